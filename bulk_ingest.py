@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Ingestão em massa de AWBs pela linha de comando, sem passar pelo Flask.
+Roda o mesmo pipeline do /api/upload (processar_arquivos_pro_tier) sobre arquivos locais ou diretórios,
+sem limite de tamanho, timeout de requisição nem cópia para UPLOAD_FOLDER.
+
+Exemplos:
+    heroku run python bulk_ingest.py historico/2024/ --limite-vazao 20000 --json stats.json
+    python bulk_ingest.py entregas.csv --profile --json -
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import cProfile
+import pstats
+import contextlib
+from datetime import datetime
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Ingestão em massa de AWBs (CSV/xlsx) direto no banco, sem o servidor web')
+    parser.add_argument('caminhos', nargs='+', help='Arquivos ou diretórios (processados em ordem de nome: o mais recente prevalece)')
+    parser.add_argument('--recursivo', action='store_true', help='Incluir subdiretórios')
+    parser.add_argument('--delta', metavar='FONTE', help='Ingestão delta: só as linhas novas ou alteradas desde o último arquivo da fonte')
+    parser.add_argument('--force', action='store_true', help='Reprocessar arquivos já processados (mesmo SHA-256)')
+    parser.add_argument('--limite-vazao', type=int, metavar='LINHAS_POR_SEGUNDO',
+                        help='Teto de linhas lidas por segundo, para não disputar o banco com o tráfego ao vivo')
+    parser.add_argument('--max-escritas', type=int, metavar='N', help='Teto de escritas simultâneas no banco (padrão: MAX_WORKERS_LIMITE)')
+    parser.add_argument('--profile', nargs='?', const='bulk_ingest.prof', metavar='ARQUIVO',
+                        help='Perfilar todas as threads do pipeline com cProfile (grava o .prof e imprime as funções mais caras)')
+    parser.add_argument('--json', metavar='ARQUIVO', help="Estatísticas em JSON no arquivo ('-' = stdout; os logs vão para stderr)")
+    parser.add_argument('--intervalo', type=float, default=10, help='Segundos entre as linhas de progresso (0 = sem progresso)')
+    return parser.parse_args()
+
+def listar_arquivos(caminhos, recursivo, allowed_file):
+    """Arquivos aceitos pelo upload, em ordem de nome dentro de cada diretório"""
+    arquivos = []
+    for caminho in caminhos:
+        if os.path.isdir(caminho):
+            encontrados = []
+            for raiz, diretorios, nomes in os.walk(caminho):
+                encontrados.extend(os.path.join(raiz, nome) for nome in nomes if allowed_file(nome))
+                if not recursivo:
+                    break
+            arquivos.extend(sorted(encontrados))
+        elif os.path.isfile(caminho):
+            arquivos.append(caminho)
+        else:
+            print(f"⚠️ Caminho não encontrado: {caminho}")
+    return arquivos
+
+class PerfilThreads:
+    """cProfile em todas as threads iniciadas durante a execução (o pipeline roda fora da thread principal)"""
+
+    def __init__(self):
+        self.perfis = []
+        self.lock = threading.Lock()
+
+    def _iniciar_na_thread(self, *_):
+        # Chamado no primeiro evento de cada thread nova: troca este gancho pelo do cProfile
+        sys.setprofile(None)
+        perfil = cProfile.Profile()
+        with self.lock:
+            self.perfis.append(perfil)
+        perfil.enable()
+
+    def __enter__(self):
+        threading.setprofile(self._iniciar_na_thread)
+        self.principal = cProfile.Profile()
+        self.principal.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.principal.disable()
+        threading.setprofile(None)
+
+    def estatisticas(self):
+        estatisticas = pstats.Stats(self.principal)
+        with self.lock:
+            for perfil in self.perfis:
+                estatisticas.add(perfil)
+        return estatisticas
+
+def resumir_perfil(estatisticas, limite=25):
+    """Funções com maior tempo acumulado, em formato serializável"""
+    funcoes = sorted(estatisticas.stats.items(), key=lambda item: item[1][3], reverse=True)[:limite]
+    return [{
+        'funcao': f'{os.path.basename(arquivo)}:{linha}({nome})',
+        'chamadas': chamadas,
+        'tempo_proprio': round(tempo_proprio, 4),
+        'tempo_acumulado': round(tempo_acumulado, 4)
+    } for (arquivo, linha, nome), (_, chamadas, tempo_proprio, tempo_acumulado, _) in funcoes]
+
+def mostrar_progresso(m, job_id, intervalo, terminado):
+    while not terminado.wait(intervalo):
+        progresso = m.obter_progresso(job_id)
+        if progresso:
+            estado = progresso.snapshot()
+            print(f"⏳ {estado['progress']:.1f}% - {estado['processed_lines']}/{estado['total_lines']} linhas, "
+                  f"{estado['new_awbs_saved']} novas, {estado['throughput_linhas_por_segundo']:.0f} linhas/s, "
+                  f"ETA {estado['estimated_time'] if estado['estimated_time'] is not None else '?'}s", file=sys.stderr)
+
+def ingerir(args):
+    # Configuração lida pelo módulo na importação: teto de escritas opcional
+    if args.max_escritas:
+        os.environ['MAX_WORKERS_LIMITE'] = str(args.max_escritas)
+    import main_supabase_integrated as m
+    # Sem retomar os jobs do web; o spool é drenado no fim da ingestão, não em background
+    m.iniciar_servicos(retomar_jobs=False, reenvio_spool=False)
+
+    if not (m.supabase or m.pg_pool):
+        print("❌ Sem conexão com o banco: configure SUPABASE_URL/SUPABASE_ANON_KEY ou DATABASE_URL")
+        return 1, {'success': False, 'error': 'Sem conexão com o banco'}
+
+    caminhos = listar_arquivos(args.caminhos, args.recursivo, m.allowed_file)
+    if not caminhos:
+        print("❌ Nenhum arquivo CSV/xlsx encontrado")
+        return 1, {'success': False, 'error': 'Nenhum arquivo encontrado'}
+
+    # Descritor de cada arquivo numa única leitura (hash para o registro de processados, formato e linhas)
+    arquivos = []
+    ignorados = []
+    for caminho in caminhos:
+        descritor = m.descrever_arquivo_local(caminho)
+        anterior = None if args.force else m.consultar_upload_processado(descritor['sha256'])
+        if anterior:
+            print(f"⏭️ {caminho}: já processado em {anterior.get('processado_em')} (use --force para reprocessar)")
+            ignorados.append({'arquivo': caminho, 'motivo': 'já processado', 'processado_em': anterior.get('processado_em')})
+            continue
+        arquivos.append({'file_path': caminho, 'upload': descritor})
+    if not arquivos:
+        return 0, {'success': True, 'data': {'arquivos': [], 'ignorados': ignorados}}
+
+    job_id = f"cli_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    print(f"🚀 Ingestão {job_id}: {len(arquivos)} arquivo(s), "
+          f"{sum(arquivo['upload']['total_linhas'] or 0 for arquivo in arquivos)} linhas")
+
+    terminado = threading.Event()
+    if args.intervalo > 0:
+        threading.Thread(target=mostrar_progresso, args=(m, job_id, args.intervalo, terminado), daemon=True).start()
+
+    perfil = PerfilThreads() if args.profile else contextlib.nullcontext()
+    try:
+        with perfil:
+            resultado = m.processar_arquivos_pro_tier(arquivos, job_id, args.delta, linhas_por_segundo=args.limite_vazao)
+    finally:
+        terminado.set()
+
+    if resultado.get('success'):
+        for arquivo, resumo in zip(arquivos, resultado['data']['arquivos']):
+            m.registrar_upload_processado(arquivo['upload'], job_id, resumo)
+
+    # O spool local não sobrevive a um dyno efêmero: tenta esvaziá-lo antes de sair
+    if m.spool_escrita.pendente():
+        try:
+            print(f"📤 Spool: {m.spool_escrita.drenar()} linhas reenviadas ao banco")
+        except Exception as e:
+            print(f"⚠️ Spool: reenvio falhou ({e})")
+    spool = m.spool_escrita.estatisticas()
+
+    estatisticas = {
+        **resultado,
+        'job_id': job_id,
+        'ignorados': ignorados,
+        'spool': spool,
+        'opcoes': {
+            'limite_vazao': args.limite_vazao,
+            'max_escritas': m.MAX_WORKERS_LIMITE,
+            'delta': args.delta,
+            'force': args.force
+        }
+    }
+    if args.profile:
+        dados_perfil = perfil.estatisticas()
+        dados_perfil.dump_stats(args.profile)
+        dados_perfil.sort_stats('cumulative').print_stats(25)
+        estatisticas['perfil'] = {'arquivo': args.profile, 'funcoes': resumir_perfil(dados_perfil)}
+
+    if not resultado.get('success'):
+        codigo = 1
+    elif spool['linhas_pendentes'] or any(motivo.startswith('falha_') for motivo in resultado['data']['erros_por_motivo']):
+        codigo = 2  # Concluído, mas com linhas fora do banco (spool pendente ou falhas de gravação)
+    else:
+        codigo = 0
+    return codigo, estatisticas
+
+def main():
+    args = parse_args()
+    # Com o JSON no stdout, todo o log (inclusive o da importação do módulo) vai para o stderr
+    saida_log = sys.stderr if args.json == '-' else sys.stdout
+    inicio = time.time()
+    with contextlib.redirect_stdout(saida_log):
+        codigo, estatisticas = ingerir(args)
+    estatisticas['tempo_total_cli'] = round(time.time() - inicio, 2)
+    estatisticas['codigo_saida'] = codigo
+
+    if args.json == '-':
+        print(json.dumps(estatisticas, ensure_ascii=False, default=str))
+    elif args.json:
+        with open(args.json, 'w') as arquivo:
+            json.dump(estatisticas, arquivo, ensure_ascii=False, indent=2, default=str)
+        print(f"📊 Estatísticas gravadas em {args.json}")
+
+    status = {0: '✅ Ingestão concluída', 1: '❌ Ingestão falhou', 2: '⚠️ Ingestão concluída com linhas fora do banco'}[codigo]
+    print(f"{status} em {estatisticas['tempo_total_cli']}s", file=saida_log)
+    sys.exit(codigo)
+
+if __name__ == "__main__":
+    main()
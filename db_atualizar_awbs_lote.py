@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Script para criar no banco PostgreSQL a função atualizar_awbs_lote do sistema MenezesLog.
+A função aplica as alterações de tipo/data/valor de um lote de AWBs numa única chamada RPC do Supabase
+(AWBs pagas ficam como estão) e, com upload_id, guarda antes o estado anterior delas em awbs_alteracoes.
+"""
+
+import os
+import sys
+import psycopg2
+
+# Obter URL do banco de dados do Heroku
+DATABASE_URL = os.environ.get('DATABASE_URL')
+if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
+
+if not DATABASE_URL:
+    print("Erro: Variável de ambiente DATABASE_URL não encontrada.")
+    print("Execute este script no Heroku com: heroku run python db_atualizar_awbs_lote.py")
+    sys.exit(1)
+
+def criar_funcao_atualizacao():
+    """Cria (ou substitui) a função atualizar_awbs_lote(alteracoes jsonb, p_upload_id text)."""
+    try:
+        print("Conectando ao banco de dados PostgreSQL...")
+        conn = psycopg2.connect(DATABASE_URL)
+        cursor = conn.cursor()
+
+        print("Criando função atualizar_awbs_lote...")
+        # alteracoes: [{"awb", "tipo_servico", "data_entrega", "valor_entrega"}, ...], convertidos com os tipos de awbs
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION atualizar_awbs_lote(alteracoes jsonb, p_upload_id text DEFAULT NULL)
+            RETURNS TABLE (awb text)
+            LANGUAGE plpgsql
+            AS $$
+            #variable_conflict use_column
+            BEGIN
+                IF p_upload_id IS NOT NULL THEN
+                    INSERT INTO awbs_alteracoes (upload_id, awb, tipo_servico, data_entrega, valor_entrega,
+                                                 tipo_servico_novo, data_entrega_nova)
+                    SELECT p_upload_id, a.awb, a.tipo_servico, a.data_entrega, a.valor_entrega, s.tipo_servico, s.data_entrega
+                    FROM awbs a JOIN jsonb_populate_recordset(NULL::awbs, alteracoes) s ON a.awb = s.awb
+                    WHERE a.status IS DISTINCT FROM 'PAGA';
+                END IF;
+
+                RETURN QUERY
+                UPDATE awbs a
+                SET tipo_servico = s.tipo_servico, data_entrega = s.data_entrega, valor_entrega = s.valor_entrega
+                FROM jsonb_populate_recordset(NULL::awbs, alteracoes) s
+                WHERE a.awb = s.awb AND a.status IS DISTINCT FROM 'PAGA'
+                RETURNING a.awb::text;
+            END;
+            $$;
+        """)
+        print("Função atualizar_awbs_lote criada com sucesso!")
+
+        # O PostgREST do Supabase só enxerga funções novas depois de recarregar o cache do esquema
+        cursor.execute("NOTIFY pgrst, 'reload schema';")
+
+        # Commit das alterações
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+        print("Reinicie a aplicação para que ela passe a atualizar AWBs em lote.")
+
+    except Exception as e:
+        print(f"Erro ao criar a função atualizar_awbs_lote: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    criar_funcao_atualizacao()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Script para criar no banco PostgreSQL o esquema da linhagem dos uploads do sistema MenezesLog.
+Adiciona a coluna upload_id à tabela awbs e cria a tabela awbs_alteracoes, usadas para reverter um upload.
+"""
+
+import os
+import sys
+import psycopg2
+
+# Obter URL do banco de dados do Heroku
+DATABASE_URL = os.environ.get('DATABASE_URL')
+if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
+
+if not DATABASE_URL:
+    print("Erro: Variável de ambiente DATABASE_URL não encontrada.")
+    print("Execute este script no Heroku com: heroku run python db_linhagem_uploads.py")
+    sys.exit(1)
+
+def criar_linhagem_uploads():
+    """Cria a coluna awbs.upload_id e a tabela awbs_alteracoes, se ainda não existirem."""
+    try:
+        print("Conectando ao banco de dados PostgreSQL...")
+        conn = psycopg2.connect(DATABASE_URL)
+        cursor = conn.cursor()
+
+        # Verificar se a coluna upload_id já existe na tabela awbs
+        cursor.execute("""
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_name='awbs' AND column_name='upload_id';
+        """)
+
+        if cursor.fetchone() is None:
+            print("Adicionando coluna upload_id à tabela awbs...")
+            cursor.execute("""
+                ALTER TABLE awbs
+                ADD COLUMN upload_id TEXT NULL;
+            """)
+            print("Coluna upload_id adicionada com sucesso!")
+        else:
+            print("A coluna upload_id já existe na tabela awbs.")
+
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS awbs_upload_id_idx ON awbs (upload_id, id);
+        """)
+
+        # Verificar se a tabela awbs_alteracoes existe
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT FROM information_schema.tables
+                WHERE table_name='awbs_alteracoes'
+            );
+        """)
+
+        if not cursor.fetchone()[0]:
+            print("Criando tabela awbs_alteracoes...")
+            # Os campos copiados de awbs herdam os tipos da própria tabela awbs
+            cursor.execute("""
+                SELECT attname::text, format_type(atttypid, atttypmod)
+                FROM pg_attribute
+                WHERE attrelid = 'awbs'::regclass AND attname IN ('tipo_servico', 'data_entrega', 'valor_entrega');
+            """)
+            tipos = dict(cursor.fetchall())
+            cursor.execute(f"""
+                CREATE TABLE awbs_alteracoes (
+                    id BIGSERIAL PRIMARY KEY,
+                    upload_id TEXT NOT NULL,
+                    awb TEXT NOT NULL,
+                    tipo_servico {tipos.get('tipo_servico', 'INTEGER')},
+                    data_entrega {tipos.get('data_entrega', 'TIMESTAMP')},
+                    valor_entrega {tipos.get('valor_entrega', 'NUMERIC(10, 2)')},
+                    tipo_servico_novo {tipos.get('tipo_servico', 'INTEGER')},
+                    data_entrega_nova {tipos.get('data_entrega', 'TIMESTAMP')},
+                    registrado_em TIMESTAMPTZ DEFAULT now()
+                );
+            """)
+            cursor.execute("""
+                CREATE INDEX awbs_alteracoes_upload_id_idx ON awbs_alteracoes (upload_id, id);
+            """)
+            print("Tabela awbs_alteracoes criada com sucesso!")
+        else:
+            print("A tabela awbs_alteracoes já existe.")
+
+        # Commit das alterações
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+        print("Esquema da linhagem dos uploads criado com sucesso!")
+        print("Reinicie a aplicação para que ela volte a gravar a linhagem (LINHAGEM_UPLOADS=1).")
+
+    except Exception as e:
+        print(f"Erro ao criar o esquema da linhagem dos uploads: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    criar_linhagem_uploads()
@@ -5,14 +5,29 @@
 from flask import Flask, request, jsonify, render_template, send_from_directory
 from flask_cors import CORS
 import os
+import io
 import json
 import pandas as pd
+import numpy as np
 import chardet
+import codecs
 import csv
 from datetime import datetime
 import threading
+import queue
 import time
-from concurrent.futures import ThreadPoolExecutor
+import uuid
+import hashlib
+import shutil
+import tempfile
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+import signal
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, TimeoutError as FuturoExpirado
+import multiprocessing
+from collections import deque
 import logging
 from werkzeug.utils import secure_filename
 
@@ -28,12 +43,43 @@ except ImportError:
     SUPABASE_AVAILABLE = False
     print("❌ Biblioteca supabase-py não encontrada")
 
+# Conexão direta com o Postgres (ingestão via COPY)
+try:
+    import psycopg2
+    import psycopg2.pool
+    PSYCOPG2_AVAILABLE = True
+except ImportError:
+    PSYCOPG2_AVAILABLE = False
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Sem flock (ex.: Windows): o índice em disco só é seguro com um processo
+
+# Leitura de planilhas xlsx em streaming: utilitários do openpyxl (datas e referências de coluna)
+try:
+    from openpyxl.styles.numbers import is_date_format
+    from openpyxl.utils import column_index_from_string
+    from openpyxl.utils.datetime import from_excel, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
 app = Flask(__name__, static_folder='static')
 CORS(app)
 
 # Configurações otimizadas para Supabase PRO TIER
-UPLOAD_FOLDER = 'uploads'
-DATA_FOLDER = 'data'
+# Arquivos recebidos, checkpoints dos jobs, spool e índice de AWBs ficam em disco local. Num dyno do Heroku esse disco
+# é efêmero (apagado a cada restart/deploy): aponte as pastas para um volume persistente onde houver um
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
 ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls'}
 
 # OTIMIZAÇÕES PARA SUPABASE PRO TIER
@@ -43,9 +89,111 @@ BATCH_DELAY = 0.05  # 50ms entre batches (muito mais rápido)
 MAX_RETRIES = 5   # Mais tentativas para garantir sucesso
 CHUNK_SIZE = 2000  # Chunks maiores para processamento
 
+# Controle adaptativo (AIMD) das escritas: BATCH_SIZE/MAX_WORKERS/BATCH_DELAY são só os valores iniciais
+BATCH_SIZE_MIN = 50
+BATCH_SIZE_MAX = int(os.environ.get('BATCH_SIZE_MAX', 2000))
+BATCH_SIZE_INCREMENTO = 50  # Aumento aditivo por lote bem-sucedido
+MAX_WORKERS_LIMITE = int(os.environ.get('MAX_WORKERS_LIMITE', 8))  # Teto de escritas simultâneas
+BATCH_DELAY_MAX = 2.0
+LATENCIA_ALVO = 1.0  # Segundos por lote abaixo dos quais o controlador acelera
+LATENCIA_MAXIMA = 3.0  # Acima disso (ou em erro/timeout) o controlador reduz pela metade
+
+# Inserts que ignoram conflitos no servidor (requer UNIQUE em awbs.awb): o cache local vira só otimização
+INSERT_IGNORAR_CONFLITOS = os.environ.get('INSERT_IGNORAR_CONFLITOS', '1') == '1'
+# Linhagem dos uploads: cada AWB inserida leva o upload_id (job ou micro-lote de ingestão) e cada atualização guarda o
+# estado anterior da AWB, o que permite reverter um upload inteiro. Requer no banco a coluna awbs.upload_id e a tabela
+# awbs_alteracoes, criadas por db_linhagem_uploads.py; sem elas a linhagem é desligada na inicialização
+# (verificar_linhagem_uploads)
+LINHAGEM_UPLOADS = os.environ.get('LINHAGEM_UPLOADS', '1') == '1'
+ALTERACOES_TABELA = 'awbs_alteracoes'
+# Atualizações via REST em uma chamada RPC por lote (função atualizar_awbs_lote, criada por db_atualizar_awbs_lote.py);
+# sem a função no banco, verificar_atualizacao_em_lote desliga e as atualizações voltam a um UPDATE por combinação de valores
+ATUALIZACAO_VIA_RPC = os.environ.get('ATUALIZACAO_VIA_RPC', '1') == '1'
+REVERSAO_LOTE = 5000  # AWBs por DELETE (faixa de ids) na reversão de um upload
+PRELOAD_AWBS_MIN_LINHAS = 20000  # Abaixo disso, com cache frio, não vale carregar todas as AWBs antes do upload
+
+# Leitura em streaming: apenas as colunas usadas pelo pipeline, com dtypes explícitos
+COLUNAS_PIPELINE = ['AWB', 'ID do motorista', 'Tipo de Serviço', 'Data/Hora Status do último status']
+DTYPES_PIPELINE = {coluna: str for coluna in COLUNAS_PIPELINE}
+CSV_ENGINE = os.environ.get('CSV_ENGINE', 'c')  # 'c' (pandas) ou 'pyarrow' (mais rápido, se instalado)
+
+# Parse + transformação em processos (opcional, para arquivos muito grandes em dynos com vários núcleos)
+PROCESS_POOL_WORKERS = int(os.environ.get('PROCESS_POOL_WORKERS', 0))  # 0 = desligado
+PROCESS_POOL_MIN_BYTES = 50 * 1024 * 1024  # Só vale a pena acima de ~50 MB
+FAIXA_BYTES = 16 * 1024 * 1024  # Tamanho de cada faixa do arquivo enviada a um processo
+
+# Intake do upload: gravação, hash e detecção de formato numa única leitura do corpo da requisição
+INTAKE_BLOCO_BYTES = 1024 * 1024
+INTAKE_AMOSTRA_BYTES = 64 * 1024  # Início do arquivo guardado para detectar encoding e delimitador
+# Limites de um .zip no upload em lote, conferidos no diretório central antes de extrair qualquer membro
+ZIP_MAX_MEMBROS = int(os.environ.get('ZIP_MAX_MEMBROS', 1000))
+ZIP_MAX_BYTES = int(os.environ.get('ZIP_MAX_BYTES', 2 * 1024 ** 3))  # Total descomprimido
+ZIP_MAX_RAZAO = 100  # Descomprimido / comprimido por membro (CSV real fica bem abaixo disso)
+BOMS_ENCODING = [  # UTF-32 antes de UTF-16: o BOM UTF-32 LE começa com o BOM UTF-16 LE
+    (b'\x00\x00\xfe\xff', 'utf-32'),
+    (b'\xff\xfe\x00\x00', 'utf-32'),
+    (b'\xef\xbb\xbf', 'utf-8-sig'),
+    (b'\xfe\xff', 'utf-16'),
+    (b'\xff\xfe', 'utf-16')
+]
+
+# Ingestão delta: fingerprints das linhas do último upload de cada fonte (só o que mudou é processado)
+FINGERPRINTS_FOLDER = os.path.join(DATA_FOLDER, 'fingerprints')
+fingerprints_fontes_lock = threading.Lock()
+
+# Processos auxiliares (pool de transformação) importam este módulo sem abrir conexões: no spawn o processo filho
+# já tem o nome do multiprocessing ao importar o módulo; a variável de ambiente força o modo em outros cenários
+PROCESSO_AUXILIAR = (os.environ.get('MENEZESLOG_PROCESSO_AUXILIAR') == '1'
+                     or multiprocessing.current_process().name != 'MainProcess')
+# Retomar no boot os jobs com checkpoint em disco. Desligado por padrão no Heroku (variável DYNO): o restart apaga o
+# disco do dyno junto com os checkpoints e os arquivos enviados, e não há o que retomar
+RETOMAR_JOBS = os.environ.get('RETOMAR_JOBS', '0' if os.environ.get('DYNO') else '1') == '1'
+
+# Índice de AWBs persistido em disco (memmap), compartilhado pelos workers do gunicorn no mesmo servidor
+INDICE_AWBS_PERSISTENTE = os.environ.get('INDICE_AWBS_PERSISTENTE', '1') == '1'
+INDICE_AWBS_DIR = os.environ.get('INDICE_AWBS_DIR', os.path.join(DATA_FOLDER, 'indice_awbs'))
+
+# Checkpoints dos jobs de upload (retomada após restart) e sinal de encerramento (SIGTERM)
+JOBS_FOLDER = os.path.join(DATA_FOLDER, 'jobs')
+encerramento_solicitado = threading.Event()
+upload_jobs_cancelamentos = {}  # job_id -> threading.Event (cancelamento pedido neste processo)
+# Escritas de AWBs (pipeline de upload, micro-lote da ingestão contínua, reenvio do spool) seguram esta trava
+# compartilhada entre processos; a reversão de upload só roda com a exclusiva, sem escrita em nenhum worker
+ESCRITAS_TRAVA = os.path.join(JOBS_FOLDER, 'escritas.lock')
+
+# Spool local de lotes que o banco recusou: segmentos append-only em disco, reenviados em background
+SPOOL_FOLDER = os.environ.get('SPOOL_FOLDER', os.path.join(DATA_FOLDER, 'spool'))
+SPOOL_SEGMENTO_BYTES = 64 * 1024 * 1024  # Tamanho a partir do qual um novo segmento é aberto
+SPOOL_REPLAY_INTERVALO = 10  # Segundos entre verificações do spool (dobra a cada falha no reenvio)
+SPOOL_REPLAY_INTERVALO_MAX = 300
+SPOOL_REPLAY_LINHAS_POR_SEGUNDO = int(os.environ.get('SPOOL_REPLAY_LINHAS_POR_SEGUNDO', 5000))  # Teto do reenvio
+SPOOL_REPLAY_MAX_TENTATIVAS = 50  # Depois disso o registro vai para rejeitados.log e libera a fila
+
+# Dedup dentro do arquivo: fingerprints das AWBs já vistas no upload, com runs ordenados em disco acima do limite
+DEDUP_ARQUIVO_LIMITE_MEMORIA = int(os.environ.get('DEDUP_ARQUIVO_LIMITE_MEMORIA', 4_000_000))  # Fingerprints (~8 bytes cada)
+
+# Pipeline de ingestão: leitor → transformação → dedup → escrita, ligados por filas limitadas
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', 2))  # Threads da etapa de transformação
+PIPELINE_FILA = MAX_WORKERS_LIMITE * 2  # Chunks por fila entre etapas (backpressure: memória constante)
+
+# Ingestão contínua de eventos (NDJSON/CSV): envios pequenos agrupados em micro-lotes limitados por linhas e por tempo
+INGESTAO_LOTE_LINHAS = int(os.environ.get('INGESTAO_LOTE_LINHAS', 1000))  # Linhas a partir das quais o micro-lote é gravado
+INGESTAO_LOTE_ESPERA = float(os.environ.get('INGESTAO_LOTE_ESPERA', 0.25))  # Segundos que o 1º evento pendente espera por outros
+INGESTAO_MAX_PENDENTES = 50000  # Linhas aguardando gravação (acima disso os envios esperam vaga: backpressure)
+INGESTAO_TIMEOUT = 60  # Segundos que uma requisição espera por vaga ou pela confirmação das suas linhas
+COLUNAS_EVENTO = {  # Nomes aceitos nos eventos NDJSON, além dos cabeçalhos do CSV
+    'awb': 'AWB',
+    'id_motorista': 'ID do motorista',
+    'tipo_servico': 'Tipo de Serviço',
+    'data_entrega': 'Data/Hora Status do último status'
+}
+
 # Criar pastas necessárias
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(DATA_FOLDER, exist_ok=True)
+os.makedirs(FINGERPRINTS_FOLDER, exist_ok=True)
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+os.makedirs(SPOOL_FOLDER, exist_ok=True)
 os.makedirs('static', exist_ok=True)
 
 # Configuração do Supabase
@@ -54,20 +202,41 @@ SUPABASE_ANON_KEY = os.environ.get('SUPABASE_ANON_KEY')
 SUPABASE_SERVICE_KEY = os.environ.get('SUPABASE_SERVICE_KEY')
 
 supabase = None
-if SUPABASE_AVAILABLE and SUPABASE_URL and SUPABASE_ANON_KEY:
+if SUPABASE_AVAILABLE and SUPABASE_URL and SUPABASE_ANON_KEY and not PROCESSO_AUXILIAR:
     try:
         supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
         print("✅ Conexão com Supabase PRO estabelecida")
     except Exception as e:
         print(f"❌ Erro ao conectar com Supabase: {e}")
 
+# Backend de escrita direto no Postgres: COPY para staging + merge em awbs (se DATABASE_URL estiver configurada)
+DATABASE_URL = os.environ.get('DATABASE_URL')
+if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
+
+pg_pool = None
+if PSYCOPG2_AVAILABLE and DATABASE_URL and os.environ.get('COPY_BACKEND', '1') == '1' and not PROCESSO_AUXILIAR:
+    try:
+        pg_pool = psycopg2.pool.ThreadedConnectionPool(1, MAX_WORKERS_LIMITE + 2, DATABASE_URL)
+        print("✅ Conexão direta com Postgres estabelecida (ingestão via COPY)")
+    except Exception as e:
+        print(f"❌ Erro ao conectar diretamente no Postgres: {e}")
+
 # Cache global para performance máxima
 cache_motoristas = {}
 cache_tarifas = {}
-cache_awbs_existentes = set()
 cache_timestamp = 0
 CACHE_DURATION = 900  # 15 minutos (Pro tier permite cache mais longo)
 
+# Sincronização incremental do cache de AWBs (high-water mark pelo id da tabela awbs)
+AWBS_VERIFICACAO_INTERVALO = 3600  # Verificação de divergência (contagem no banco x índice) a cada 1 hora
+cache_awbs_sync = {
+    'watermark': None,  # Maior id de awbs já incorporado ao índice (None = cache frio)
+    'ultima_reconstrucao': None,
+    'ultima_verificacao': 0
+}
+cache_awbs_sync_lock = threading.Lock()
+
 # Tarifas padrão do sistema
 TARIFAS_PADRAO = {
     0: 3.50,  # Encomendas
@@ -76,103 +245,1400 @@ TARIFAS_PADRAO = {
     8: 0.50   # Revistas
 }
 
-# Status de processamento global
-processing_status = {
-    'active': False,
-    'progress': 0,
-    'message': '',
-    'total_lines': 0,
-    'processed_lines': 0,
-    'errors': 0,
-    'duplicates_discarded': 0,
-    'new_awbs_saved': 0,
-    'start_time': None,
-    'estimated_time': None,
-    'performance_stats': {}
-}
+# Colunas gravadas na tabela awbs
+COLUNAS_AWBS = ['empresa_id', 'awb', 'id_motorista', 'nome_motorista', 'tipo_servico', 'data_entrega', 'valor_entrega', 'status']
+if LINHAGEM_UPLOADS:
+    COLUNAS_AWBS.append('upload_id')
+COLUNAS_AWBS_ATUALIZAVEIS = ['tipo_servico', 'data_entrega', 'valor_entrega']  # Reescritas quando um arquivo traz tipo/data novos
+
+# Tabelas de junção do transform vetorizado (remontadas quando os caches mudam)
+lookup_transform = None
+lookup_transform_lock = threading.Lock()
+
+# Progresso dos uploads, um registro por job (entradas concluídas expiram)
+PROGRESSO_TTL = 3600  # 1 hora
+PROGRESSO_JANELA_ETA = 30  # Segundos de histórico usados no throughput móvel
+progresso_uploads = {}
+progresso_uploads_lock = threading.Lock()
+
+# Jobs de upload executados em background (estado consultável por ID). O estado fica na memória deste processo:
+# o web roda com um único worker do gunicorn (--workers 1 --threads N no Procfile), senão a consulta de um job
+# pode cair num worker que não o conhece
+UPLOAD_JOB_WORKERS = int(os.environ.get('UPLOAD_JOB_WORKERS', 2))  # Uploads processados simultaneamente
+UPLOAD_JOB_MAX_FILA = int(os.environ.get('UPLOAD_JOB_MAX_FILA', 10))  # Jobs pendentes (queued + running) aceitos
+upload_jobs = {}
+upload_jobs_lock = threading.Lock()
+upload_job_executor = ThreadPoolExecutor(max_workers=UPLOAD_JOB_WORKERS, thread_name_prefix='upload-job')
+
+# Registro de arquivos já processados, pelo SHA-256 do conteúdo (reenvio idêntico devolve o resultado anterior).
+# Tabela no Supabase: uploads_processados (content_hash text primary key, arquivo text, tamanho_bytes bigint,
+# total_linhas integer, job_id text, resultado jsonb, processado_em timestamptz)
+UPLOADS_PROCESSADOS_TABELA = 'uploads_processados'
+uploads_processados = {}
+uploads_processados_lock = threading.Lock()
+
+class ProgressoUpload:
+    """Progresso thread-safe de um job de upload: contadores, tempos por etapa e ETA"""
+    
+    CONTADORES = ('processed_lines', 'errors', 'duplicates_discarded', 'new_awbs_saved', 'linhas_concluidas')
+    
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.lock = threading.Lock()
+        self.active = True
+        self.message = 'Iniciando processamento PRO TIER...'
+        self.total_lines = 0
+        self.contadores = dict.fromkeys(self.CONTADORES, 0)
+        self.etapas = {}
+        self.performance_stats = {}
+        self.start_time = time.time()
+        self.finished_time = None
+        self.amostras = deque([(self.start_time, 0)])
+    
+    def atualizar(self, **campos):
+        """Atualiza mensagem, total de linhas ou estatísticas"""
+        with self.lock:
+            for campo, valor in campos.items():
+                setattr(self, campo, valor)
+    
+    def incrementar(self, **incrementos):
+        """Soma atomicamente aos contadores e registra amostra para o throughput"""
+        with self.lock:
+            for contador, valor in incrementos.items():
+                self.contadores[contador] += valor
+            
+            agora = time.time()
+            self.amostras.append((agora, self.contadores['linhas_concluidas']))
+            while len(self.amostras) > 2 and agora - self.amostras[0][0] > PROGRESSO_JANELA_ETA:
+                self.amostras.popleft()
+    
+    def registrar_etapa(self, etapa, segundos):
+        """Acumula o tempo gasto em uma etapa do pipeline"""
+        with self.lock:
+            self.etapas[etapa] = self.etapas.get(etapa, 0) + segundos
+    
+    def finalizar(self, **campos):
+        """Marca o job como concluído (passa a contar o TTL de expiração)"""
+        with self.lock:
+            for campo, valor in campos.items():
+                setattr(self, campo, valor)
+            self.active = False
+            self.finished_time = time.time()
+    
+    def snapshot(self):
+        """Cópia consistente do progresso para a API"""
+        with self.lock:
+            concluidas = self.contadores['linhas_concluidas']
+            (t0, linhas0), (t1, linhas1) = self.amostras[0], self.amostras[-1]
+            throughput = (linhas1 - linhas0) / (t1 - t0) if t1 > t0 else 0
+            
+            if not self.active:
+                progress = 100
+                estimated_time = 0
+            else:
+                progress = min(concluidas / self.total_lines * 100, 100) if self.total_lines else 0
+                restantes = max(self.total_lines - concluidas, 0)
+                estimated_time = round(restantes / throughput, 1) if throughput > 0 and self.total_lines else None
+            
+            return {
+                'job_id': self.job_id,
+                'active': self.active,
+                'progress': round(progress, 2),
+                'message': self.message,
+                'total_lines': self.total_lines,
+                'processed_lines': self.contadores['processed_lines'],
+                'errors': self.contadores['errors'],
+                'duplicates_discarded': self.contadores['duplicates_discarded'],
+                'new_awbs_saved': self.contadores['new_awbs_saved'],
+                'start_time': self.start_time,
+                'estimated_time': estimated_time,
+                'throughput_linhas_por_segundo': round(throughput, 2),
+                'stage_timings': {etapa: round(segundos, 3) for etapa, segundos in self.etapas.items()},
+                'performance_stats': dict(self.performance_stats)
+            }
+
+class ControladorEscrita:
+    """Controlador AIMD do tamanho de lote e das escritas simultâneas, guiado por latência e falhas"""
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.batch_size = BATCH_SIZE
+        self.limite_escritas = min(MAX_WORKERS, MAX_WORKERS_LIMITE)
+        self.atraso = BATCH_DELAY
+        self.em_voo = 0
+        self.sucessos_seguidos = 0
+        self.lotes = 0
+        self.falhas = 0
+        self.latencia_media = None
+        self.decisoes = deque(maxlen=20)
+    
+    def adquirir(self):
+        """Bloqueia até haver vaga entre as escritas simultâneas permitidas"""
+        with self.cond:
+            while self.em_voo >= self.limite_escritas:
+                self.cond.wait()
+            self.em_voo += 1
+    
+    def liberar(self):
+        with self.cond:
+            self.em_voo -= 1
+            self.cond.notify_all()
+    
+    def registrar(self, latencia, sucesso):
+        """Ajusta os parâmetros após cada lote: aumento aditivo, redução multiplicativa"""
+        with self.cond:
+            self.lotes += 1
+            self.latencia_media = latencia if self.latencia_media is None else 0.8 * self.latencia_media + 0.2 * latencia
+            
+            if not sucesso or latencia > LATENCIA_MAXIMA:
+                self.falhas += 0 if sucesso else 1
+                self.sucessos_seguidos = 0
+                self.batch_size = max(BATCH_SIZE_MIN, self.batch_size // 2)
+                self.limite_escritas = max(1, self.limite_escritas // 2)
+                self.atraso = min(BATCH_DELAY_MAX, max(self.atraso * 2, BATCH_DELAY))
+                self._decidir('reduzir', 'falha' if not sucesso else f'latência {latencia:.2f}s')
+            elif latencia <= LATENCIA_ALVO:
+                self.sucessos_seguidos += 1
+                anterior = (self.batch_size, self.limite_escritas)
+                self.batch_size = min(BATCH_SIZE_MAX, self.batch_size + BATCH_SIZE_INCREMENTO)
+                if self.sucessos_seguidos % 3 == 0:
+                    self.limite_escritas = min(MAX_WORKERS_LIMITE, self.limite_escritas + 1)
+                    self.atraso = self.atraso / 2 if self.atraso > 0.005 else 0
+                if (self.batch_size, self.limite_escritas) != anterior:
+                    self._decidir('aumentar', f'latência {latencia:.2f}s')
+            self.cond.notify_all()
+    
+    def _decidir(self, acao, motivo):
+        self.decisoes.append({
+            'momento': datetime.now().isoformat(timespec='seconds'),
+            'acao': acao,
+            'motivo': motivo,
+            'batch_size': self.batch_size,
+            'escritas_simultaneas': self.limite_escritas,
+            'atraso': round(self.atraso, 3)
+        })
+    
+    def estatisticas(self):
+        with self.cond:
+            return {
+                'batch_size': self.batch_size,
+                'escritas_simultaneas': self.limite_escritas,
+                'atraso_entre_lotes': round(self.atraso, 3),
+                'latencia_media_ms': round(self.latencia_media * 1000, 1) if self.latencia_media is not None else None,
+                'lotes': self.lotes,
+                'falhas': self.falhas,
+                'decisoes': list(self.decisoes)
+            }
+
+# Controlador único do processo: a capacidade do banco é compartilhada entre os jobs
+controlador_escrita = ControladorEscrita()
+
+ESTADO_DESCONHECIDO = np.uint64(0)  # AWB indexada sem os campos mutáveis (não gera update)
+
+def fingerprint_awbs(awbs):
+    """Fingerprints de 64 bits das AWBs (hash vetorizado e estável entre processos)"""
+    return pd.util.hash_array(np.asarray(awbs, dtype=object), categorize=False)
+
+def _localizar_em(ordenado, valores):
+    """Busca em lote num array ordenado (fingerprints, ids): posição de cada valor e máscara dos encontrados.
+    
+    Nos não encontrados a posição é só um índice válido qualquer de ordenado (0 se ele estiver vazio).
+    """
+    if not len(ordenado) or not len(valores):
+        return np.zeros(len(valores), dtype=np.int64), np.zeros(len(valores), dtype=bool)
+    posicoes = np.minimum(np.searchsorted(ordenado, valores), len(ordenado) - 1)
+    return posicoes, ordenado[posicoes] == valores
+
+def fingerprint_estados(tipos_servico, datas_entrega):
+    """Fingerprints de 64 bits dos campos mutáveis de cada AWB (tipo de serviço + data de entrega normalizada)"""
+    datas = pd.Series(np.asarray(datas_entrega, dtype=object)).fillna('').astype(str).str.strip()
+    # Data normalizada para o instante: '2025-01-02 10:00' do CSV e '2025-01-02T10:00:00' do banco coincidem
+    try:
+        instantes = pd.to_datetime(datas, errors='raise', format='ISO8601', utc=True)
+    except (ValueError, TypeError):
+        instantes = pd.to_datetime(datas, errors='coerce', format='mixed', dayfirst=True, utc=True)
+    
+    campos = pd.DataFrame({
+        'tipo_servico': pd.to_numeric(pd.Series(np.asarray(tipos_servico, dtype=object)), errors='coerce').fillna(-1).astype('int64'),
+        'instante': instantes.astype('int64'),
+        'texto': datas.where(instantes.isna(), '')  # Datas não reconhecidas entram como texto
+    })
+    estados = pd.util.hash_pandas_object(campos, index=False).to_numpy(dtype=np.uint64)
+    estados[estados == ESTADO_DESCONHECIDO] = 1
+    return estados
+
+class IndiceAWB:
+    """Índice compacto das AWBs existentes: fingerprints de 64 bits ordenados + buffer de inserções.
+    
+    Cada AWB guarda ao lado o fingerprint dos campos mutáveis (tipo de serviço, data de entrega),
+    o que permite detectar alterações sem reler a linha no banco.
+    """
+    
+    LIMITE_BUFFER = 65536  # Acima disso o buffer é mesclado ao array principal
+    
+    def __init__(self, fingerprints=None):
+        self.lock = threading.Lock()
+        self.base = np.unique(np.asarray(fingerprints, dtype=np.uint64)) if fingerprints is not None else np.empty(0, dtype=np.uint64)
+        self.base_estados = np.full(len(self.base), ESTADO_DESCONHECIDO, dtype=np.uint64)
+        self.buffer = np.empty(0, dtype=np.uint64)
+        self.buffer_estados = np.empty(0, dtype=np.uint64)
+        self.sobrepostas = 0  # AWBs da base com estado mais recente no buffer (o buffer prevalece)
+    
+    def __len__(self):
+        return len(self.base) + len(self.buffer) - self.sobrepostas
+    
+    def __contains__(self, awb):
+        return bool(self.contem([awb])[0])
+    
+    def contem(self, awbs):
+        """Máscara booleana com as AWBs do lote que já estão no índice"""
+        return self.contem_fingerprints(fingerprint_awbs(awbs))
+    
+    def contem_fingerprints(self, fingerprints):
+        with self.lock:
+            return _localizar_em(self.base, fingerprints)[1] | _localizar_em(self.buffer, fingerprints)[1]
+    
+    def adicionar(self, awbs, estados=None):
+        self.adicionar_fingerprints(fingerprint_awbs(awbs), estados)
+    
+    def adicionar_fingerprints(self, fingerprints, estados=None):
+        if estados is None:
+            estados = np.full(len(fingerprints), ESTADO_DESCONHECIDO, dtype=np.uint64)
+        with self.lock:
+            self._adicionar(np.asarray(fingerprints, dtype=np.uint64), np.asarray(estados, dtype=np.uint64))
+    
+    def classificar(self, awbs, estados=None):
+        """Em uma operação atômica, separa a 1ª ocorrência de cada AWB do lote em inéditas e alteradas.
+        
+        Retorna (novas, alteradas) como máscaras; ambas passam a constar no índice com o estado recebido.
+        AWBs já indexadas com estado desconhecido só têm o estado registrado, sem contar como alteradas.
+        """
+        fingerprints = fingerprint_awbs(awbs)
+        if estados is None:
+            estados = np.full(len(fingerprints), ESTADO_DESCONHECIDO, dtype=np.uint64)
+        primeiras = np.zeros(len(fingerprints), dtype=bool)
+        _, indices = np.unique(fingerprints, return_index=True)
+        primeiras[indices] = True
+        
+        with self.lock, self._sincronizado():
+            atuais, existentes = self._estados(fingerprints)
+            novas = primeiras & ~existentes
+            alteradas = (primeiras & existentes & (estados != ESTADO_DESCONHECIDO)
+                         & (atuais != ESTADO_DESCONHECIDO) & (atuais != estados))
+            registrar = novas | (primeiras & existentes & (estados != ESTADO_DESCONHECIDO) & (atuais != estados))
+            self._registrar(fingerprints[registrar], estados[registrar])
+        return novas, alteradas
+    
+    def remover(self, awbs):
+        """Tira AWBs do índice (reversão de um upload); retorna quantas estavam indexadas"""
+        fingerprints = np.unique(fingerprint_awbs(awbs))
+        with self.lock:
+            return self._remover(fingerprints)
+    
+    def _estados(self, fingerprints):
+        """Estado guardado de cada fingerprint (ESTADO_DESCONHECIDO se ausente, buffer antes da base) e máscara dos existentes"""
+        posicoes_base, na_base = _localizar_em(self.base, fingerprints)
+        posicoes_buffer, no_buffer = _localizar_em(self.buffer, fingerprints)
+        estados = np.full(len(fingerprints), ESTADO_DESCONHECIDO, dtype=np.uint64)
+        estados[na_base] = self.base_estados[posicoes_base[na_base]]
+        estados[no_buffer] = self.buffer_estados[posicoes_buffer[no_buffer]]
+        return estados, na_base | no_buffer
+    
+    def _sincronizado(self):
+        """Contexto em que o índice é lido e alterado (no persistente: flock com o estado recarregado do disco)"""
+        return nullcontext()
+    
+    def _adicionar(self, fingerprints, estados):
+        with self._sincronizado():
+            self._registrar(fingerprints, estados)
+    
+    def _registrar(self, fingerprints, estados):
+        self._aplicar(fingerprints, estados)
+        if len(self.buffer) > self.LIMITE_BUFFER:
+            self._compactar()
+    
+    def _aplicar(self, fingerprints, estados):
+        # A base nunca é alterada no lugar (pode ser um memmap somente leitura): inclusões e novos estados vão para o buffer
+        fingerprints, estados = _mesclar_indice(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64), fingerprints, estados)
+        posicoes_buffer, no_buffer = _localizar_em(self.buffer, fingerprints)
+        self.buffer_estados[posicoes_buffer[no_buffer]] = estados[no_buffer]
+        
+        inseridas = ~no_buffer
+        if inseridas.any():
+            self.sobrepostas += int(_localizar_em(self.base, fingerprints[inseridas])[1].sum())
+            self.buffer, self.buffer_estados = _mesclar_indice(
+                self.buffer, self.buffer_estados, fingerprints[inseridas], estados[inseridas]
+            )
+    
+    def _remover(self, fingerprints):
+        antes = len(self)
+        manter_base = ~_localizar_em(fingerprints, self.base)[1]
+        manter_buffer = ~_localizar_em(fingerprints, self.buffer)[1]
+        self.base, self.base_estados = self.base[manter_base], self.base_estados[manter_base]
+        self.buffer, self.buffer_estados = self.buffer[manter_buffer], self.buffer_estados[manter_buffer]
+        self.sobrepostas = int(_localizar_em(self.base, self.buffer)[1].sum())
+        return antes - len(self)
+    
+    def _compactar(self):
+        self.base, self.base_estados = _mesclar_indice(self.base, self.base_estados, self.buffer, self.buffer_estados)
+        self.buffer = np.empty(0, dtype=np.uint64)
+        self.buffer_estados = np.empty(0, dtype=np.uint64)
+        self.sobrepostas = 0
+    
+    def estatisticas(self):
+        """Tamanho e consumo de memória do índice"""
+        with self.lock:
+            total = len(self.base) + len(self.buffer) - self.sobrepostas
+            memoria = self.base.nbytes + self.buffer.nbytes + self.base_estados.nbytes + self.buffer_estados.nbytes
+        return {
+            'awbs': total,
+            'memoria_bytes': memoria,
+            'bytes_por_awb': round(memoria / total, 2) if total else 0
+        }
+
+def _mesclar_indice(chaves, estados, novas_chaves, novos_estados):
+    """Une dois pares (fingerprints, estados) mantendo a ordem; em chaves repetidas vale o último estado"""
+    chaves = np.concatenate([chaves, novas_chaves])
+    estados = np.concatenate([estados, novos_estados])
+    if not len(chaves):
+        return chaves, estados
+    ordem = np.argsort(chaves, kind='stable')
+    chaves, estados = chaves[ordem], estados[ordem]
+    ultimas = np.append(chaves[1:] != chaves[:-1], True)
+    return chaves[ultimas], estados[ultimas]
+
+@contextmanager
+def _trava_arquivo(caminho, exclusiva):
+    """flock entre processos (compartilhado para leitura, exclusivo para escrita)"""
+    with open(caminho, 'a+') as arquivo:
+        if fcntl:
+            fcntl.flock(arquivo, fcntl.LOCK_EX if exclusiva else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(arquivo, fcntl.LOCK_UN)
+
+class IndiceAWBPersistente(IndiceAWB):
+    """IndiceAWB gravado em disco e compartilhado pelos processos do mesmo servidor.
+    
+    A base (fingerprints e estados ordenados) de cada geração é aberta via memmap, com as páginas
+    compartilhadas entre os workers. As inclusões vão para um log append-only de pares
+    (fingerprint, estado), que os demais workers aplicam ao próprio buffer em `recarregar` e antes de
+    cada classificação. Quando o log passa de LIMITE_LOG registros, base + log são regravados numa nova geração.
+    """
+    
+    # O log vira o buffer privado de cada worker (fora das páginas compartilhadas) e cada inclusão refaz esse buffer
+    # ordenado: o limite acompanha o do buffer do IndiceAWB em memória
+    LIMITE_LOG = IndiceAWB.LIMITE_BUFFER
+    TAMANHO_REGISTRO = 16  # fingerprint + estado, uint64 cada
+    
+    def __init__(self, diretorio):
+        super().__init__()
+        self.diretorio = diretorio
+        self.geracao = None
+        self.posicao_log = 0
+        self.meta = {}
+        os.makedirs(diretorio, exist_ok=True)
+        self.caminho_trava = os.path.join(diretorio, 'indice.lock')
+        self.recarregar()
+    
+    def _caminho(self, nome, geracao=None):
+        return os.path.join(self.diretorio, nome if geracao is None else f'{nome}_{geracao}')
+    
+    def _ler_meta(self):
+        try:
+            with open(self._caminho('meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def _gravar_meta(self, meta):
+        temporario = self._caminho(f'meta.json.{uuid.uuid4().hex[:8]}.tmp')
+        with open(temporario, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temporario, self._caminho('meta.json'))
+        self.meta = meta
+    
+    @property
+    def watermark(self):
+        return self.meta.get('watermark')
+    
+    def recarregar(self):
+        """Aplica a geração e as entradas do log gravadas em disco por outros processos"""
+        with self.lock:
+            with _trava_arquivo(self.caminho_trava, exclusiva=True):
+                self._recarregar_travado()
+    
+    @contextmanager
+    def _sincronizado(self):
+        # A classificação compara com o que os outros workers já registraram e grava sob o mesmo flock:
+        # dois workers não classificam a mesma AWB como inédita
+        with _trava_arquivo(self.caminho_trava, exclusiva=True):
+            self._recarregar_travado()
+            yield
+    
+    def _recarregar_travado(self):
+        meta = self._ler_meta()
+        if meta is None:
+            # Primeiro uso do diretório: geração vazia
+            self._gravar_geracao(None)
+            return
+        
+        if meta['geracao'] != self.geracao:
+            self.base = np.load(self._caminho('base', meta['geracao']) + '.npy', mmap_mode='r')
+            self.base_estados = np.load(self._caminho('estados', meta['geracao']) + '.npy', mmap_mode='r')
+            self.buffer = np.empty(0, dtype=np.uint64)
+            self.buffer_estados = np.empty(0, dtype=np.uint64)
+            self.sobrepostas = 0
+            self.geracao = meta['geracao']
+            self.posicao_log = 0
+        self.meta = meta
+        
+        caminho_log = self._caminho('log', self.geracao)
+        tamanho = os.path.getsize(caminho_log) if os.path.exists(caminho_log) else 0
+        tamanho -= tamanho % self.TAMANHO_REGISTRO  # Ignora registro parcial
+        if tamanho > self.posicao_log:
+            with open(caminho_log, 'rb') as f:
+                f.seek(self.posicao_log)
+                registros = np.frombuffer(f.read(tamanho - self.posicao_log), dtype=np.uint64).reshape(-1, 2)
+            self._aplicar(registros[:, 0].copy(), registros[:, 1].copy())
+            self.posicao_log = tamanho
+    
+    def _registrar(self, fingerprints, estados):
+        # Chamado dentro de _sincronizado
+        if not len(fingerprints):
+            return
+        self._aplicar(fingerprints, estados)
+        
+        registros = np.column_stack([fingerprints, estados]).astype(np.uint64)
+        with open(self._caminho('log', self.geracao), 'ab') as f:
+            f.write(registros.tobytes())
+        self.posicao_log += registros.nbytes
+        
+        if self.posicao_log // self.TAMANHO_REGISTRO > self.LIMITE_LOG:
+            self._gravar_geracao(self.meta.get('watermark'))
+    
+    def _remover(self, fingerprints):
+        # O log só registra inclusões: a remoção grava uma nova geração, que os demais workers carregam em recarregar
+        with self._sincronizado():
+            removidas = super()._remover(fingerprints)
+            if removidas:
+                self._gravar_geracao(self.meta.get('watermark'))
+            return removidas
+    
+    def _gravar_geracao(self, watermark, ultima_reconstrucao=None):
+        """Grava base + estados atuais como uma nova geração (com log vazio) e passa a usá-la via memmap"""
+        self._compactar()
+        geracao_anterior = self.geracao
+        geracao = (geracao_anterior or 0) + 1
+        np.save(self._caminho('base', geracao) + '.npy', np.asarray(self.base, dtype=np.uint64))
+        np.save(self._caminho('estados', geracao) + '.npy', np.asarray(self.base_estados, dtype=np.uint64))
+        open(self._caminho('log', geracao), 'wb').close()
+        self._gravar_meta({
+            'geracao': geracao,
+            'watermark': watermark,
+            'awbs': len(self.base),
+            'ultima_reconstrucao': ultima_reconstrucao or self.meta.get('ultima_reconstrucao'),
+            'gravado_em': time.time()
+        })
+        
+        self.base = np.load(self._caminho('base', geracao) + '.npy', mmap_mode='r')
+        self.base_estados = np.load(self._caminho('estados', geracao) + '.npy', mmap_mode='r')
+        self.geracao = geracao
+        self.posicao_log = 0
+        
+        # Processos que ainda mapeiam a geração anterior continuam lendo até recarregar (unlink não invalida o memmap)
+        if geracao_anterior is not None:
+            for nome in ('base', 'estados'):
+                try:
+                    os.remove(self._caminho(nome, geracao_anterior) + '.npy')
+                except OSError:
+                    pass
+            try:
+                os.remove(self._caminho('log', geracao_anterior))
+            except OSError:
+                pass
+    
+    def substituir(self, indice, watermark, ultima_reconstrucao):
+        """Troca todo o conteúdo pelo de um índice reconstruído do banco, gravando uma nova geração"""
+        with self.lock:
+            with _trava_arquivo(self.caminho_trava, exclusiva=True):
+                self._recarregar_travado()
+                with indice.lock:
+                    indice._compactar()
+                    self.base, self.base_estados = indice.base, indice.base_estados
+                self.buffer = np.empty(0, dtype=np.uint64)
+                self.buffer_estados = np.empty(0, dtype=np.uint64)
+                self.sobrepostas = 0
+                self._gravar_geracao(watermark, ultima_reconstrucao)
+    
+    def salvar_watermark(self, watermark):
+        """Registra no disco até qual id de awbs o índice está sincronizado"""
+        with self.lock:
+            with _trava_arquivo(self.caminho_trava, exclusiva=True):
+                meta = self._ler_meta() or {}
+                if meta.get('geracao') == self.geracao and (meta.get('watermark') or 0) < watermark:
+                    self._gravar_meta({**meta, 'watermark': watermark})
+    
+    def estatisticas(self):
+        estatisticas = super().estatisticas()
+        estatisticas.update({
+            'persistente': True,
+            'geracao': self.geracao,
+            'registros_log': self.posicao_log // self.TAMANHO_REGISTRO
+        })
+        return estatisticas
+
+def criar_indice_awbs():
+    """Índice em disco compartilhado entre workers (se habilitado), ou só em memória"""
+    if INDICE_AWBS_PERSISTENTE and not PROCESSO_AUXILIAR:
+        try:
+            indice = IndiceAWBPersistente(INDICE_AWBS_DIR)
+            print(f"✅ Índice de AWBs aberto do disco: {len(indice)} AWBs (geração {indice.geracao}, watermark {indice.watermark})")
+            return indice
+        except Exception as e:
+            print(f"⚠️ Índice de AWBs em disco indisponível, usando só memória: {e}")
+    return IndiceAWB()
+
+# Cache global das AWBs existentes (índice compacto de fingerprints)
+cache_awbs_existentes = criar_indice_awbs()
+if isinstance(cache_awbs_existentes, IndiceAWBPersistente):
+    cache_awbs_sync['watermark'] = cache_awbs_existentes.watermark  # Boot sem varrer a tabela awbs
+
+class DedupArquivo:
+    """AWBs já vistas em um upload, para descartar repetições dentro do próprio arquivo.
+    
+    Os fingerprints de cada chunk entram como um run ordenado em memória; runs de tamanho parecido
+    são fundidos (como um contador binário), então há O(log n) runs e cada fingerprint é reordenado
+    O(log n) vezes, em vez de o conjunto inteiro ser refeito a cada chunk. Acima de
+    DEDUP_ARQUIVO_LIMITE_MEMORIA os runs em memória são fundidos e gravados em disco (lidos via memmap).
+    Não é thread-safe: é usado só pela etapa de dedup, que processa os chunks em ordem.
+    """
+    
+    def __init__(self, limite_memoria=None):
+        self.limite_memoria = limite_memoria or DEDUP_ARQUIVO_LIMITE_MEMORIA
+        self.memoria = []
+        self.em_memoria = 0
+        self.runs = []
+        self.diretorio = None
+        self.total = 0
+    
+    def registrar(self, awbs):
+        """Máscara das AWBs vistas pela primeira vez no arquivo (1ª ocorrência), que passam a constar no conjunto"""
+        fingerprints = fingerprint_awbs(awbs)
+        primeiras = np.zeros(len(fingerprints), dtype=bool)
+        unicos, indices = np.unique(fingerprints, return_index=True)
+        
+        # Busca com as chaves ordenadas (acessos aos runs em ordem crescente, amigáveis ao cache)
+        vistas = np.zeros(len(unicos), dtype=bool)
+        for run in self.memoria + self.runs:
+            vistas |= _localizar_em(run, unicos)[1]
+        primeiras[indices[~vistas]] = True
+        
+        novas = unicos[~vistas]
+        if len(novas):
+            self._adicionar_run(novas)
+        self.total += len(novas)
+        if self.em_memoria >= self.limite_memoria:
+            self._despejar()
+        return primeiras
+    
+    def _adicionar_run(self, ordenado):
+        self.memoria.append(ordenado)
+        self.em_memoria += len(ordenado)
+        # Funde o run novo com o anterior enquanto o anterior não for maior que ele
+        while len(self.memoria) > 1 and len(self.memoria[-2]) <= len(self.memoria[-1]):
+            ultimo = self.memoria.pop()
+            # Timsort (kind='stable') reconhece os dois trechos já ordenados e só os intercala
+            self.memoria[-1] = np.sort(np.concatenate([self.memoria[-1], ultimo]), kind='stable')
+    
+    def _despejar(self):
+        if self.diretorio is None:
+            self.diretorio = tempfile.mkdtemp(prefix='dedup_arquivo_')
+        caminho = os.path.join(self.diretorio, f'run_{len(self.runs)}.npy')
+        np.save(caminho, np.sort(np.concatenate(self.memoria), kind='stable'))
+        self.runs.append(np.load(caminho, mmap_mode='r'))
+        self.memoria = []
+        self.em_memoria = 0
+    
+    def fechar(self):
+        """Libera a memória e apaga os runs gravados em disco"""
+        self.memoria = []
+        self.em_memoria = 0
+        self.runs = []
+        if self.diretorio:
+            shutil.rmtree(self.diretorio, ignore_errors=True)
+            self.diretorio = None
+    
+    def estatisticas(self):
+        return {
+            'awbs_distintas': self.total,
+            'runs_em_disco': len(self.runs),
+            'runs_em_memoria': len(self.memoria),
+            'memoria_bytes': self.em_memoria * 8
+        }
+
+def limpar_registros_expirados():
+    """Remove progresso e jobs concluídos há mais de PROGRESSO_TTL segundos"""
+    limite = time.time() - PROGRESSO_TTL
+    with progresso_uploads_lock:
+        expirados = [job_id for job_id, progresso in progresso_uploads.items()
+                     if progresso.finished_time and progresso.finished_time < limite]
+        for job_id in expirados:
+            del progresso_uploads[job_id]
+    
+    with upload_jobs_lock:
+        for job_id in [job_id for job_id, job in upload_jobs.items()
+                       if job.get('finished_ts') and job['finished_ts'] < limite]:
+            del upload_jobs[job_id]
+
+def iniciar_progresso(job_id):
+    """Cria o registro de progresso de um job"""
+    limpar_registros_expirados()
+    progresso = ProgressoUpload(job_id)
+    with progresso_uploads_lock:
+        progresso_uploads[job_id] = progresso
+    return progresso
+
+def obter_progresso(job_id=None):
+    """Progresso de um job; sem ID, o do job mais recente"""
+    with progresso_uploads_lock:
+        if job_id:
+            return progresso_uploads.get(job_id)
+        if not progresso_uploads:
+            return None
+        return max(progresso_uploads.values(), key=lambda progresso: progresso.start_time)
+
+def uploads_ativos():
+    """Quantidade de jobs com processamento em andamento"""
+    with progresso_uploads_lock:
+        return sum(1 for progresso in progresso_uploads.values() if progresso.active)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def validar_pacote_zip(pacote):
+    """Motivo para recusar o .zip inteiro (None se estiver dentro dos limites): quantidade de membros, tamanho
+    descomprimido total, razão de compressão, membros criptografados e nomes absolutos ou com '..'.
+    
+    Os tamanhos vêm do diretório central (ZipInfo.file_size); a extração não passa do tamanho declarado.
+    """
+    membros = pacote.infolist()
+    if len(membros) > ZIP_MAX_MEMBROS:
+        return f'Arquivo zip com {len(membros)} membros (limite {ZIP_MAX_MEMBROS})'
+    total = sum(membro.file_size for membro in membros)
+    if total > ZIP_MAX_BYTES:
+        return f'Arquivo zip com {total} bytes descomprimidos (limite {ZIP_MAX_BYTES})'
+    for membro in membros:
+        nome = membro.filename.replace('\\', '/')
+        if nome.startswith('/') or '..' in nome.split('/') or ':' in nome or '\x00' in nome:
+            return f'Nome de membro inválido no zip: {membro.filename!r}'
+        if membro.flag_bits & 0x1:
+            return f'Membro criptografado no zip: {membro.filename}'
+        if membro.file_size > ZIP_MAX_RAZAO * max(membro.compress_size, 1):
+            return f'Razão de compressão suspeita no membro {membro.filename} do zip'
+    return None
+
 def detectar_encoding(file_path):
     """Detecta o encoding do arquivo"""
     try:
         with open(file_path, 'rb') as f:
-            raw_data = f.read(10000)
-            result = chardet.detect(raw_data)
-            encoding = result['encoding']
-            
-        # Fallbacks para encodings brasileiros
-        encodings_to_try = [encoding, 'iso-8859-1', 'windows-1252', 'latin-1', 'utf-8']
-        
-        for enc in encodings_to_try:
-            if enc:
-                try:
-                    with open(file_path, 'r', encoding=enc) as f:
-                        f.read(1000)
-                    return enc
-                except:
-                    continue
-        
-        return 'utf-8'
+            return detectar_encoding_amostra(f.read(10000))
     except:
         return 'utf-8'
 
+def detectar_encoding_amostra(amostra):
+    """Detecta o encoding a partir dos primeiros bytes do arquivo (BOM, chardet e fallbacks)"""
+    for bom, enc in BOMS_ENCODING:
+        if amostra.startswith(bom):
+            return enc
+    
+    encoding = chardet.detect(amostra)['encoding']
+    
+    # Fallbacks para encodings brasileiros; a amostra é cortada na última quebra de linha
+    # para não partir um caractere multibyte
+    if b'\n' in amostra:
+        amostra = amostra[:amostra.rindex(b'\n') + 1]
+    encodings_to_try = [encoding, 'iso-8859-1', 'windows-1252', 'latin-1', 'utf-8']
+    
+    for enc in encodings_to_try:
+        if enc:
+            try:
+                amostra.decode(enc)
+                return enc
+            except:
+                continue
+    
+    return 'utf-8'
+
 def detectar_delimitador_csv(file_path, encoding):
     """Detecta o delimitador do CSV"""
     try:
         with open(file_path, 'r', encoding=encoding) as f:
-            primeira_linha = f.readline()
-            
-        delimitadores = {
-            ';': primeira_linha.count(';'),
-            ',': primeira_linha.count(','),
-            '\t': primeira_linha.count('\t'),
-            '|': primeira_linha.count('|')
-        }
-        
-        delimitador = max(delimitadores, key=delimitadores.get)
-        return delimitador if delimitadores[delimitador] > 0 else ','
+            return detectar_delimitador_linha(f.readline())
     except:
         return ';'
 
-def carregar_awbs_existentes_pro():
-    """Carrega AWBs existentes de forma otimizada para Pro tier"""
-    global cache_awbs_existentes
+def detectar_delimitador_linha(primeira_linha):
+    """Escolhe o delimitador mais frequente na linha de cabeçalho"""
+    delimitadores = {
+        ';': primeira_linha.count(';'),
+        ',': primeira_linha.count(','),
+        '\t': primeira_linha.count('\t'),
+        '|': primeira_linha.count('|')
+    }
     
-    if not supabase:
-        return set()
+    delimitador = max(delimitadores, key=delimitadores.get)
+    return delimitador if delimitadores[delimitador] > 0 else ','
+
+def contar_linhas_csv(file_path):
+    """Conta as linhas de dados do CSV lendo em blocos binários (memória constante)"""
+    total = 0
+    ultimo_byte = b'\n'
+    with open(file_path, 'rb') as f:
+        while True:
+            bloco = f.read(INTAKE_BLOCO_BYTES)
+            if not bloco:
+                break
+            total += bloco.count(b'\n')
+            ultimo_byte = bloco[-1:]
+
+    if ultimo_byte != b'\n':
+        total += 1  # Última linha sem quebra de linha
+    return max(total - 1, 0)  # Desconta o cabeçalho
+
+def receber_upload(stream, file_path, nome_arquivo, gravar=True):
+    """Grava o upload em disco numa única passada, calculando hash, encoding, delimitador e linhas.
     
-    try:
-        # Pro tier permite consultas maiores - carregar em lotes
-        awbs_set = set()
-        page_size = 1000
-        page = 0
-        
+    Retorna o descritor do upload, reaproveitado pelas etapas seguintes sem reabrir o arquivo.
+    Com gravar=False o stream é o próprio arquivo em file_path: só o descritor é calculado, sem cópia.
+    """
+    formato = nome_arquivo.rsplit('.', 1)[-1].lower() if '.' in nome_arquivo else ''
+    sha256 = hashlib.sha256()
+    amostra = bytearray()
+    tamanho = 0
+    
+    # CSV: as linhas são contadas no texto decodificado (em UTF-16, por exemplo, um byte 0x0A nem sempre é
+    # quebra de linha); os blocos lidos antes de a amostra bastar para detectar o encoding esperam em pendentes
+    encoding = None
+    decodificador = None
+    pendentes = []
+    quebras = 0
+    ultimo_caractere = ''
+    
+    def contar(texto):
+        nonlocal quebras, ultimo_caractere
+        if texto:
+            quebras += texto.count('\n')
+            ultimo_caractere = texto[-1]
+    
+    with open(file_path, 'wb') if gravar else nullcontext() as destino:
         while True:
-            start = page * page_size
-            end = start + page_size - 1
-            
-            response = supabase.table('awbs').select('awb').range(start, end).execute()
-            
-            if not response.data:
+            bloco = stream.read(INTAKE_BLOCO_BYTES)
+            if not bloco:
                 break
-                
-            for item in response.data:
-                awbs_set.add(item['awb'])
+            if gravar:
+                destino.write(bloco)
+            sha256.update(bloco)
+            tamanho += len(bloco)
+            if len(amostra) < INTAKE_AMOSTRA_BYTES:
+                amostra += bloco[:INTAKE_AMOSTRA_BYTES - len(amostra)]
             
-            if len(response.data) < page_size:
-                break
-                
-            page += 1
+            if formato == 'csv':
+                if decodificador is None:
+                    pendentes.append(bloco)
+                    if len(amostra) < INTAKE_AMOSTRA_BYTES:
+                        continue
+                    encoding = detectar_encoding_amostra(bytes(amostra[:10000]))
+                    decodificador = codecs.getincrementaldecoder(encoding)('replace')
+                for pendente in pendentes or [bloco]:
+                    contar(decodificador.decode(pendente))
+                pendentes = []
+    
+    descritor = {
+        'arquivo': nome_arquivo,
+        'formato': formato,
+        'tamanho_bytes': tamanho,
+        'sha256': sha256.hexdigest(),
+        'encoding': None,
+        'delimitador': None,
+        'total_linhas': None
+    }
+    
+    if formato == 'csv':
+        amostra = bytes(amostra)
+        if decodificador is None:
+            # Arquivo menor que a amostra
+            encoding = detectar_encoding_amostra(amostra[:10000])
+            decodificador = codecs.getincrementaldecoder(encoding)('replace')
+            for pendente in pendentes:
+                contar(decodificador.decode(pendente))
+        contar(decodificador.decode(b'', final=True))
+        try:
+            primeira_linha = amostra.decode(encoding, errors='ignore').lstrip('\ufeff').split('\n', 1)[0]
+            delimitador = detectar_delimitador_linha(primeira_linha)
+        except:
+            delimitador = ';'
         
-        cache_awbs_existentes = awbs_set
-        print(f"✅ Cache AWBs PRO: {len(cache_awbs_existentes)} AWBs existentes carregadas")
-        return cache_awbs_existentes
+        if ultimo_caractere and ultimo_caractere != '\n':
+            quebras += 1  # Última linha sem quebra de linha
+        descritor.update({
+            'encoding': encoding,
+            'delimitador': delimitador,
+            'total_linhas': max(quebras - 1, 0)  # Desconta o cabeçalho
+        })
+    elif formato in ('xlsx', 'xls'):
+        try:
+            descritor['total_linhas'] = contar_linhas_planilha(file_path)
+        except Exception as e:
+            print(f"⚠️ Não foi possível contar as linhas da planilha {nome_arquivo}: {e}")
+    
+    return descritor
+
+def descrever_arquivo_local(file_path):
+    """Descritor (hash, formato, encoding, delimitador, linhas) de um arquivo já em disco, lido uma vez"""
+    with open(file_path, 'rb') as arquivo:
+        return receber_upload(arquivo, file_path, os.path.basename(file_path), gravar=False)
+
+def ler_cabecalho_csv(file_path, encoding, delimitador):
+    """Retorna as colunas do cabeçalho do CSV"""
+    return list(pd.read_csv(file_path, encoding=encoding, delimiter=delimitador, nrows=0).columns)
+
+def ler_csv_em_chunks(file_path, encoding, delimitador, chunk_size=CHUNK_SIZE, engine=None, colunas_desejadas=None):
+    """Lê o CSV sob demanda em chunks de tamanho fixo, apenas com as colunas do pipeline (ou as pedidas)"""
+    engine = engine or CSV_ENGINE
+    colunas_desejadas = colunas_desejadas or COLUNAS_PIPELINE
+    colunas = [c for c in ler_cabecalho_csv(file_path, encoding, delimitador) if c in colunas_desejadas]
+
+    if engine == 'pyarrow' and PYARROW_AVAILABLE:
+        yield from _ler_csv_em_chunks_pyarrow(file_path, encoding, delimitador, colunas, chunk_size)
+        return
+
+    leitor = pd.read_csv(
+        file_path,
+        encoding=encoding,
+        delimiter=delimitador,
+        usecols=colunas,
+        dtype={c: DTYPES_PIPELINE.get(c, str) for c in colunas},
+        chunksize=chunk_size
+    )
+    with leitor:
+        for chunk in leitor:
+            yield chunk
+
+def _ler_csv_em_chunks_pyarrow(file_path, encoding, delimitador, colunas, chunk_size):
+    """Leitor em streaming com pyarrow, reagrupando os blocos em chunks de tamanho fixo"""
+    leitor = pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(encoding=encoding, block_size=4 * 1024 * 1024),
+        parse_options=pa_csv.ParseOptions(delimiter=delimitador),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=colunas,
+            column_types={c: pa.string() for c in colunas}
+        )
+    )
+
+    pendentes = []
+    linhas_pendentes = 0
+    for batch in leitor:
+        pendentes.append(batch)
+        linhas_pendentes += batch.num_rows
+
+        while linhas_pendentes >= chunk_size:
+            tabela = pa.Table.from_batches(pendentes, schema=leitor.schema)
+            yield tabela.slice(0, chunk_size).to_pandas()
+
+            resto = tabela.slice(chunk_size)
+            pendentes = resto.to_batches()
+            linhas_pendentes = resto.num_rows
+
+    if linhas_pendentes:
+        yield pa.Table.from_batches(pendentes, schema=leitor.schema).to_pandas()
+
+class _AlvoAbaXlsx:
+    """Alvo do parser expat da aba: guarda só os textos das células pedidas, uma linha por vez.
+    
+    Sem ElementTree nem fila de eventos: o expat chama start/data/end direto e nenhum elemento é montado.
+    """
+    
+    def __init__(self, leitor):
+        ns = leitor.ns
+        self.leitor = leitor
+        self.tag_linha, self.tag_celula, self.tag_valor = f'{ns}row', f'{ns}c', f'{ns}v'
+        self.tag_texto, self.tag_fonetica = f'{ns}t', f'{ns}rPh'
+        self.prontas = []
+        self.total_linhas = 0
+        self.valores = {}
+        self.posicao = 0
+        self.celula = None  # (tipo, estilo) da célula em leitura; None quando a coluna não foi pedida
+        self.partes = None
+        self.coletando = False
+        self.fonetica = False
+        self.indices_referencia = {}
+    
+    def start(self, tag, atributos):
+        if tag == self.tag_celula:
+            referencia = atributos.get('r')
+            if referencia:
+                letras = referencia.rstrip('0123456789')
+                posicao = self.indices_referencia.get(letras)
+                if posicao is None:
+                    posicao = self.indices_referencia[letras] = column_index_from_string(letras) - 1
+                self.posicao = posicao
+            colunas = self.leitor.colunas
+            if colunas is None or self.posicao in colunas:
+                self.celula = (atributos.get('t', 'n'), atributos.get('s'))
+                self.partes = []
+        elif self.celula is not None:
+            if tag == self.tag_valor or (tag == self.tag_texto and not self.fonetica):
+                self.coletando = True
+            elif tag == self.tag_fonetica:
+                self.fonetica = True
+    
+    def data(self, texto):
+        if self.coletando:
+            self.partes.append(texto)
+    
+    def end(self, tag):
+        if tag == self.tag_valor or tag == self.tag_texto:
+            self.coletando = False
+        elif tag == self.tag_celula:
+            if self.celula is not None:
+                texto = self.leitor._converter(self.celula, ''.join(self.partes)) if self.partes else None
+                if texto is not None:
+                    self.valores[self.posicao] = texto
+                self.celula = None
+                self.fonetica = False
+            self.posicao += 1
+        elif tag == self.tag_linha:
+            self.total_linhas += 1
+            if self.valores:
+                self.prontas.append(self.valores)
+                self.valores = {}
+            self.posicao = 0
+        elif tag == self.tag_fonetica:
+            self.fonetica = False
+    
+    def close(self):
+        return None
+
+class _AlvoStringsXlsx:
+    """Alvo do parser expat de sharedStrings.xml: o texto de cada <si>, sem a transcrição fonética (<rPh>)"""
+    
+    def __init__(self, ns):
+        self.tag_string, self.tag_texto, self.tag_fonetica = f'{ns}si', f'{ns}t', f'{ns}rPh'
+        self.strings = []
+        self.partes = []
+        self.coletando = False
+        self.fonetica = False
+    
+    def start(self, tag, atributos):
+        if tag == self.tag_texto and not self.fonetica:
+            self.coletando = True
+        elif tag == self.tag_fonetica:
+            self.fonetica = True
+    
+    def data(self, texto):
+        if self.coletando:
+            self.partes.append(texto)
+    
+    def end(self, tag):
+        if tag == self.tag_texto:
+            self.coletando = False
+        elif tag == self.tag_fonetica:
+            self.fonetica = False
+        elif tag == self.tag_string:
+            self.strings.append(''.join(self.partes))
+            self.partes = []
+    
+    def close(self):
+        return None
+
+class LeitorXlsx:
+    """Leitura em streaming da primeira aba de um xlsx direto do XML (zip + expat).
+    
+    O openpyxl, mesmo em read-only, monta objetos por célula e por string compartilhada; aqui o XML é
+    descompactado em blocos e cada linha vira só os textos das colunas pedidas. A memória fica no bloco
+    corrente mais a tabela de strings compartilhadas do arquivo.
+    """
+    
+    FORMATOS_DATA = set(range(14, 23)) | {45, 46, 47}  # numFmtId embutidos de data/hora
+    
+    def __init__(self, file_path):
+        self.zip = zipfile.ZipFile(file_path)
+        self.colunas = None  # Índices lidos em linhas() (None = todas)
+        self.datas = {}
+        try:
+            raiz = ET.fromstring(self.zip.read('xl/workbook.xml'))
+            self.ns = raiz.tag[:-len('workbook')]
+            self.caminho_aba = self._caminho_primeira_aba(raiz)
+            propriedades = raiz.find(f'{self.ns}workbookPr')
+            self.calendario = CALENDAR_MAC_1904 if propriedades is not None and propriedades.get('date1904') in ('1', 'true') else CALENDAR_WINDOWS_1900
+            self.estilos_data = self._estilos_data()
+            self.strings = self._strings_compartilhadas()
+        except Exception:
+            self.zip.close()
+            raise
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.zip.close()
+    
+    def _caminho_primeira_aba(self, raiz):
+        aba = raiz.find(f'{self.ns}sheets/{self.ns}sheet')
+        rid = next(valor for chave, valor in aba.attrib.items() if chave.endswith('}id'))
+        for relacao in ET.fromstring(self.zip.read('xl/_rels/workbook.xml.rels')):
+            if relacao.get('Id') == rid:
+                alvo = relacao.get('Target')
+                return alvo.lstrip('/') if alvo.startswith('/') else posixpath.normpath(posixpath.join('xl', alvo))
+        raise ValueError('Primeira aba não encontrada no xlsx')
+    
+    def _estilos_data(self):
+        """Índices de estilo (atributo s da célula) cujo formato numérico é data/hora"""
+        if 'xl/styles.xml' not in self.zip.namelist():
+            return set()
+        raiz = ET.fromstring(self.zip.read('xl/styles.xml'))
+        formatos = {int(f.get('numFmtId')): f.get('formatCode', '') for f in raiz.iter(f'{self.ns}numFmt')}
+        xfs = raiz.find(f'{self.ns}cellXfs')
+        estilos = set()
+        for indice, xf in enumerate(xfs if xfs is not None else []):
+            formato = int(xf.get('numFmtId', 0))
+            if formato in self.FORMATOS_DATA or (formato in formatos and is_date_format(formatos[formato])):
+                estilos.add(str(indice))
+        return estilos
+    
+    def _strings_compartilhadas(self):
+        if 'xl/sharedStrings.xml' not in self.zip.namelist():
+            return []
+        alvo = _AlvoStringsXlsx(self.ns)
+        for _ in self._percorrer('xl/sharedStrings.xml', alvo):
+            pass
+        return alvo.strings
+    
+    def _percorrer(self, caminho, alvo):
+        """Alimenta o parser com o XML descompactado em blocos, devolvendo o controle a cada bloco"""
+        parser = ET.XMLParser(target=alvo)
+        with self.zip.open(caminho) as arquivo:
+            while True:
+                bloco = arquivo.read(INTAKE_BLOCO_BYTES)
+                if not bloco:
+                    break
+                parser.feed(bloco)
+                yield
+        parser.close()
+    
+    def dimensao(self):
+        """Linhas da aba pela tag <dimension> (None se o arquivo não a gravou)"""
+        with self.zip.open(self.caminho_aba) as arquivo:
+            for _, elemento in ET.iterparse(arquivo, events=('start',)):
+                if elemento.tag == f'{self.ns}dimension':
+                    ultima = elemento.get('ref', '').split(':')[-1].lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ$').lstrip('$')
+                    return int(ultima) if ultima.isdigit() else None
+                if elemento.tag == f'{self.ns}sheetData':
+                    return None
+        return None
+    
+    def contar_linhas(self):
+        """Conta as linhas da aba percorrendo o XML, sem decodificar as células"""
+        colunas, self.colunas = self.colunas, set()
+        try:
+            alvo = _AlvoAbaXlsx(self)
+            for _ in self._percorrer(self.caminho_aba, alvo):
+                pass
+            return alvo.total_linhas
+        finally:
+            self.colunas = colunas
+    
+    def linhas(self):
+        """Gera cada linha não vazia da aba como {índice da coluna: texto}, só com as colunas em self.colunas"""
+        alvo = _AlvoAbaXlsx(self)
+        for _ in self._percorrer(self.caminho_aba, alvo):
+            prontas, alvo.prontas = alvo.prontas, []
+            yield from prontas
+        yield from alvo.prontas
+    
+    def _converter(self, celula, valor):
+        """Texto equivalente ao que o CSV exportado da planilha traria"""
+        tipo, estilo = celula
+        if tipo == 's':
+            return self.strings[int(valor)]
+        if tipo == 'n':
+            numero = float(valor)
+            if estilo in self.estilos_data:
+                # Datas de status se repetem muito entre as linhas: a conversão é memorizada por valor bruto
+                texto = self.datas.get(valor)
+                if texto is None:
+                    texto = from_excel(numero, self.calendario).isoformat(sep=' ')
+                    if len(self.datas) < 65536:
+                        self.datas[valor] = texto
+                return texto
+            return str(int(numero)) if numero.is_integer() else valor  # AWBs e IDs numéricos sem ".0"
+        return valor  # inlineStr, str (fórmula), b, e, d (ISO 8601)
+
+def contar_linhas_planilha(file_path):
+    """Linhas de dados da primeira aba, pela dimensão gravada no xlsx (sem percorrer a planilha quando possível)"""
+    if not (OPENPYXL_AVAILABLE and file_path.lower().endswith('.xlsx')):
+        return None
+    with LeitorXlsx(file_path) as leitor:
+        total = leitor.dimensao()
+        if total is None:
+            # Arquivo sem a tag de dimensão (gerado por alguns exportadores): contagem em streaming
+            total = leitor.contar_linhas()
+        return max(total - 1, 0)
+
+def ler_planilha_em_chunks(file_path, chunk_size=CHUNK_SIZE, colunas_desejadas=None):
+    """Lê a primeira aba da planilha em chunks de texto, como ler_csv_em_chunks.
+    
+    xlsx é lido em streaming pelo LeitorXlsx, com memória limitada ao chunk. xls (formato binário
+    antigo) não tem leitura em streaming e é carregado inteiro pelo pandas.
+    """
+    colunas_desejadas = colunas_desejadas or COLUNAS_PIPELINE
+    
+    if not (OPENPYXL_AVAILABLE and file_path.lower().endswith('.xlsx')):
+        df = pd.read_excel(file_path, dtype=str)
+        df = df[[c for c in df.columns if c in colunas_desejadas]]
+        for inicio in range(0, len(df), chunk_size):
+            yield df.iloc[inicio:inicio + chunk_size].reset_index(drop=True)
+        return
+    
+    with LeitorXlsx(file_path) as leitor:
+        linhas = leitor.linhas()
+        cabecalho = next(linhas, None)
+        if cabecalho is None:
+            return
+        posicoes = {texto.strip(): indice for indice, texto in cabecalho.items()}
+        colunas = [c for c in colunas_desejadas if c in posicoes]
+        indices = [posicoes[c] for c in colunas]
+        leitor.colunas = set(indices)
         
+        pendentes = []
+        for valores in linhas:
+            pendentes.append([valores.get(indice) for indice in indices])
+            if len(pendentes) >= chunk_size:
+                yield pd.DataFrame(pendentes, columns=colunas, dtype=object)
+                pendentes = []
+        if pendentes:
+            yield pd.DataFrame(pendentes, columns=colunas, dtype=object)
+
+def fingerprint_linhas(chunk):
+    """Fingerprints de 64 bits de cada linha do chunk, sobre as colunas usadas pelo pipeline"""
+    colunas = [c for c in COLUNAS_PIPELINE if c in chunk.columns]
+    return pd.util.hash_pandas_object(chunk[colunas], index=False).to_numpy(dtype=np.uint64)
+
+def _arquivo_fingerprints_fonte(fonte):
+    return os.path.join(FINGERPRINTS_FOLDER, f"{secure_filename(fonte) or 'padrao'}.npy")
+
+def carregar_fingerprints_fonte(fonte):
+    """Fingerprints ordenados das linhas do último upload da fonte (vazio se não houver)"""
+    try:
+        with fingerprints_fontes_lock:
+            return np.load(_arquivo_fingerprints_fonte(fonte))
+    except FileNotFoundError:
+        return np.empty(0, dtype=np.uint64)
     except Exception as e:
-        print(f"❌ Erro ao carregar AWBs existentes: {e}")
-        return set()
+        print(f"⚠️ Fingerprints da fonte {fonte} ilegíveis, processando arquivo completo: {e}")
+        return np.empty(0, dtype=np.uint64)
+
+def salvar_fingerprints_fonte(fonte, blocos):
+    """Substitui atomicamente os fingerprints da fonte pelos do upload atual"""
+    fingerprints = np.unique(np.concatenate(blocos)) if blocos else np.empty(0, dtype=np.uint64)
+    destino = _arquivo_fingerprints_fonte(fonte)
+    temporario = f"{destino}.{uuid.uuid4().hex[:8]}.tmp"
+    with fingerprints_fontes_lock:
+        with open(temporario, 'wb') as f:
+            np.save(f, fingerprints)
+        os.replace(temporario, destino)
+    return len(fingerprints)
+
+def filtrar_delta_fonte(chunks, anteriores, blocos):
+    """Repassa de cada chunk só as linhas novas ou alteradas em relação ao upload anterior da fonte.
+    
+    Os fingerprints das linhas inalteradas (aceitas no upload anterior) são acumulados em `blocos`; os das
+    linhas repassadas seguem no lote e só entram na base se a linha passar na validação (o pipeline os
+    devolve em fingerprints_aceitos), para que uma linha rejeitada hoje volte a ser lida no próximo upload.
+    """
+    for chunk in chunks:
+        fingerprints = fingerprint_linhas(chunk)
+        inalteradas = _localizar_em(anteriores, fingerprints)[1]
+        blocos.append(fingerprints[inalteradas])
+        yield {
+            'linhas': len(chunk),
+            'dados': chunk[~inalteradas],
+            'fingerprints': fingerprints[~inalteradas],
+            'inalteradas': int(inalteradas.sum())
+        }
+
+def dividir_csv_em_faixas(file_path, tamanho_faixa=None):
+    """Divide o corpo do CSV (sem o cabeçalho) em faixas de bytes alinhadas em quebras de linha"""
+    tamanho_faixa = tamanho_faixa or FAIXA_BYTES
+    tamanho = os.path.getsize(file_path)
+    faixas = []
+    with open(file_path, 'rb') as f:
+        f.readline()  # Cabeçalho
+        inicio = f.tell()
+        while inicio < tamanho:
+            f.seek(min(inicio + tamanho_faixa, tamanho))
+            f.readline()  # Completa a linha corrente
+            fim = min(f.tell(), tamanho)
+            faixas.append((inicio, fim))
+            inicio = fim
+    return faixas
+
+def inicializar_processo_transformacao(motoristas_cache, tarifas_cache):
+    """Initializer do pool de processos: caches de motoristas e tarifas ficam no processo"""
+    global cache_motoristas, cache_tarifas
+    cache_motoristas, cache_tarifas = motoristas_cache, tarifas_cache
+
+def transformar_faixa_em_processo(file_path, inicio, fim, encoding, delimitador, cabecalho):
+    """(Processo auxiliar) Parse + transformação de uma faixa; devolve arrays NumPy compactos por chunk"""
+    with open(file_path, 'rb') as f:
+        f.seek(inicio)
+        dados = f.read(fim - inicio)
+    
+    colunas = [c for c in cabecalho if c in COLUNAS_PIPELINE]
+    leitor = pd.read_csv(
+        io.BytesIO(dados),
+        encoding=encoding,
+        delimiter=delimitador,
+        header=None,
+        names=cabecalho,
+        usecols=colunas,
+        dtype={c: DTYPES_PIPELINE[c] for c in colunas},
+        chunksize=CHUNK_SIZE
+    )
+    
+    resultados = []
+    with leitor:
+        for chunk in leitor:
+            validas, erros_por_motivo = transformar_chunk_pro(chunk, cache_motoristas, cache_tarifas)
+            resultados.append({
+                'linhas': len(chunk),
+                'erros_por_motivo': erros_por_motivo,
+                'awb': validas['awb'].to_numpy(dtype=str),
+                'id_motorista': validas['id_motorista'].to_numpy(dtype='int64'),
+                'tipo_servico': validas['tipo_servico'].to_numpy(dtype='int64'),
+                'data_entrega': validas['data_entrega'].to_numpy(dtype=str),
+                'valor_entrega': validas['valor_entrega'].to_numpy(dtype='float64')
+            })
+    return resultados
+
+def transformar_csv_em_processos(file_path, encoding, delimitador, motoristas_cache, tarifas_cache, workers=None):
+    """Gera lotes já transformados: as faixas do arquivo são processadas em paralelo por processos"""
+    workers = workers or PROCESS_POOL_WORKERS
+    cabecalho = ler_cabecalho_csv(file_path, encoding, delimitador)
+    lookup = preparar_lookup_transform(motoristas_cache, tarifas_cache)
+    
+    def desempacotar(resultados):
+        for resultado in resultados:
+            posicoes, _ = _localizar_em(lookup['ids_motoristas'], resultado['id_motorista'])
+            validas = pd.DataFrame({
+                'awb': resultado['awb'].astype(object),
+                'id_motorista': resultado['id_motorista'],
+                'nome_motorista': lookup['nomes_motoristas'][posicoes],
+                'tipo_servico': resultado['tipo_servico'],
+                'data_entrega': resultado['data_entrega'].astype(object),
+                'valor_entrega': resultado['valor_entrega']
+            })
+            yield {'linhas': resultado['linhas'], 'validas': validas, 'erros_por_motivo': resultado['erros_por_motivo']}
+    
+    # spawn: os processos não herdam threads/locks do servidor (e não abrem conexões na importação)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=inicializar_processo_transformacao,
+        initargs=(motoristas_cache, tarifas_cache)
+    ) as executor:
+        em_voo = deque()
+        for inicio, fim in dividir_csv_em_faixas(file_path):
+            # Faixas em ordem e no máximo 2 por processo em voo (memória limitada)
+            while len(em_voo) >= workers * 2:
+                yield from desempacotar(em_voo.popleft().result())
+            em_voo.append(executor.submit(
+                transformar_faixa_em_processo, file_path, inicio, fim, encoding, delimitador, cabecalho
+            ))
+        
+        while em_voo:
+            yield from desempacotar(em_voo.popleft().result())
+
+def buscar_awbs_desde(ultimo_id, page_size=1000):
+    """Paginação por keyset: páginas de AWBs com id > ultimo_id, em ordem de id"""
+    while True:
+        response = supabase.table('awbs').select('id, awb, tipo_servico, data_entrega').gt('id', ultimo_id).order('id').limit(page_size).execute()
+        
+        if not response.data:
+            break
+        
+        yield response.data
+        ultimo_id = response.data[-1]['id']
+        
+        if len(response.data) < page_size:
+            break
+
+def carregar_awbs_existentes_pro(forcar_reconstrucao=False):
+    """Sincroniza o cache de AWBs: reconstrução completa no cold start, depois só as AWBs novas"""
+    global cache_awbs_existentes
+    
+    if not supabase:
+        return cache_awbs_existentes
+    
+    with cache_awbs_sync_lock:
+        try:
+            agora = time.time()
+            
+            # Índice em disco: aplicar o que outros workers já gravaram e partir do watermark mais avançado
+            persistente = isinstance(cache_awbs_existentes, IndiceAWBPersistente)
+            if persistente:
+                cache_awbs_existentes.recarregar()
+                if cache_awbs_existentes.watermark is not None:
+                    cache_awbs_sync['watermark'] = max(cache_awbs_sync['watermark'] or 0, cache_awbs_existentes.watermark)
+            
+            # Verificação periódica de divergência (ex.: AWBs removidas ou inserts que falharam)
+            if (cache_awbs_sync['watermark'] is not None and not forcar_reconstrucao
+                    and agora - cache_awbs_sync['ultima_verificacao'] > AWBS_VERIFICACAO_INTERVALO
+                    and uploads_ativos() <= 1):
+                cache_awbs_sync['ultima_verificacao'] = agora
+                response = supabase.table('awbs').select('id', count='exact').limit(1).execute()
+                total_banco = response.count or 0
+                if total_banco != len(cache_awbs_existentes):
+                    print(f"⚠️ Cache AWBs divergente ({len(cache_awbs_existentes)} em cache, {total_banco} no banco) - reconstruindo")
+                    forcar_reconstrucao = True
+            
+            reconstruir = forcar_reconstrucao or cache_awbs_sync['watermark'] is None
+            indice = IndiceAWB() if reconstruir else cache_awbs_existentes
+            watermark = 0 if reconstruir else cache_awbs_sync['watermark']
+            novas = 0
+            
+            # Pro tier permite consultas maiores - carregar em lotes (apenas fingerprints ficam em memória)
+            for pagina in buscar_awbs_desde(watermark):
+                estados = fingerprint_estados([item.get('tipo_servico') for item in pagina],
+                                              [item.get('data_entrega') for item in pagina])
+                indice.adicionar([item['awb'] for item in pagina], estados)
+                watermark = pagina[-1]['id']
+                novas += len(pagina)
+            
+            cache_awbs_sync['watermark'] = watermark
+            if reconstruir:
+                if persistente:
+                    cache_awbs_existentes.substituir(indice, watermark, agora)
+                else:
+                    cache_awbs_existentes = indice
+                cache_awbs_sync['ultima_reconstrucao'] = agora
+                cache_awbs_sync['ultima_verificacao'] = agora
+            elif persistente:
+                cache_awbs_existentes.salvar_watermark(watermark)
+            
+            estatisticas = cache_awbs_existentes.estatisticas()
+            print(f"✅ Cache AWBs PRO ({'reconstrução completa' if reconstruir else 'incremental'}): +{novas} AWBs, "
+                  f"{estatisticas['awbs']} no total ({estatisticas['memoria_bytes'] / 1024 / 1024:.1f} MB, "
+                  f"{estatisticas['bytes_por_awb']} bytes/AWB)")
+            return cache_awbs_existentes
+            
+        except Exception as e:
+            print(f"❌ Erro ao carregar AWBs existentes: {e}")
+            return cache_awbs_existentes
 
 def carregar_dados_supabase_pro():
     """Carrega dados do Supabase com cache otimizado para Pro tier"""
@@ -227,260 +1693,2139 @@ def carregar_dados_supabase_pro():
     
     return motoristas, tarifas
 
-def calcular_valor_entrega_pro(tipo_servico, id_motorista, tarifas_cache):
-    """Versão Pro do cálculo de valor com tarifas customizadas"""
+def codigo_erro_banco(e):
+    """SQLSTATE (psycopg2) ou código do PostgREST (supabase-py) de um erro do banco; None se não houver"""
+    codigo = getattr(e, 'pgcode', None) or getattr(e, 'code', None)
+    if codigo is None and e.args and isinstance(e.args[0], dict):
+        codigo = e.args[0].get('code')
+    return str(codigo) if codigo is not None else None
+
+def erro_permanente(e):
+    """Erro que repetir não resolve: dado inválido (SQLSTATE 22), violação de restrição (23), esquema ou permissão
+    (42) e as demais recusas 4xx do PostgREST. Conexão, timeout e indisponibilidade (PGRST0xx) são transitórios"""
+    codigo = codigo_erro_banco(e) or ''
+    if codigo.startswith('PGRST'):
+        return not codigo.startswith('PGRST0')
+    return len(codigo) == 5 and codigo[:2] in ('22', '23', '42')
+
+def verificar_linhagem_uploads():
+    """Confere se o banco tem o esquema da linhagem (awbs.upload_id e awbs_alteracoes, criados por
+    db_linhagem_uploads.py); sem ele desliga a linhagem, em vez de deixar toda escrita falhar e ir para o spool"""
+    global LINHAGEM_UPLOADS
+    if not LINHAGEM_UPLOADS or not (pg_pool or supabase):
+        return LINHAGEM_UPLOADS
+    try:
+        if pg_pool:
+            conn = pg_pool.getconn()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT upload_id FROM awbs LIMIT 0")
+                    cursor.execute(f"SELECT id FROM {ALTERACOES_TABELA} LIMIT 0")
+            finally:
+                conn.rollback()
+                pg_pool.putconn(conn)
+        else:
+            supabase.table('awbs').select('upload_id').limit(0).execute()
+            supabase.table(ALTERACOES_TABELA).select('id').limit(0).execute()
+    except Exception as e:
+        codigo = codigo_erro_banco(e) or ''
+        if not (codigo.startswith('42') or codigo.startswith('PGRST2')):  # Coluna/tabela inexistente
+            print(f"⚠️ Não foi possível verificar o esquema da linhagem dos uploads: {e}")
+            return LINHAGEM_UPLOADS
+        LINHAGEM_UPLOADS = False
+        if 'upload_id' in COLUNAS_AWBS:
+            COLUNAS_AWBS.remove('upload_id')
+        print(f"⚠️ Linhagem de uploads desativada: esquema ausente no banco ({e}). Crie-o com db_linhagem_uploads.py")
+    return LINHAGEM_UPLOADS
+
+def verificar_atualizacao_em_lote():
+    """Confere (com um lote vazio) se a função atualizar_awbs_lote existe no banco; sem ela, as atualizações via REST
+    seguem por UPDATEs agrupados por valores"""
+    global ATUALIZACAO_VIA_RPC
+    if not ATUALIZACAO_VIA_RPC or pg_pool or not supabase:
+        return ATUALIZACAO_VIA_RPC
+    try:
+        supabase.rpc('atualizar_awbs_lote', {'alteracoes': [], 'p_upload_id': None}).execute()
+    except Exception as e:
+        if codigo_erro_banco(e) not in ('PGRST202', '42883'):  # Função inexistente
+            print(f"⚠️ Não foi possível verificar a função atualizar_awbs_lote: {e}")
+            return ATUALIZACAO_VIA_RPC
+        ATUALIZACAO_VIA_RPC = False
+        print("⚠️ Função atualizar_awbs_lote ausente no banco: atualizações via UPDATE por valores. "
+              "Crie-a com db_atualizar_awbs_lote.py")
+    return ATUALIZACAO_VIA_RPC
+
+def inserir_lote_awbs(lote, ignorar_conflitos=True):
+    """Insere um lote na tabela awbs e retorna as AWBs que o banco realmente inseriu"""
+    if ignorar_conflitos:
+        # ON CONFLICT (awb) DO NOTHING: o banco pula as AWBs existentes e devolve só as inseridas
+        response = supabase.table('awbs').upsert(lote, on_conflict='awb', ignore_duplicates=True).execute()
+    else:
+        response = supabase.table('awbs').insert(lote).execute()
+    return [linha['awb'] for linha in response.data or []]
+
+def inserir_chunk_awbs_copy(awbs_novas):
+    """Grava um chunk via COPY em tabela de staging e merge em awbs; retorna as AWBs inseridas"""
+    colunas = ', '.join(COLUNAS_AWBS)
+    conn = pg_pool.getconn()
     try:
-        tipo_servico = int(tipo_servico)
-        id_motorista = int(id_motorista)
+        with conn.cursor() as cursor:
+            # Staging temporária da sessão, com os tipos de awbs e esvaziada a cada commit
+            cursor.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS awbs_staging ON COMMIT DELETE ROWS AS
+                SELECT {colunas} FROM awbs WITH NO DATA;
+            """)
+            
+            buffer = io.StringIO()
+            awbs_novas[COLUNAS_AWBS].to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY awbs_staging ({colunas}) FROM STDIN WITH (FORMAT csv)", buffer)
+            
+            cursor.execute(f"""
+                INSERT INTO awbs ({colunas})
+                SELECT {colunas} FROM awbs_staging
+                ON CONFLICT (awb) DO NOTHING
+                RETURNING awb;
+            """)
+            inseridas = [linha[0] for linha in cursor.fetchall()]
+        conn.commit()
+        return inseridas
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg_pool.putconn(conn)
+
+def filtrar_duplicatas_pro(awbs_lote):
+    """Separa o lote no índice: retorna (novas, duplicatas sem alteração, existentes com tipo/data alterados)"""
+    if awbs_lote is None or awbs_lote.empty:
+        return awbs_lote, 0, awbs_lote
+    
+    estados = fingerprint_estados(awbs_lote['tipo_servico'].to_numpy(), awbs_lote['data_entrega'].to_numpy())
+    novas, alteradas = cache_awbs_existentes.classificar(awbs_lote['awb'].to_numpy(), estados)
+    return awbs_lote[novas], len(awbs_lote) - int(novas.sum()) - int(alteradas.sum()), awbs_lote[alteradas]
+
+def atualizar_chunk_awbs_copy(alteradas, upload_id=None):
+    """Atualiza tipo/data/valor de AWBs existentes via COPY em staging + UPDATE ... FROM; retorna as AWBs alteradas
+    (com upload_id, o estado anterior delas vai para awbs_alteracoes na mesma transação)"""
+    colunas = ', '.join(COLUNAS_AWBS)
+    colunas_update = ', '.join(['awb'] + COLUNAS_AWBS_ATUALIZAVEIS)
+    conn = pg_pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS awbs_staging ON COMMIT DELETE ROWS AS
+                SELECT {colunas} FROM awbs WITH NO DATA;
+            """)
+            
+            buffer = io.StringIO()
+            alteradas[['awb'] + COLUNAS_AWBS_ATUALIZAVEIS].to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY awbs_staging ({colunas_update}) FROM STDIN WITH (FORMAT csv)", buffer)
+            
+            if upload_id:
+                cursor.execute(f"""
+                    INSERT INTO {ALTERACOES_TABELA} (upload_id, awb, tipo_servico, data_entrega, valor_entrega,
+                                                     tipo_servico_novo, data_entrega_nova)
+                    SELECT %s, a.awb, a.tipo_servico, a.data_entrega, a.valor_entrega, s.tipo_servico, s.data_entrega
+                    FROM awbs a JOIN awbs_staging s ON a.awb = s.awb
+                    WHERE a.status IS DISTINCT FROM 'PAGA';
+                """, (upload_id,))
+            
+            # AWBs pagas não mudam de valor depois do pagamento
+            atribuicoes = ', '.join(f"{c} = s.{c}" for c in COLUNAS_AWBS_ATUALIZAVEIS)
+            cursor.execute(f"""
+                UPDATE awbs a SET {atribuicoes}
+                FROM awbs_staging s
+                WHERE a.awb = s.awb AND a.status IS DISTINCT FROM 'PAGA'
+                RETURNING a.awb;
+            """)
+            atualizadas = [linha[0] for linha in cursor.fetchall()]
+        conn.commit()
+        return atualizadas
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg_pool.putconn(conn)
+
+def registros_atualizacao(alteradas):
+    """Linhas (awb + campos atualizáveis) como dicts com tipos nativos para o JSON do REST (NaN vira None)"""
+    registros = alteradas[['awb'] + COLUNAS_AWBS_ATUALIZAVEIS].astype(object)
+    return registros.where(registros.notna(), None).to_dict('records')
+
+def atualizar_lote_awbs(alteradas, upload_id=None):
+    """Grava tipo/data/valor de um lote de AWBs via REST e retorna as AWBs que o banco alterou (pagas ficam como estão).
+    
+    Com a função atualizar_awbs_lote no banco (db_atualizar_awbs_lote.py), o lote inteiro vai numa única chamada
+    RPC, que também guarda a linhagem. Sem ela: um SELECT e um INSERT em awbs_alteracoes por lote (com upload_id)
+    e um UPDATE ... WHERE awb IN (...) por combinação de valores.
+    """
+    registros = registros_atualizacao(alteradas)
+    if ATUALIZACAO_VIA_RPC:
+        response = supabase.rpc('atualizar_awbs_lote', {'alteracoes': registros, 'p_upload_id': upload_id}).execute()
+        return [linha['awb'] for linha in response.data or []]
+    
+    awbs = [registro['awb'] for registro in registros]
+    if upload_id:
+        atuais = supabase.table('awbs').select('awb, tipo_servico, data_entrega, valor_entrega').in_('awb', awbs).neq('status', 'PAGA').execute()
+        if atuais.data:
+            novos = {registro['awb']: registro for registro in registros}
+            supabase.table(ALTERACOES_TABELA).insert([
+                {**atual, 'upload_id': upload_id,
+                 'tipo_servico_novo': novos[atual['awb']]['tipo_servico'],
+                 'data_entrega_nova': novos[atual['awb']]['data_entrega']}
+                for atual in atuais.data
+            ]).execute()
+    
+    atualizadas = []
+    grupos = {}
+    for registro in registros:
+        grupos.setdefault(tuple(registro[c] for c in COLUNAS_AWBS_ATUALIZAVEIS), []).append(registro['awb'])
+    for valores, awbs_grupo in grupos.items():
+        campos = dict(zip(COLUNAS_AWBS_ATUALIZAVEIS, valores))
+        response = supabase.table('awbs').update(campos).in_('awb', awbs_grupo).neq('status', 'PAGA').execute()
+        atualizadas.extend(linha['awb'] for linha in response.data or [])
+    return atualizadas
+
+def atualizar_awbs_pro(alteradas, chunk_id):
+    """Grava as alterações de tipo/data (e o valor recalculado) de AWBs existentes; retorna a máscara das linhas atualizadas"""
+    upload_id = alteradas['upload_id'].iloc[0] if LINHAGEM_UPLOADS and 'upload_id' in alteradas.columns else None
+    if pg_pool:
+        operacoes = [(atualizar_chunk_awbs_copy, (alteradas, upload_id))]
+    else:
+        # REST: lotes do tamanho do controlador (uma chamada RPC por lote, quando a função existe no banco)
+        operacoes = [(atualizar_lote_awbs, (alteradas.iloc[i:i+controlador_escrita.batch_size], upload_id))
+                     for i in range(0, len(alteradas), controlador_escrita.batch_size)]
+    
+    atualizadas = []
+    for funcao, argumentos in operacoes:
+        for tentativa in range(MAX_RETRIES):
+            controlador_escrita.adquirir()
+            inicio = time.time()
+            try:
+                atualizadas.extend(funcao(*argumentos))
+                controlador_escrita.registrar(time.time() - inicio, True)
+                break
+            except Exception as e:
+                controlador_escrita.registrar(time.time() - inicio, False)
+                if tentativa < MAX_RETRIES - 1 and not erro_permanente(e):
+                    time.sleep((tentativa + 1) * 0.1)
+                else:
+                    print(f"❌ Erro ao atualizar AWBs após {tentativa + 1} tentativa(s): {e}")
+                    raise e
+            finally:
+                controlador_escrita.liberar()
+    
+    print(f"🔄 PRO Chunk {chunk_id}: {len(atualizadas)}/{len(alteradas)} AWBs alteradas atualizadas")
+    return alteradas['awb'].isin(atualizadas).to_numpy()
+
+def gravar_awbs_pro(novas, chunk_id):
+    """Grava AWBs novas (COPY direto ou REST em lotes): retorna a máscara das linhas que o banco inseriu
+    (as demais ele já tinha)"""
+    novas = novas.assign(empresa_id=1, status='NAO_PAGA')
+    if LINHAGEM_UPLOADS and 'upload_id' not in novas.columns:
+        novas = novas.assign(upload_id=None)  # Sem origem conhecida (ex.: lote no spool de uma versão anterior)
+    
+    # Postgres direto: o chunk inteiro em um único COPY + merge
+    if pg_pool:
+        for tentativa in range(MAX_RETRIES):
+            controlador_escrita.adquirir()
+            inicio = time.time()
+            try:
+                inseridas = inserir_chunk_awbs_copy(novas)
+                controlador_escrita.registrar(time.time() - inicio, True)
+                print(f"💾 PRO Chunk {chunk_id}: {len(novas)} AWBs via COPY ({len(inseridas)} inseridas)")
+                return novas['awb'].isin(inseridas).to_numpy()
+            except Exception as e:
+                controlador_escrita.registrar(time.time() - inicio, False)
+                if tentativa < MAX_RETRIES - 1 and not erro_permanente(e):
+                    wait_time = (tentativa + 1) * 0.1
+                    print(f"⚠️ PRO COPY tentativa {tentativa + 1} falhou, aguardando {wait_time}s...")
+                    time.sleep(wait_time)
+                else:
+                    print(f"❌ Erro no COPY após {tentativa + 1} tentativa(s): {e}")
+                    raise e
+            finally:
+                controlador_escrita.liberar()
+    
+    # Registros montados só na fronteira do insert
+    awbs_novas = novas[COLUNAS_AWBS].to_dict('records')
+    
+    # Lotes e escritas simultâneas ditados pelo controlador AIMD
+    inseridas = []
+    i = 0
+    while i < len(awbs_novas):
+        lote = awbs_novas[i:i+controlador_escrita.batch_size]
+        ignorar_conflitos = INSERT_IGNORAR_CONFLITOS
+        
+        # Retry com backoff otimizado para Pro tier
+        for tentativa in range(MAX_RETRIES):
+            controlador_escrita.adquirir()
+            inicio = time.time()
+            try:
+                inseridas_lote = inserir_lote_awbs(lote, ignorar_conflitos)
+                controlador_escrita.registrar(time.time() - inicio, True)
+                inseridas.extend(inseridas_lote)
+                print(f"💾 PRO Chunk {chunk_id}: {i+len(lote)}/{len(awbs_novas)} AWBs processadas ({len(inseridas_lote)} inseridas)")
+                break
+            except Exception as e:
+                if "duplicate key" in str(e).lower() and not ignorar_conflitos:
+                    # Uma duplicata não descarta o lote: repetir deixando o banco ignorar só as AWBs em conflito
+                    ignorar_conflitos = True
+                elif tentativa < MAX_RETRIES - 1 and not erro_permanente(e):
+                    controlador_escrita.registrar(time.time() - inicio, False)
+                    wait_time = (tentativa + 1) * 0.1  # Backoff mais rápido para Pro
+                    print(f"⚠️ PRO Tentativa {tentativa + 1} falhou, aguardando {wait_time}s...")
+                    time.sleep(wait_time)
+                else:
+                    controlador_escrita.registrar(time.time() - inicio, False)
+                    print(f"❌ Erro após {tentativa + 1} tentativa(s): {e}")
+                    raise e
+            finally:
+                controlador_escrita.liberar()
         
-        # Buscar tarifa específica do motorista (Pro tier suporta tarifas customizadas)
-        if id_motorista in tarifas_cache:
-            return tarifas_cache[id_motorista].get(tipo_servico, TARIFAS_PADRAO.get(tipo_servico, 0))
+        i += len(lote)
         
-        # Usar tarifa padrão
-        return TARIFAS_PADRAO.get(tipo_servico, 0)
-    except:
-        return 0
+        # Pausa entre batches definida pelo controlador (zero quando o banco está folgado)
+        if i < len(awbs_novas) and controlador_escrita.atraso:
+            time.sleep(controlador_escrita.atraso)
+    
+    return novas['awb'].isin(inseridas).to_numpy()
 
-def salvar_lote_supabase_pro(awbs_lote, chunk_id):
-    """Salva lote de AWBs no Supabase Pro com performance máxima"""
-    if not supabase or not awbs_lote:
-        return 0, 0
+def buscar_estados_awbs(awbs):
+    """Tipo, data e status gravados no banco para as AWBs informadas (DataFrame; ausentes ficam de fora)"""
+    colunas = ['awb', 'tipo_servico', 'data_entrega', 'status']
+    if pg_pool:
+        conn = pg_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT {', '.join(colunas)} FROM awbs WHERE awb = ANY(%s)", (list(awbs),))
+                linhas = cursor.fetchall()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pg_pool.putconn(conn)
+        return pd.DataFrame(linhas, columns=colunas)
     
-    try:
-        # Filtrar duplicatas ANTES de tentar inserir
-        awbs_existentes = cache_awbs_existentes
-        awbs_novas = []
-        duplicatas_descartadas = 0
-        
-        for awb in awbs_lote:
-            if awb['awb'] not in awbs_existentes:
-                awbs_novas.append({
-                    'empresa_id': 1,
-                    'awb': awb['awb'],
-                    'id_motorista': awb['id_motorista'],
-                    'nome_motorista': awb['nome_motorista'],
-                    'tipo_servico': awb['tipo_servico'],
-                    'data_entrega': awb.get('data_entrega', ''),
-                    'valor_entrega': float(awb['valor_entrega']),
-                    'status': 'NAO_PAGA'
-                })
-                # Adicionar ao cache para evitar duplicatas no mesmo upload
-                awbs_existentes.add(awb['awb'])
-            else:
-                duplicatas_descartadas += 1
+    linhas = []
+    for i in range(0, len(awbs), controlador_escrita.batch_size):
+        response = supabase.table('awbs').select(', '.join(colunas)).in_('awb', list(awbs[i:i+controlador_escrita.batch_size])).execute()
+        linhas.extend(response.data or [])
+    return pd.DataFrame(linhas, columns=colunas)
+
+def separar_alteradas_no_banco(conflitantes):
+    """Das linhas que o insert recusou (AWB já no banco), as que trazem tipo/data diferentes do gravado.
+    
+    O índice não as conhecia (cache frio, ou outro worker/upload gravando a mesma AWB): sem esta
+    verificação a alteração seria descartada como duplicata. AWBs pagas não mudam e ficam de fora.
+    """
+    atuais = buscar_estados_awbs(conflitantes['awb'].tolist()).drop_duplicates('awb').set_index('awb')
+    atuais = atuais.reindex(conflitantes['awb'])
+    diferentes = (fingerprint_estados(conflitantes['tipo_servico'].to_numpy(), conflitantes['data_entrega'].to_numpy())
+                  != fingerprint_estados(atuais['tipo_servico'].to_numpy(), atuais['data_entrega'].to_numpy()))
+    return conflitantes[diferentes & (atuais['status'] != 'PAGA').to_numpy()]
+
+def inserir_conciliando(novas, chunk_id):
+    """Insere AWBs novas; retorna (máscara das inseridas, linhas já existentes no banco com tipo/data alterados),
+    estas para seguirem como UPDATE"""
+    inseridas = gravar_awbs_pro(novas, chunk_id)
+    conflitantes = novas[~inseridas]
+    if conflitantes.empty:
+        return inseridas, conflitantes
+    return inseridas, separar_alteradas_no_banco(conflitantes)
+
+def atualizar_conciliando(alteradas, chunk_id):
+    """Atualiza AWBs existentes; retorna (máscara das atualizadas, máscara das inseridas).
+    
+    O índice registra a AWB antes de a escrita terminar: o UPDATE pode não encontrá-la (inserção de
+    outro lote ainda em voo, que falhou ou foi revertida). Essas linhas são inseridas; se nesse meio-tempo
+    a outra inserção confirmou, o conflito volta como UPDATE uma única vez.
+    """
+    atualizadas = atualizar_awbs_pro(alteradas, chunk_id)
+    inseridas = np.zeros(len(alteradas), dtype=bool)
+    ausentes = alteradas[~atualizadas]
+    # Lotes de atualização guardados no spool por versões anteriores não têm as colunas do insert
+    if ausentes.empty or 'id_motorista' not in ausentes.columns:
+        return atualizadas, inseridas
+    
+    inseridas_ausentes, ainda_alteradas = inserir_conciliando(ausentes, chunk_id)
+    inseridas[~atualizadas] = inseridas_ausentes
+    if not ainda_alteradas.empty:
+        atualizadas |= alteradas['awb'].isin(ainda_alteradas['awb'][atualizar_awbs_pro(ainda_alteradas, chunk_id)]).to_numpy()
+    return atualizadas, inseridas
+
+class SpoolEscrita:
+    """Spool durável dos lotes que não chegaram ao banco, reenviados em ordem quando ele volta.
+    
+    Cada lote é uma linha `cabeçalho<TAB>dados` (JSON) num segmento append-only `segmento_<n>.log`,
+    gravada com fsync antes de contar como confirmado. Só um processo reenvia por vez (replay.lock),
+    avançando o cursor em cursor.json; segmentos consumidos são apagados. contagem.json soma o que
+    entrou e o cursor o que saiu: a diferença é a profundidade do spool.
+    """
+    
+    def __init__(self, diretorio):
+        self.diretorio = diretorio
+        self.lock = threading.Lock()
+        self.ultimo_erro = None
+        self.ultimo_reenvio = None
+        os.makedirs(diretorio, exist_ok=True)
+    
+    def _caminho(self, nome):
+        return os.path.join(self.diretorio, nome)
+    
+    def _segmento(self, numero):
+        return self._caminho(f'segmento_{numero:06d}.log')
+    
+    def _segmentos(self):
+        return sorted(int(nome[9:-4]) for nome in os.listdir(self.diretorio)
+                      if nome.startswith('segmento_') and nome.endswith('.log'))
+    
+    def _ler_json(self, nome, padrao):
+        try:
+            with open(self._caminho(nome)) as arquivo:
+                return {**padrao, **json.load(arquivo)}
+        except (OSError, ValueError):
+            return dict(padrao)
+    
+    def _gravar_json(self, nome, dados):
+        temporario = self._caminho(nome + '.tmp')
+        with open(temporario, 'w') as arquivo:
+            json.dump(dados, arquivo)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, self._caminho(nome))
+    
+    def _cursor(self):
+        return self._ler_json('cursor.json', {'segmento': 0, 'offset': 0, 'tentativas': 0,
+                                              'registros': 0, 'linhas': 0, 'rejeitados': 0})
+    
+    def _contagem(self):
+        return self._ler_json('contagem.json', {'registros': 0, 'linhas': 0})
+    
+    def _registro(self, tipo, batch_id, dados, motivo):
+        cabecalho = {'id': uuid.uuid4().hex, 'tipo': tipo, 'batch_id': batch_id, 'linhas': len(dados),
+                     'motivo': motivo[:200], 'criado_em': time.time()}
+        return cabecalho, (json.dumps(cabecalho) + '\t' + json.dumps(dados.to_dict('list'), default=str) + '\n').encode('utf-8')
+    
+    def gravar(self, tipo, batch_id, dados, motivo):
+        """Acrescenta um lote ('insercao' ou 'atualizacao') ao spool, com fsync; retorna as linhas guardadas"""
+        cabecalho, registro = self._registro(tipo, batch_id, dados, motivo)
         
-        if not awbs_novas:
-            print(f"📦 Chunk {chunk_id}: Todas as {len(awbs_lote)} AWBs já existem - descartadas")
-            return 0, duplicatas_descartadas
+        with self.lock, _trava_arquivo(self._caminho('spool.lock'), exclusiva=True):
+            segmentos = self._segmentos()
+            numero = segmentos[-1] if segmentos else self._cursor()['segmento'] + 1
+            caminho = self._segmento(numero)
+            if segmentos and os.path.getsize(caminho) >= SPOOL_SEGMENTO_BYTES:
+                numero += 1
+                caminho = self._segmento(numero)
+            
+            with open(caminho, 'ab+') as arquivo:
+                # Linha truncada por uma queda no meio da gravação: fechada para não corromper este registro
+                if arquivo.tell() > 0:
+                    arquivo.seek(-1, os.SEEK_END)
+                    if arquivo.read(1) != b'\n':
+                        arquivo.write(b'\n')
+                arquivo.write(registro)
+                arquivo.flush()
+                os.fsync(arquivo.fileno())
+            
+            contagem = self._contagem()
+            contagem['registros'] += 1
+            contagem['linhas'] += len(dados)
+            self._gravar_json('contagem.json', contagem)
+        
+        print(f"📥 Spool: lote {batch_id} ({tipo}, {len(dados)} linhas) guardado - {cabecalho['motivo']}")
+        return len(dados)
+    
+    def rejeitar(self, tipo, batch_id, dados, motivo):
+        """Lote que o banco recusou com erro permanente: vai direto para rejeitados.log, sem passar pela fila do spool"""
+        _, registro = self._registro(tipo, batch_id, dados, motivo)
+        with self.lock, _trava_arquivo(self._caminho('spool.lock'), exclusiva=True):
+            with open(self._caminho('rejeitados.log'), 'ab') as rejeitados:
+                rejeitados.write(registro)
+                rejeitados.flush()
+                os.fsync(rejeitados.fileno())
+            contagem = self._contagem()
+            contagem['rejeitados'] = contagem.get('rejeitados', 0) + 1
+            self._gravar_json('contagem.json', contagem)
+        print(f"🚫 Lote {batch_id} ({tipo}, {len(dados)} linhas) rejeitado pelo banco, em rejeitados.log - {motivo[:200]}")
+    
+    def pendente(self):
+        """Há lotes aguardando reenvio? (só metadados dos arquivos, barato o bastante para cada lote)"""
+        try:
+            segmentos = self._segmentos()
+            if not segmentos:
+                return False
+            cursor = self._cursor()
+            segmentos = [numero for numero in segmentos if numero >= cursor['segmento']]
+            if len(segmentos) != 1 or segmentos[0] != cursor['segmento']:
+                return bool(segmentos)
+            return os.path.getsize(self._segmento(segmentos[0])) > cursor['offset']
+        except OSError:
+            return True  # Segmento apagado durante a verificação: na dúvida, mantém a ordem
+    
+    def _proximo_registro(self, cursor):
+        """Próxima linha completa a partir do cursor (sem o '\\n') e o offset seguinte; apaga segmentos consumidos"""
+        segmentos = self._segmentos()
+        for posicao, numero in enumerate(segmentos):
+            caminho = self._segmento(numero)
+            if numero < cursor['segmento']:
+                os.remove(caminho)
+                continue
+            if numero > cursor['segmento']:
+                cursor.update(segmento=numero, offset=0)
+            
+            with open(caminho, 'rb') as arquivo:
+                arquivo.seek(cursor['offset'])
+                linha = arquivo.readline()
+            if linha.endswith(b'\n'):
+                return linha[:-1], cursor['offset'] + len(linha)
+            
+            if posicao < len(segmentos) - 1:
+                os.remove(caminho)  # Já sucedido por outro segmento: nada mais será acrescentado aqui
+                continue
+            # Último segmento esgotado: apagado sob a trava de gravação, se nada entrou nesse meio-tempo
+            with self.lock, _trava_arquivo(self._caminho('spool.lock'), exclusiva=True):
+                if os.path.getsize(caminho) == cursor['offset']:
+                    os.remove(caminho)
+        return None
+    
+    def _reenviar(self, cabecalho, dados):
+        if cabecalho['tipo'] == 'atualizacao':
+            atualizar_conciliando(dados, cabecalho['batch_id'])
+        else:
+            _, alteradas = inserir_conciliando(dados, cabecalho['batch_id'])
+            if not alteradas.empty:
+                atualizar_conciliando(alteradas, cabecalho['batch_id'])
+    
+    def drenar(self):
+        """Reenvia os lotes em ordem até esvaziar o spool; propaga o erro se o banco falhar.
         
-        # Pro tier: Salvar em lotes maiores com menos delay
-        total_salvos = 0
-        for i in range(0, len(awbs_novas), BATCH_SIZE):
-            lote = awbs_novas[i:i+BATCH_SIZE]
+        Retorna as linhas reenviadas (0 de imediato se outro processo já está drenando).
+        """
+        with _trava_arquivo(ESCRITAS_TRAVA, exclusiva=False), open(self._caminho('replay.lock'), 'a+') as trava:
+            if fcntl:
+                try:
+                    fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return 0
             
-            # Retry com backoff otimizado para Pro tier
-            for tentativa in range(MAX_RETRIES):
+            reenviadas = 0
+            cursor = self._cursor()
+            while not encerramento_solicitado.is_set():
+                proximo = self._proximo_registro(cursor)
+                if proximo is None:
+                    break
+                linha, offset_seguinte = proximo
+                
                 try:
-                    # INSERT com ON CONFLICT para Pro tier (mais eficiente)
-                    response = supabase.table('awbs').insert(lote).execute()
-                    if response.data:
-                        total_salvos += len(lote)
-                        print(f"💾 PRO Chunk {chunk_id}: {min(i+BATCH_SIZE, len(awbs_novas))}/{len(awbs_novas)} AWBs salvas")
+                    cabecalho, dados = linha.split(b'\t', 1)
+                    cabecalho = json.loads(cabecalho)
+                    dados = pd.DataFrame(json.loads(dados))
+                except ValueError:
+                    cabecalho, dados = {'linhas': 0}, None  # Registro truncado por uma queda durante a gravação
+                
+                inicio = time.time()
+                if dados is not None:
+                    try:
+                        self._reenviar(cabecalho, dados)
+                    except Exception as e:
+                        self.ultimo_erro = {'momento': datetime.now().isoformat(timespec='seconds'), 'erro': str(e)[:200]}
+                        cursor['tentativas'] += 1
+                        # Só erros transitórios (conexão, timeout) são tentados de novo; o resto libera a fila já
+                        if cursor['tentativas'] < SPOOL_REPLAY_MAX_TENTATIVAS and not erro_permanente(e):
+                            self._gravar_json('cursor.json', cursor)
+                            raise
+                        print(f"❌ Spool: lote {cabecalho['batch_id']} rejeitado após {cursor['tentativas']} tentativa(s): {e}")
+                        esquecer_awbs_nao_gravadas(dados)
+                        dados = None
+                
+                if dados is None:
+                    with open(self._caminho('rejeitados.log'), 'ab') as rejeitados:
+                        rejeitados.write(linha + b'\n')
+                    cursor['rejeitados'] += 1
+                else:
+                    reenviadas += len(dados)
+                    self.ultimo_reenvio = datetime.now().isoformat(timespec='seconds')
+                
+                cursor.update(offset=offset_seguinte, tentativas=0,
+                              registros=cursor['registros'] + 1, linhas=cursor['linhas'] + cabecalho['linhas'])
+                self._gravar_json('cursor.json', cursor)
+                
+                # Limite de vazão: o banco recém-recuperado não recebe o spool inteiro de uma vez
+                if dados is not None:
+                    espera = len(dados) / SPOOL_REPLAY_LINHAS_POR_SEGUNDO - (time.time() - inicio)
+                    if espera > 0:
+                        time.sleep(espera)
+            
+            return reenviadas
+    
+    def estatisticas(self):
+        """Profundidade (lotes, linhas, bytes) e idade do lote mais antigo ainda no spool"""
+        cursor = self._cursor()
+        contagem = self._contagem()
+        bytes_pendentes = 0
+        mais_antigo = None
+        segmentos = [numero for numero in self._segmentos() if numero >= cursor['segmento']]
+        for numero in segmentos:
+            try:
+                with open(self._segmento(numero), 'rb') as arquivo:
+                    offset = cursor['offset'] if numero == cursor['segmento'] else 0
+                    bytes_pendentes += max(0, os.fstat(arquivo.fileno()).st_size - offset)
+                    if mais_antigo is None:
+                        arquivo.seek(offset)
+                        cabecalho = arquivo.readline().split(b'\t', 1)[0]
+                        mais_antigo = json.loads(cabecalho)['criado_em'] if cabecalho else None
+            except (OSError, ValueError, KeyError):
+                continue
+        
+        return {
+            'lotes_pendentes': max(0, contagem['registros'] - cursor['registros']),
+            'linhas_pendentes': max(0, contagem['linhas'] - cursor['linhas']),
+            'bytes_pendentes': bytes_pendentes,
+            'segmentos': len(segmentos),
+            'mais_antigo_em': datetime.fromtimestamp(mais_antigo).isoformat(timespec='seconds') if mais_antigo else None,
+            'idade_segundos': round(time.time() - mais_antigo, 1) if mais_antigo else 0,
+            'tentativas_lote_atual': cursor['tentativas'],
+            'lotes_reenviados': cursor['registros'] - cursor['rejeitados'],
+            'lotes_rejeitados': cursor['rejeitados'] + contagem.get('rejeitados', 0),
+            'ultimo_reenvio': self.ultimo_reenvio,
+            'ultimo_erro': self.ultimo_erro
+        }
+
+# Spool único do servidor (diretório compartilhado pelos workers)
+spool_escrita = SpoolEscrita(SPOOL_FOLDER)
+
+def preparar_lookup_transform(motoristas_cache, tarifas_cache):
+    """Monta as tabelas de junção (motoristas e tarifas) uma vez por versão do cache"""
+    global lookup_transform
+    
+    with lookup_transform_lock:
+        atual = lookup_transform
+        if atual and atual['motoristas'] is motoristas_cache and atual['tarifas'] is tarifas_cache:
+            return atual
+        
+        # Arrays NumPy somente leitura: podem ser consultados por várias threads sem lock
+        ids = pd.to_numeric(pd.Series(list(motoristas_cache.keys()), dtype=object), errors='coerce').to_numpy(dtype='float64')
+        nomes = np.asarray(list(motoristas_cache.values()), dtype=object)[~np.isnan(ids)]
+        ids = ids[~np.isnan(ids)].astype('int64')
+        ordem = np.argsort(ids, kind='stable')
+        
+        # Tarifas em matriz densa: linha = motorista com tarifa customizada, coluna = tipo de serviço
+        ids_tarifas = sorted({int(id_motorista) for id_motorista in tarifas_cache if isinstance(id_motorista, (int, np.integer))})
+        tipos = sorted({int(tipo) for tarifas_motorista in tarifas_cache.values() for tipo in tarifas_motorista
+                        if isinstance(tipo, (int, np.integer))} | set(TARIFAS_PADRAO))
+        linha_por_id = {id_motorista: i for i, id_motorista in enumerate(ids_tarifas)}
+        coluna_por_tipo = {tipo: i for i, tipo in enumerate(tipos)}
+        matriz = np.full((len(ids_tarifas), len(tipos)), np.nan)
+        for id_motorista, tarifas_motorista in tarifas_cache.items():
+            if not isinstance(id_motorista, (int, np.integer)):
+                continue
+            for tipo, valor in tarifas_motorista.items():
+                if isinstance(tipo, (int, np.integer)):
+                    matriz[linha_por_id[int(id_motorista)], coluna_por_tipo[int(tipo)]] = pd.to_numeric(valor, errors='coerce')
+        
+        lookup_transform = {
+            'motoristas': motoristas_cache,
+            'tarifas': tarifas_cache,
+            'ids_motoristas': ids[ordem],
+            'nomes_motoristas': nomes[ordem],
+            'ids_tarifas': np.asarray(ids_tarifas, dtype='int64'),
+            'tipos_servico': np.asarray(tipos, dtype='int64'),
+            'matriz_tarifas': matriz,
+            'tarifas_padrao': np.asarray([TARIFAS_PADRAO.get(tipo, 0) for tipo in tipos], dtype='float64')
+        }
+        return lookup_transform
+
+def transformar_chunk_pro(chunk_data, motoristas_cache, tarifas_cache, devolver_mascara=False):
+    """Transforma um chunk com operações vetorizadas: retorna (AWBs válidas, erros por motivo)
+    (com devolver_mascara, também a máscara das linhas do chunk que passaram na validação)"""
+    lookup = preparar_lookup_transform(motoristas_cache, tarifas_cache)
+    
+    def coluna(nome, padrao):
+        if nome in chunk_data.columns:
+            return chunk_data[nome].astype('string').str.strip()
+        return pd.Series(padrao, index=chunk_data.index, dtype='string')
+    
+    awbs = coluna('AWB', '').fillna('')
+    ids = pd.to_numeric(coluna('ID do motorista', '0'), errors='coerce').astype('float64').to_numpy()
+    tipos = pd.to_numeric(coluna('Tipo de Serviço', '0'), errors='coerce').astype('float64').to_numpy()
+    
+    # Validação em bloco, um motivo por linha (na ordem das verificações)
+    sem_awb = (awbs == '').to_numpy(dtype=bool)
+    id_invalido = ~sem_awb & (np.isnan(ids) | (ids % 1 != 0))
+    tipo_invalido = ~sem_awb & ~id_invalido & (np.isnan(tipos) | (tipos % 1 != 0))
+    restantes = ~(sem_awb | id_invalido | tipo_invalido)
+    ids_validos = np.where(restantes, ids, -1).astype('int64')
+    posicao_motorista, motorista_conhecido = _localizar_em(lookup['ids_motoristas'], ids_validos)
+    motorista_desconhecido = restantes & ~motorista_conhecido
+    validas = restantes & ~motorista_desconhecido
+    
+    erros_por_motivo = {
+        'awb_vazia': int(sem_awb.sum()),
+        'id_motorista_invalido': int(id_invalido.sum()),
+        'tipo_servico_invalido': int(tipo_invalido.sum()),
+        'motorista_desconhecido': int(motorista_desconhecido.sum())
+    }
+    
+    id_motorista = ids_validos[validas]
+    tipo_servico = tipos[validas].astype('int64')
+    
+    # Junção com a tabela de tarifas: customizada -> padrão do tipo -> 0
+    linha, tarifa_customizada = _localizar_em(lookup['ids_tarifas'], id_motorista)
+    coluna_tipo, tipo_conhecido = _localizar_em(lookup['tipos_servico'], tipo_servico)
+    encontrada = tarifa_customizada & tipo_conhecido
+    valor_entrega = np.full(len(id_motorista), np.nan)
+    valor_entrega[encontrada] = lookup['matriz_tarifas'][linha[encontrada], coluna_tipo[encontrada]]
+    valor_padrao = np.where(tipo_conhecido, lookup['tarifas_padrao'][coluna_tipo], 0)
+    valor_entrega = np.where(np.isnan(valor_entrega), valor_padrao, valor_entrega)
+    
+    if 'Data/Hora Status do último status' in chunk_data.columns:
+        data_entrega = chunk_data['Data/Hora Status do último status'][validas].fillna('').astype(str).to_numpy()
+    else:
+        data_entrega = np.full(len(id_motorista), '', dtype=object)
+    
+    awbs_validas = pd.DataFrame({
+        'awb': awbs[validas].astype(object).to_numpy(),
+        'id_motorista': id_motorista,
+        'nome_motorista': lookup['nomes_motoristas'][posicao_motorista[validas]],
+        'tipo_servico': tipo_servico,
+        'data_entrega': data_entrega,
+        'valor_entrega': valor_entrega
+    })
+    if devolver_mascara:
+        return awbs_validas, erros_por_motivo, validas
+    return awbs_validas, erros_por_motivo
+
+class CheckpointJob:
+    """Checkpoint em disco de um job de upload, para retomar o processamento após um restart.
+    
+    Registra os chunks confirmados (gravados sem falha), com os totais deles, e o último chunk
+    despachado para dedup/escrita. Na retomada os confirmados são pulados; os despachados e não
+    confirmados são regravados deixando o banco resolver os conflitos, pois o índice de AWBs
+    pode tê-los registrado antes de a escrita terminar.
+    """
+    
+    def __init__(self, dados):
+        self.lock = threading.Lock()
+        self.dados = dados
+        self.caminho = os.path.join(JOBS_FOLDER, f"{dados['job_id']}.json")
+        self.confirmados = set(dados.get('chunks_confirmados', []))
+        self.despachado_na_retomada = dados.get('ultimo_despachado', 0)
+    
+    @classmethod
+    def criar(cls, job_id, **campos):
+        checkpoint = cls({
+            'job_id': job_id,
+            'status': 'queued',
+            'confirmados_ate': 0,  # Todos os chunks até este id foram confirmados
+            'chunks_confirmados': [],  # Confirmados fora de ordem, acima de confirmados_ate
+            'ultimo_despachado': 0,
+            'totais': None,
+            **campos
+        })
+        checkpoint.salvar()
+        return checkpoint
+    
+    @classmethod
+    def carregar(cls, caminho):
+        with open(caminho) as f:
+            return cls(json.load(f))
+    
+    def salvar(self):
+        with self.lock:
+            self._salvar()
+    
+    def _salvar(self):
+        self.dados['chunks_confirmados'] = sorted(self.confirmados)
+        temporario = f"{self.caminho}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temporario, 'w') as f:
+            json.dump(self.dados, f)
+        os.replace(temporario, self.caminho)
+    
+    def atualizar(self, **campos):
+        with self.lock:
+            self.dados.update(campos)
+            self._salvar()
+    
+    def pular(self, chunk_id):
+        """Chunk já confirmado numa execução anterior"""
+        with self.lock:
+            return chunk_id <= self.dados['confirmados_ate'] or chunk_id in self.confirmados
+    
+    def reprocessar(self, chunk_id):
+        """Chunk despachado antes do restart sem confirmação: pode ter sido gravado pela metade"""
+        return chunk_id <= self.despachado_na_retomada
+    
+    def despachar(self, chunk_id):
+        with self.lock:
+            if chunk_id > self.dados['ultimo_despachado']:
+                self.dados['ultimo_despachado'] = chunk_id
+                self._salvar()
+    
+    def confirmar(self, chunk_id, totais):
+        with self.lock:
+            self.confirmados.add(chunk_id)
+            while self.dados['confirmados_ate'] + 1 in self.confirmados:
+                self.dados['confirmados_ate'] += 1
+                self.confirmados.discard(self.dados['confirmados_ate'])
+            self.dados['totais'] = totais
+            self._salvar()
+    
+    def remover(self):
+        job_id = self.dados['job_id']
+        for caminho in (self.caminho, os.path.join(JOBS_FOLDER, f'{job_id}.lock'), os.path.join(JOBS_FOLDER, f'{job_id}.cancel')):
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+
+def reservar_job(job_id):
+    """Trava exclusiva entre processos para executar um job (None se outro worker já o executa)"""
+    trava = open(os.path.join(JOBS_FOLDER, f'{job_id}.lock'), 'a+')
+    if fcntl:
+        try:
+            fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            trava.close()
+            return None
+    return trava
+
+def reservar_reversao():
+    """Trava exclusiva entre processos para reverter um upload (None se há escrita de AWBs ou outra reversão em
+    andamento, em qualquer worker)"""
+    trava = open(ESCRITAS_TRAVA, 'a+')
+    if fcntl:
+        try:
+            fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            trava.close()
+            return None
+    return trava
+
+def novos_totais_pipeline():
+    return {'chunks': 0, 'linhas': 0, 'processadas': 0, 'erros': 0, 'salvos': 0, 'duplicatas': 0, 'duplicatas_arquivo': 0,
+            'duplicatas_banco': 0, 'atualizadas': 0, 'inalteradas': 0, 'chunks_cancelados': 0, 'linhas_canceladas': 0,
+            'em_spool': 0, 'erros_por_motivo': {}}
+
+def somar_lote_aos_totais(totais, lote):
+    """Acumula os contadores de um lote concluído nos totais do pipeline (e nos do seu arquivo, em lotes de arquivos)"""
+    if lote.get('arquivo') is not None:
+        por_arquivo = totais.setdefault('arquivos', {}).setdefault(str(lote['arquivo']), novos_totais_pipeline())
+        somar_lote_aos_totais(por_arquivo, {**lote, 'arquivo': None})
+    if lote.get('cancelado'):
+        totais['chunks_cancelados'] += 1
+        totais['linhas_canceladas'] += lote['linhas']
+        return
+    for motivo, quantidade in lote['erros_por_motivo'].items():
+        totais['erros_por_motivo'][motivo] = totais['erros_por_motivo'].get(motivo, 0) + quantidade
+    totais['chunks'] += 1
+    totais['linhas'] += lote['linhas']
+    totais['processadas'] += len(lote['validas']) if lote['validas'] is not None else 0
+    totais['erros'] += sum(lote['erros_por_motivo'].values())
+    totais['salvos'] += lote['salvos']
+    totais['duplicatas'] += lote['duplicatas_arquivo'] + lote['duplicatas']
+    totais['duplicatas_arquivo'] += lote['duplicatas_arquivo']
+    totais['duplicatas_banco'] += lote['duplicatas']
+    totais['atualizadas'] += lote['atualizadas']
+    totais['inalteradas'] += lote.get('inalteradas', 0)
+    totais['em_spool'] += lote.get('em_spool', 0)
+
+def linhas_com_falha(erros_por_motivo):
+    """Linhas que não chegaram ao banco nem ao spool (motivos falha_*: transformação, dedup, gravação, atualização)"""
+    return sum(quantidade for motivo, quantidade in (erros_por_motivo or {}).items() if motivo.startswith('falha_'))
+
+def resumir_totais_arquivo(arquivo, formato, totais):
+    """Linha do relatório consolidado de um lote de arquivos"""
+    totais = totais or novos_totais_pipeline()
+    return {
+        'arquivo': (arquivo.get('upload') or {}).get('arquivo') or os.path.basename(arquivo['file_path']),
+        'total_linhas': formato['total_linhas'],
+        'entregas_processadas': totais['processadas'],
+        'entregas_erro': totais['erros'],
+        'erros_por_motivo': totais['erros_por_motivo'],
+        'awbs_novas_salvas': totais['salvos'],
+        'duplicatas_no_arquivo': totais['duplicatas_arquivo'],
+        'duplicatas_no_banco': totais['duplicatas_banco'],
+        'awbs_atualizadas': totais['atualizadas'],
+        'linhas_em_spool': totais['em_spool'],
+        'linhas_canceladas': totais['linhas_canceladas']
+    }
+
+def esquecer_awbs_nao_gravadas(dados):
+    """Tira do índice AWBs que ele registrou na classificação mas que não chegaram ao banco nem ao spool:
+    o próximo upload delas volta a gravá-las (o insert concilia as que já existiam)"""
+    try:
+        cache_awbs_existentes.remover(dados['awb'].to_numpy())
+    except Exception as e:
+        print(f"⚠️ Índice de AWBs: falha ao esquecer {len(dados)} AWBs não gravadas ({e})")
+
+def enviar_lote_ao_spool(lote, tipo, dados, motivo, falha, permanente=False):
+    """Guarda no spool local o que não foi (ou não pode ser agora) gravado; só é falha se nem o spool aceitar.
+    
+    Com permanente (erro que repetir não resolve), o lote vai direto para rejeitados.log e conta como falha:
+    não fica na fila do spool segurando os lotes seguintes.
+    """
+    destino = 'linhas_com_falha'
+    try:
+        if permanente:
+            spool_escrita.rejeitar(tipo, lote['batch_id'], dados, motivo)
+        else:
+            lote['em_spool'] += spool_escrita.gravar(tipo, lote['batch_id'], dados, motivo)
+            destino = 'linhas_em_spool'
+    except Exception as e:
+        print(f"❌ Spool indisponível para o chunk {lote['chunk_id']}: {e}")
+    if destino == 'linhas_com_falha':
+        lote['erros_por_motivo'][falha] = len(dados)
+        esquecer_awbs_nao_gravadas(dados)
+    lote[destino] = lote.get(destino, dados.index[:0]).append(dados.index)
+
+def gravar_lote_duravel(lote, registrar_etapa=lambda etapa, segundos: None):
+    """Escrita de um lote já dedupado (novas, depois alteradas): o que o banco recusa fica no spool em disco.
+    
+    Preenche salvos, atualizadas e em_spool no lote; falhas sem spool vão para erros_por_motivo.
+    Os rótulos (índice do DataFrame) das linhas de cada desfecho ficam em linhas_inseridas,
+    linhas_atualizadas, linhas_em_spool e linhas_com_falha.
+    """
+    lote['salvos'] = 0
+    lote['atualizadas'] = 0
+    lote['em_spool'] = 0
+    # Com lotes pendentes no spool, este entra atrás deles: uma atualização nunca passa à frente da inserção da AWB
+    enfileirar = bool(supabase or pg_pool) and spool_escrita.pendente()
+    
+    novas = lote['novas']
+    if (supabase or pg_pool) and novas is not None and not novas.empty:
+        inicio = time.time()
+        if LINHAGEM_UPLOADS and lote.get('upload_id'):
+            novas = novas.assign(upload_id=lote['upload_id'])
+        if enfileirar:
+            enviar_lote_ao_spool(lote, 'insercao', novas, 'spool pendente', 'falha_gravacao')
+        else:
+            try:
+                inseridas, alteradas_no_banco = inserir_conciliando(novas, lote['batch_id'])
+                lote['salvos'] = int(inseridas.sum())
+                lote['linhas_inseridas'] = novas.index[inseridas]
+                lote['duplicatas'] += len(novas) - lote['salvos'] - len(alteradas_no_banco)
+                if not alteradas_no_banco.empty:
+                    # Existentes que o índice não conhecia: a alteração segue junto com as do lote
+                    lote['alteradas'] = pd.concat([lote['alteradas'], alteradas_no_banco]) if lote['alteradas'] is not None else alteradas_no_banco
+            except Exception as e:
+                print(f"❌ Erro na gravação do chunk {lote['chunk_id']}: {e}")
+                enviar_lote_ao_spool(lote, 'insercao', novas, str(e), 'falha_gravacao', erro_permanente(e))
+        registrar_etapa('gravacao', time.time() - inicio)
+    
+    alteradas = lote['alteradas']
+    if (supabase or pg_pool) and alteradas is not None and not alteradas.empty:
+        inicio = time.time()
+        # Com as colunas do insert: a AWB que o UPDATE não encontrar é inserida
+        alteradas = alteradas[['awb', 'id_motorista', 'nome_motorista'] + COLUNAS_AWBS_ATUALIZAVEIS]
+        if LINHAGEM_UPLOADS and lote.get('upload_id'):
+            alteradas = alteradas.assign(upload_id=lote['upload_id'])
+        if enfileirar or lote['em_spool']:
+            enviar_lote_ao_spool(lote, 'atualizacao', alteradas, 'spool pendente', 'falha_atualizacao')
+        else:
+            try:
+                atualizadas, inseridas = atualizar_conciliando(alteradas, lote['batch_id'])
+                lote['atualizadas'] = int(atualizadas.sum())
+                lote['linhas_atualizadas'] = alteradas.index[atualizadas]
+                lote['salvos'] += int(inseridas.sum())
+                lote['linhas_inseridas'] = lote.get('linhas_inseridas', alteradas.index[:0]).append(alteradas.index[inseridas])
+            except Exception as e:
+                print(f"❌ Erro na atualização do chunk {lote['chunk_id']}: {e}")
+                enviar_lote_ao_spool(lote, 'atualizacao', alteradas, str(e), 'falha_atualizacao', erro_permanente(e))
+        registrar_etapa('atualizacao', time.time() - inicio)
+
+FIM_DO_FLUXO = object()  # Sentinela que encerra cada etapa do pipeline
+
+class PipelineIngestao:
+    """Pipeline leitor → transformação → dedup → escrita em threads ligadas por filas limitadas"""
+    
+    def __init__(self, motoristas_cache, tarifas_cache, progresso, transform_workers=None, writer_workers=None, checkpoint=None,
+                 linhas_por_segundo=None):
+        self.motoristas_cache = motoristas_cache
+        self.tarifas_cache = tarifas_cache
+        self.progresso = progresso
+        self.transform_workers = transform_workers or TRANSFORM_WORKERS
+        self.writer_workers = writer_workers or MAX_WORKERS_LIMITE  # Escritas efetivas limitadas pelo controlador
+        
+        # Filas limitadas: se a escrita atrasa, a leitura para de avançar (backpressure)
+        self.fila_transformacao = queue.Queue(maxsize=PIPELINE_FILA)
+        self.fila_dedup = queue.Queue(maxsize=PIPELINE_FILA)
+        self.fila_escrita = queue.Queue(maxsize=PIPELINE_FILA)
+        self.fila_resultados = queue.Queue()
+        self.erro_etapa = None  # Primeiro erro fatal de uma etapa: executar() o propaga e o job termina com falha
+        self.dedup_arquivo = DedupArquivo()
+        self.arquivo_dedup = None  # Em lotes de arquivos, a repetição é verificada dentro de cada arquivo
+        self.estatisticas_dedup = {}
+        self.escritas_pendentes = {}  # arquivo -> lotes enviados à escrita e ainda não gravados
+        self.cond_escritas = threading.Condition()
+        self.checkpoint = checkpoint
+        self.linhas_por_segundo = linhas_por_segundo  # Limite de vazão da leitura (None = sem limite)
+        self.interrompido = False
+        self.cancelado = False
+        self.job_id = progresso.job_id
+        self.fingerprints_aceitos = []  # Delta: fingerprints das linhas válidas gravadas (ou já no banco) sem falha
+    
+    def _enviar(self, fila, item, etapa):
+        """put bloqueante, contabilizando o tempo parado por backpressure"""
+        inicio = time.time()
+        fila.put(item)
+        espera = time.time() - inicio
+        if espera > 0.001:
+            self.progresso.registrar_etapa(f'espera_{etapa}', espera)
+    
+    def _etapa_leitura(self, chunks):
+        chunk_id = 0
+        linhas_enviadas = 0
+        inicio_leitura = time.time()
+        try:
+            iterador = iter(chunks)
+            while True:
+                inicio = time.time()
+                chunk = next(iterador, None)
+                self.progresso.registrar_etapa('leitura', time.time() - inicio)
+                if chunk is None:
+                    break
+                
+                chunk_id += 1
+                if self.checkpoint and self.checkpoint.pular(chunk_id):
+                    # Confirmado antes do restart: só conta no progresso
+                    self.progresso.incrementar(linhas_concluidas=chunk['linhas'] if isinstance(chunk, dict) else len(chunk))
+                    continue
+                if encerramento_solicitado.is_set():
+                    # SIGTERM: não lê mais nada; os chunks já na fila terminam e ficam no checkpoint
+                    print(f"🛑 Leitura interrompida antes do chunk {chunk_id} (encerramento do servidor)")
+                    self.interrompido = True
                     break
+                if self._cancelado():
+                    print(f"🚫 Job {self.job_id} cancelado: leitura encerrada antes do chunk {chunk_id}")
+                    break
+                if self.erro_etapa:
+                    break  # Outra etapa falhou: o job termina com erro, não adianta ler o resto
+                
+                # Lotes já transformados (pool de processos) passam direto pela etapa de transformação
+                lote = chunk if isinstance(chunk, dict) else {'linhas': len(chunk), 'dados': chunk}
+                lote['chunk_id'] = chunk_id
+                if self.linhas_por_segundo:
+                    # Backfill sem disputar o banco com o tráfego ao vivo: a leitura espera até caber no limite
+                    espera = linhas_enviadas / self.linhas_por_segundo - (time.time() - inicio_leitura)
+                    if espera > 0:
+                        time.sleep(espera)
+                        self.progresso.registrar_etapa('espera_limite_vazao', espera)
+                    linhas_enviadas += lote['linhas']
+                self._enviar(self.fila_transformacao, lote, 'leitura')
+        except Exception as e:
+            self._falhar_etapa(f'leitura (chunk {chunk_id + 1})', e)
+        finally:
+            for _ in range(self.transform_workers):
+                self.fila_transformacao.put(FIM_DO_FLUXO)
+    
+    def _falhar_etapa(self, etapa, erro):
+        """Erro fatal numa etapa: registra o primeiro (o job termina com falha) e faz a leitura parar"""
+        print(f"❌ Erro na etapa de {etapa} do pipeline: {erro}")
+        if self.erro_etapa is None:
+            self.erro_etapa = erro
+    
+    def _esvaziar(self, fila, sentinelas):
+        """Depois de um erro fatal, consome a fila até as sentinelas para a etapa anterior não travar no put"""
+        while sentinelas > 0:
+            if fila.get() is FIM_DO_FLUXO:
+                sentinelas -= 1
+    
+    def _cancelado(self):
+        if not self.cancelado and job_cancelado(self.job_id):
+            self.cancelado = True
+        return self.cancelado
+    
+    def _etapa_transformacao(self):
+        try:
+            while True:
+                lote = self.fila_transformacao.get()
+                if lote is FIM_DO_FLUXO:
+                    break
+                
+                if 'validas' in lote:
+                    self._enviar(self.fila_dedup, lote, 'transformacao')
+                    continue
+                
+                inicio = time.time()
+                try:
+                    lote['validas'], lote['erros_por_motivo'], validas = transformar_chunk_pro(
+                        lote.pop('dados'), self.motoristas_cache, self.tarifas_cache, devolver_mascara=True
+                    )
+                    if 'fingerprints' in lote:
+                        lote['fingerprints'] = lote['fingerprints'][validas]  # Linhas rejeitadas não entram na base do delta
+                except Exception as e:
+                    print(f"❌ Erro na transformação do chunk {lote['chunk_id']}: {e}")
+                    lote.pop('dados', None)
+                    lote.pop('fingerprints', None)
+                    lote['validas'], lote['erros_por_motivo'] = None, {'falha_transformacao': lote['linhas']}
+                self.progresso.registrar_etapa('transformacao', time.time() - inicio)
+                
+                self._enviar(self.fila_dedup, lote, 'transformacao')
+        except Exception as e:
+            self._falhar_etapa('transformação', e)
+            self._esvaziar(self.fila_transformacao, 1)
+        finally:
+            self.fila_dedup.put(FIM_DO_FLUXO)
+    
+    def _etapa_dedup(self):
+        # Uma única thread, na ordem dos chunks no arquivo: a 1ª ocorrência de cada AWB é sempre a mantida.
+        # Primeiro as repetições dentro do arquivo, depois o que já existe no banco (índice global)
+        pendentes = {}
+        proximo = 1
+        encerradas = 0
+        
+        try:
+            while encerradas < self.transform_workers:
+                lote = self.fila_dedup.get()
+                if lote is FIM_DO_FLUXO:
+                    encerradas += 1
+                    continue
+                
+                pendentes[lote['chunk_id']] = lote
+                while True:
+                    if self.checkpoint and proximo not in pendentes and self.checkpoint.pular(proximo):
+                        proximo += 1  # Chunk confirmado antes do restart, não passa pelo pipeline
+                        continue
+                    if proximo not in pendentes:
+                        break
+                    lote = pendentes.pop(proximo)
+                    proximo += 1
+                    
+                    if self._cancelado():
+                        # Ainda não registrado no índice nem enviado à escrita: descartado sem efeito no banco
+                        lote.update({'cancelado': True, 'salvos': 0, 'atualizadas': 0})
+                        lote.pop('dados', None)
+                        lote.pop('validas', None)
+                        self.fila_resultados.put(lote)
+                        continue
+                    
+                    # ID determinístico do lote (job + chunk): regravar o mesmo lote na retomada é idempotente
+                    lote['batch_id'] = f"{self.job_id}:{lote['chunk_id']}"
+                    lote['upload_id'] = self.job_id
+                    reprocessar = bool(self.checkpoint and self.checkpoint.reprocessar(lote['chunk_id']))
+                    if self.checkpoint:
+                        self.checkpoint.despachar(lote['chunk_id'])
+                    
+                    inicio = time.time()
+                    lote['novas'], lote['duplicatas'], lote['alteradas'] = lote['validas'], 0, None
+                    lote['duplicatas_arquivo'] = 0
+                    arquivo = lote.get('arquivo')
+                    if arquivo != self.arquivo_dedup:
+                        self._trocar_dedup_arquivo(arquivo)
+                    try:
+                        if lote['validas'] is not None:
+                            primeiras = self.dedup_arquivo.registrar(lote['validas']['awb'].to_numpy())
+                            lote['duplicatas_arquivo'] = int((~primeiras).sum())
+                            lote['novas'] = lote['validas'][primeiras]
+                        if (supabase or pg_pool) and lote['novas'] is not None:
+                            unicas = lote['novas']
+                            lote['novas'], lote['duplicatas'], lote['alteradas'] = filtrar_duplicatas_pro(unicas)
+                            if reprocessar:
+                                # Pode ter sido gravado pela metade antes do restart: tudo vai ao banco, que ignora as existentes
+                                lote['novas'] = unicas[~unicas.index.isin(lote['alteradas'].index)]
+                                lote['duplicatas'] = 0
+                    except Exception as e:
+                        print(f"❌ Erro no dedup do chunk {lote['chunk_id']}: {e}")
+                        lote['novas'] = None
+                        lote['erros_por_motivo']['falha_dedup'] = len(lote['validas'])
+                    self.progresso.registrar_etapa('dedup', time.time() - inicio)
+                    
+                    if lote['alteradas'] is not None and not lote['alteradas'].empty:
+                        # A AWB alterada pode ter sido inserida por um arquivo anterior do lote: espera essa inserção terminar
+                        self._aguardar_escritas_anteriores(arquivo)
+                    with self.cond_escritas:
+                        self.escritas_pendentes[arquivo] = self.escritas_pendentes.get(arquivo, 0) + 1
+                    self._enviar(self.fila_escrita, lote, 'dedup')
+        except Exception as e:
+            # Ex.: checkpoint sem espaço em disco. Os escritores recebem as sentinelas mesmo assim e executar() termina
+            self._falhar_etapa('dedup', e)
+            self._esvaziar(self.fila_dedup, self.transform_workers - encerradas)
+        finally:
+            for _ in range(self.writer_workers):
+                self.fila_escrita.put(FIM_DO_FLUXO)
+    
+    def _etapa_escrita(self):
+        try:
+            while True:
+                lote = self.fila_escrita.get()
+                if lote is FIM_DO_FLUXO:
+                    break
+                
+                try:
+                    gravar_lote_duravel(lote, self.progresso.registrar_etapa)
                 except Exception as e:
-                    if "duplicate key" in str(e).lower():
-                        # Se for duplicata, contar como descartada e continuar
-                        duplicatas_descartadas += len(lote)
-                        break
-                    elif tentativa < MAX_RETRIES - 1:
-                        wait_time = (tentativa + 1) * 0.1  # Backoff mais rápido para Pro
-                        print(f"⚠️ PRO Tentativa {tentativa + 1} falhou, aguardando {wait_time}s...")
-                        time.sleep(wait_time)
-                    else:
-                        print(f"❌ Erro após {MAX_RETRIES} tentativas: {e}")
-                        raise e
-            
-            # Delay menor entre batches (Pro tier suporta mais throughput)
-            if i + BATCH_SIZE < len(awbs_novas):
-                time.sleep(BATCH_DELAY)
+                    self._falhar_etapa(f"escrita (chunk {lote['chunk_id']})", e)
+                    continue
+                finally:
+                    with self.cond_escritas:
+                        self.escritas_pendentes[lote.get('arquivo')] -= 1
+                        self.cond_escritas.notify_all()
+                self.fila_resultados.put(lote)
+        finally:
+            self.fila_resultados.put(FIM_DO_FLUXO)
+    
+    def _trocar_dedup_arquivo(self, arquivo):
+        """Novo arquivo do lote: as AWBs vistas no anterior não contam como repetidas neste"""
+        if self.arquivo_dedup is not None:
+            self._acumular_estatisticas_dedup()
+            self.dedup_arquivo.fechar()
+            self.dedup_arquivo = DedupArquivo()
+        self.arquivo_dedup = arquivo
+    
+    def _acumular_estatisticas_dedup(self):
+        for chave, valor in self.dedup_arquivo.estatisticas().items():
+            self.estatisticas_dedup[chave] = self.estatisticas_dedup.get(chave, 0) + valor
+    
+    def _aguardar_escritas_anteriores(self, arquivo):
+        inicio = time.time()
+        with self.cond_escritas:
+            self.cond_escritas.wait_for(lambda: not any(
+                pendentes for anterior, pendentes in self.escritas_pendentes.items()
+                if anterior is not None and anterior < arquivo
+            ))
+        espera = time.time() - inicio
+        if espera > 0.001:
+            self.progresso.registrar_etapa('espera_ordem_arquivos', espera)
+    
+    def executar(self, chunks, total_chunks=None):
+        """Executa o pipeline sobre um iterável de chunks e devolve os totais consolidados"""
+        threads = [threading.Thread(target=self._etapa_leitura, args=(chunks,), name='pipeline-leitura')]
+        threads += [threading.Thread(target=self._etapa_transformacao, name=f'pipeline-transformacao-{i}')
+                    for i in range(self.transform_workers)]
+        threads.append(threading.Thread(target=self._etapa_dedup, name='pipeline-dedup'))
+        threads += [threading.Thread(target=self._etapa_escrita, name=f'pipeline-escrita-{i}')
+                    for i in range(self.writer_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
         
-        return total_salvos, duplicatas_descartadas
+        # Na retomada, os totais partem do que já foi confirmado antes do restart
+        # (checkpoints de versões anteriores podem não ter os contadores mais novos)
+        confirmados = {**novos_totais_pipeline(), **((self.checkpoint and self.checkpoint.dados.get('totais')) or {})}
+        totais = json.loads(json.dumps(confirmados))
+        if totais['chunks']:
+            self.progresso.incrementar(
+                processed_lines=totais['processadas'],
+                errors=totais['erros'],
+                duplicates_discarded=totais['duplicatas'],
+                new_awbs_saved=totais['salvos']
+            )
         
-    except Exception as e:
-        print(f"❌ Erro ao salvar lote no Supabase PRO: {e}")
-        return 0, 0
-
-def processar_chunk_pro(chunk_data, chunk_id, motoristas_cache, tarifas_cache):
-    """Processa um chunk de dados com performance Pro tier"""
-    awbs_processadas = []
-    erros = 0
-    
-    for _, row in chunk_data.iterrows():
-        try:
-            # Extrair dados da linha
-            awb = str(row.get('AWB', '')).strip()
-            if not awb:  # Pular linhas sem AWB
-                erros += 1
+        encerradas = 0
+        while encerradas < self.writer_workers:
+            lote = self.fila_resultados.get()
+            if lote is FIM_DO_FLUXO:
+                encerradas += 1
                 continue
-                
-            id_motorista = int(row.get('ID do motorista', 0))
-            tipo_servico = int(row.get('Tipo de Serviço', 0))
-            data_entrega = str(row.get('Data/Hora Status do último status', ''))
             
-            # Verificar se motorista existe
-            if id_motorista not in motoristas_cache:
-                erros += 1
+            somar_lote_aos_totais(totais, lote)
+            if lote.get('cancelado'):
+                self.progresso.incrementar(linhas_concluidas=lote['linhas'])
                 continue
             
-            # Calcular valor com tarifas Pro
-            valor_entrega = calcular_valor_entrega_pro(tipo_servico, id_motorista, tarifas_cache)
-            
-            # Criar AWB
-            awb_data = {
-                'awb': awb,
-                'id_motorista': id_motorista,
-                'nome_motorista': motoristas_cache[id_motorista],
-                'tipo_servico': tipo_servico,
-                'data_entrega': data_entrega,
-                'valor_entrega': valor_entrega
-            }
-            
-            awbs_processadas.append(awb_data)
+            processadas = len(lote['validas']) if lote['validas'] is not None else 0
+            erros = sum(lote['erros_por_motivo'].values())
+            if 'fingerprints' in lote and not linhas_com_falha(lote['erros_por_motivo']):
+                self.fingerprints_aceitos.append(lote.pop('fingerprints'))
+            if self.checkpoint and not any(motivo.startswith('falha_') for motivo in lote['erros_por_motivo']):
+                somar_lote_aos_totais(confirmados, lote)
+                self.checkpoint.confirmar(lote['chunk_id'], confirmados)
             
-        except Exception as e:
-            erros += 1
-            continue
-    
-    # Salvar no Supabase Pro com performance máxima
-    salvos, duplicatas = salvar_lote_supabase_pro(awbs_processadas, chunk_id)
-    
-    return len(awbs_processadas), erros, salvos, duplicatas
+            # Atualizar progresso
+            self.progresso.incrementar(
+                processed_lines=processadas,
+                errors=erros,
+                duplicates_discarded=lote['duplicatas_arquivo'] + lote['duplicatas'],
+                new_awbs_saved=lote['salvos'],
+                linhas_concluidas=lote['linhas']
+            )
+            self.progresso.atualizar(
+                message=f"PRO: Chunk {lote['chunk_id']}/{total_chunks or '?'} - {lote['salvos']} novas, "
+                        f"{lote['duplicatas_arquivo']} repetidas no arquivo, {lote['duplicatas']} já no banco"
+            )
+        
+        for thread in threads:
+            thread.join()
+        
+        self._acumular_estatisticas_dedup()
+        self.dedup_arquivo.fechar()
+        
+        if self.erro_etapa:
+            raise self.erro_etapa
+        return totais
 
-def processar_csv_pro_tier(file_path):
-    """Processa CSV com performance máxima do Pro tier"""
-    global processing_status
+def detectar_formato_arquivo(file_path, descritor=None):
+    """Formato, encoding, delimitador e total de linhas de um arquivo (do descritor do intake, quando houver)"""
+    formato = (descritor or {}).get('formato') or file_path.rsplit('.', 1)[-1].lower()
+    if formato in ('xlsx', 'xls'):
+        # Planilha: sem encoding/delimitador, lida em streaming pela primeira aba
+        total_linhas = (descritor or {}).get('total_linhas')
+        if total_linhas is None:
+            total_linhas = contar_linhas_planilha(file_path) or 0
+        return {'formato': formato, 'planilha': True, 'encoding': None, 'delimitador': None, 'total_linhas': total_linhas}
     
-    try:
-        processing_status.update({
-            'active': True,
-            'progress': 0,
-            'message': 'Iniciando processamento PRO TIER...',
-            'start_time': time.time(),
-            'duplicates_discarded': 0,
-            'new_awbs_saved': 0,
-            'performance_stats': {}
-        })
-        
+    if descritor and descritor.get('encoding'):
+        # Formato já detectado no intake do upload: o arquivo não é relido
+        encoding = descritor['encoding']
+        delimitador = descritor['delimitador']
+        total_linhas = descritor['total_linhas']
+    else:
         # Detectar encoding e delimitador
         encoding = detectar_encoding(file_path)
         delimitador = detectar_delimitador_csv(file_path, encoding)
         
-        processing_status['message'] = f'PRO: Encoding {encoding}, Delimitador {delimitador}'
+        # Contar linhas sem carregar o arquivo (leitura em streaming logo abaixo)
+        total_linhas = contar_linhas_csv(file_path)
+    return {'formato': formato, 'planilha': False, 'encoding': encoding, 'delimitador': delimitador, 'total_linhas': total_linhas}
+
+def abrir_fonte_arquivo(file_path, formato, motoristas_cache, tarifas_cache, fonte_delta=None, anteriores=None, fingerprints_lidos=None):
+    """Chunks de um arquivo para o pipeline: pool de processos (CSV grande), leitura em streaming e filtro delta"""
+    encoding = formato['encoding']
+    usar_processos = (PROCESS_POOL_WORKERS > 1 and not formato['planilha'] and not fonte_delta
+                      and os.path.getsize(file_path) >= PROCESS_POOL_MIN_BYTES
+                      and not encoding.lower().replace('_', '-').startswith(('utf-16', 'utf-32')))
+    if usar_processos:
+        return transformar_csv_em_processos(file_path, encoding, formato['delimitador'], motoristas_cache, tarifas_cache)
+    
+    if formato['planilha']:
+        fonte = ler_planilha_em_chunks(file_path)
+    else:
+        fonte = ler_csv_em_chunks(file_path, encoding, formato['delimitador'])
+    if fonte_delta:
+        fonte = filtrar_delta_fonte(fonte, anteriores, fingerprints_lidos)
+    return fonte
+
+def encadear_fontes(fontes):
+    """Chunks de vários arquivos em sequência, cada um marcado com o índice do seu arquivo"""
+    for indice, fonte in enumerate(fontes):
+        for chunk in fonte:
+            lote = chunk if isinstance(chunk, dict) else {'linhas': len(chunk), 'dados': chunk}
+            lote['arquivo'] = indice
+            yield lote
+
+def processar_csv_pro_tier(file_path, job_id=None, descritor=None, fonte_delta=None, checkpoint=None):
+    """Processa CSV (ou planilha xlsx/xls) com performance máxima do Pro tier (com fonte_delta, só as linhas que mudaram
+    desde o último upload da fonte; com checkpoint, retomando do último chunk confirmado)"""
+    return processar_arquivos_pro_tier([{'file_path': file_path, 'upload': descritor}], job_id, fonte_delta, checkpoint,
+                                       por_arquivo=False)
+
+def processar_arquivos_pro_tier(arquivos, job_id=None, fonte_delta=None, checkpoint=None, por_arquivo=True, linhas_por_segundo=None):
+    """Processa um ou mais arquivos ({'file_path', 'upload'}) em um único pipeline.
+    
+    Em um lote de arquivos (backfill), os caches são carregados uma vez e os chunks seguem em
+    sequência, na ordem da lista, sem esvaziar o pipeline entre um arquivo e outro; com por_arquivo,
+    o resultado traz também os totais de cada arquivo. linhas_por_segundo limita a vazão da leitura.
+    """
+    progresso = iniciar_progresso(job_id or uuid.uuid4().hex)
+    
+    try:
+        inicio_etapa = time.time()
+        formatos = [detectar_formato_arquivo(arquivo['file_path'], arquivo.get('upload')) for arquivo in arquivos]
+        total_linhas = sum(formato['total_linhas'] for formato in formatos)
+        total_chunks = max(sum((formato['total_linhas'] + CHUNK_SIZE - 1) // CHUNK_SIZE for formato in formatos), 1)
+        progresso.registrar_etapa('deteccao_formato', time.time() - inicio_etapa)
+        if len(arquivos) > 1:
+            mensagem = f'PRO: Lote de {len(arquivos)} arquivos'
+        elif formatos[0]['planilha']:
+            mensagem = f"PRO: Planilha {formatos[0]['formato']}"
+        else:
+            mensagem = f"PRO: Encoding {formatos[0]['encoding']}, Delimitador {formatos[0]['delimitador']}"
+        progresso.atualizar(total_lines=total_linhas, message=mensagem)
         
         # Carregar dados e AWBs existentes (Pro tier permite cache maior)
+        inicio_etapa = time.time()
         motoristas_cache, tarifas_cache = carregar_dados_supabase_pro()
-        carregar_awbs_existentes_pro()
-        
-        processing_status['message'] = f'PRO: {len(motoristas_cache)} motoristas, {len(cache_awbs_existentes)} AWBs em cache'
-        
-        # Ler CSV
-        df = pd.read_csv(file_path, encoding=encoding, delimiter=delimitador)
-        total_linhas = len(df)
+        if INSERT_IGNORAR_CONFLITOS and total_linhas < PRELOAD_AWBS_MIN_LINHAS and cache_awbs_sync['watermark'] is None:
+            # Upload pequeno com cache frio: o banco resolve as duplicatas, sem varrer a tabela awbs
+            print(f"⏭️ Upload pequeno ({total_linhas} linhas): pré-carga das AWBs existentes dispensada")
+        else:
+            carregar_awbs_existentes_pro()
+        progresso.registrar_etapa('carga_cache', time.time() - inicio_etapa)
         
-        processing_status.update({
-            'total_lines': total_linhas,
-            'message': f'PRO: CSV carregado - {total_linhas} linhas'
-        })
+        progresso.atualizar(message=f'PRO: {len(motoristas_cache)} motoristas, {len(cache_awbs_existentes)} AWBs em cache - '
+                                    f'processando {total_linhas} linhas em {total_chunks} chunks com {controlador_escrita.limite_escritas} escritas paralelas')
         
-        # Dividir em chunks maiores para Pro tier
-        chunks = [df[i:i+CHUNK_SIZE] for i in range(0, len(df), CHUNK_SIZE)]
+        # Pipeline em etapas: leitura sob demanda, transformação, dedup e escrita em paralelo
+        fingerprints_lidos = []
+        anteriores = carregar_fingerprints_fonte(fonte_delta) if fonte_delta else None
+        fontes = (abrir_fonte_arquivo(arquivo['file_path'], formato, motoristas_cache, tarifas_cache,
+                                      fonte_delta, anteriores, fingerprints_lidos)
+                  for arquivo, formato in zip(arquivos, formatos))
+        fonte = encadear_fontes(fontes) if por_arquivo else next(fontes)
+        usar_processos = PROCESS_POOL_WORKERS > 1 and not fonte_delta and any(
+            not formato['planilha'] and os.path.getsize(arquivo['file_path']) >= PROCESS_POOL_MIN_BYTES
+            for arquivo, formato in zip(arquivos, formatos))
         
-        processing_status['message'] = f'PRO: Processando {len(chunks)} chunks com {MAX_WORKERS} threads paralelas'
+        pipeline = PipelineIngestao(motoristas_cache, tarifas_cache, progresso, checkpoint=checkpoint,
+                                    linhas_por_segundo=linhas_por_segundo)
+        with _trava_arquivo(ESCRITAS_TRAVA, exclusiva=False):
+            totais = pipeline.executar(fonte, total_chunks)
         
-        # Processar chunks em PARALELO (Pro tier suporta múltiplas conexões)
-        total_processadas = 0
-        total_erros = 0
-        total_salvos = 0
-        total_duplicatas = 0
+        if pipeline.interrompido:
+            confirmados_ate = checkpoint.dados['confirmados_ate'] if checkpoint else 0
+            mensagem = f'Processamento interrompido pelo encerramento do servidor (chunks confirmados até {confirmados_ate})'
+            progresso.finalizar(message=f'PRO: {mensagem}')
+            return {
+                'success': False,
+                'interrompido': True,
+                'error': mensagem
+            }
         
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = []
-            
-            for i, chunk in enumerate(chunks):
-                future = executor.submit(
-                    processar_chunk_pro, 
-                    chunk, i+1, motoristas_cache, tarifas_cache
-                )
-                futures.append(future)
-            
-            # Coletar resultados com timeout maior para Pro tier
-            for i, future in enumerate(futures):
-                try:
-                    processadas, erros, salvos, duplicatas = future.result(timeout=600)  # 10 minutos por chunk
-                    total_processadas += processadas
-                    total_erros += erros
-                    total_salvos += salvos
-                    total_duplicatas += duplicatas
-                    
-                    # Atualizar progresso
-                    progress = ((i + 1) / len(chunks)) * 100
-                    processing_status.update({
-                        'progress': progress,
-                        'processed_lines': total_processadas,
-                        'errors': total_erros,
-                        'duplicates_discarded': total_duplicatas,
-                        'new_awbs_saved': total_salvos,
-                        'message': f'PRO: Chunk {i+1}/{len(chunks)} - {salvos} novas, {duplicatas} duplicatas'
-                    })
-                    
-                except Exception as e:
-                    print(f"❌ Erro no chunk {i+1}: {e}")
-                    total_erros += len(chunks[i])
+        # Delta: a base da próxima comparação só avança se todas as linhas chegaram ao banco
+        if fonte_delta and not pipeline.cancelado:
+            if (supabase or pg_pool) and not linhas_com_falha(totais['erros_por_motivo']):
+                salvar_fingerprints_fonte(fonte_delta, fingerprints_lidos + pipeline.fingerprints_aceitos)
+            else:
+                print(f"⚠️ Fingerprints da fonte {fonte_delta} mantidos: upload com falhas ou sem banco")
         
         # Finalizar com estatísticas Pro
-        tempo_total = time.time() - processing_status['start_time']
+        tempo_total = time.time() - progresso.start_time
+        total_processadas = totais['processadas']
+        total_erros = totais['erros']
+        total_salvos = totais['salvos']
+        total_duplicatas = totais['duplicatas']
+        erros_por_motivo = totais['erros_por_motivo']
         performance = total_processadas / tempo_total if tempo_total > 0 else 0
         
-        processing_status.update({
-            'active': False,
-            'progress': 100,
-            'message': 'PRO: Processamento concluído com performance máxima!',
-            'performance_stats': {
+        if pipeline.cancelado:
+            mensagem_final = (f"PRO: Cancelado - {total_salvos} AWBs gravadas e {totais['atualizadas']} atualizadas antes do cancelamento, "
+                              f"{totais['linhas_canceladas']} linhas descartadas sem gravar")
+        else:
+            mensagem_final = 'PRO: Processamento concluído com performance máxima!'
+        if totais['em_spool']:
+            mensagem_final += f" {totais['em_spool']} linhas aguardam no spool local o reenvio ao banco."
+        
+        progresso.finalizar(
+            message=mensagem_final,
+            performance_stats={
+                'cancelado': pipeline.cancelado,
                 'linhas_por_segundo': round(performance, 2),
                 'tempo_total': round(tempo_total, 2),
-                'chunks_paralelos': len(chunks),
-                'workers_utilizados': MAX_WORKERS,
-                'batch_size': BATCH_SIZE
+                'chunks_paralelos': totais['chunks'],
+                'engine_csv': 'pyarrow' if CSV_ENGINE == 'pyarrow' and PYARROW_AVAILABLE else 'c',
+                'workers_utilizados': controlador_escrita.limite_escritas,
+                'transform_workers': TRANSFORM_WORKERS,
+                'processos_transformacao': PROCESS_POOL_WORKERS if usar_processos else 0,
+                'fonte_delta': fonte_delta,
+                'dedup_arquivo': pipeline.estatisticas_dedup,
+                'batch_size': controlador_escrita.batch_size,
+                'backend_escrita': 'postgres_copy' if pg_pool else 'supabase_rest',
+                'controle_escrita': controlador_escrita.estatisticas(),
+                'spool': spool_escrita.estatisticas()
             }
-        })
+        )
+        
+        dados = {
+            'job_id': progresso.job_id,
+            'cancelado': pipeline.cancelado,
+            'chunks_cancelados': totais['chunks_cancelados'],
+            'linhas_canceladas': totais['linhas_canceladas'],
+            'entregas_processadas': total_processadas,
+            'entregas_erro': total_erros,
+            'erros_por_motivo': erros_por_motivo,
+            'awbs_novas_salvas': total_salvos,
+            'duplicatas_descartadas': total_duplicatas,
+            'duplicatas_no_arquivo': totais['duplicatas_arquivo'],
+            'duplicatas_no_banco': totais['duplicatas_banco'],
+            'awbs_atualizadas': totais['atualizadas'],
+            'linhas_inalteradas': totais['inalteradas'],
+            'linhas_em_spool': totais['em_spool'],
+            'fonte_delta': fonte_delta,
+            'tempo_processamento': round(tempo_total, 2),
+            'tempo_por_etapa': progresso.snapshot()['stage_timings'],
+            'performance_linhas_por_segundo': round(performance, 2),
+            'tier': 'PRO',
+            'workers_paralelos': controlador_escrita.limite_escritas,
+            'batch_size': controlador_escrita.batch_size
+        }
+        if por_arquivo:
+            dados['total_arquivos'] = len(arquivos)
+            dados['arquivos'] = [
+                resumir_totais_arquivo(arquivo, formato, totais.get('arquivos', {}).get(str(indice)))
+                for indice, (arquivo, formato) in enumerate(zip(arquivos, formatos))
+            ]
         
         return {
-            'success': True,
-            'data': {
-                'entregas_processadas': total_processadas,
-                'entregas_erro': total_erros,
-                'awbs_novas_salvas': total_salvos,
-                'duplicatas_descartadas': total_duplicatas,
-                'tempo_processamento': round(tempo_total, 2),
-                'performance_linhas_por_segundo': round(performance, 2),
-                'tier': 'PRO',
-                'workers_paralelos': MAX_WORKERS,
-                'batch_size': BATCH_SIZE
-            },
-            'message': f'PRO TIER: {total_salvos} AWBs novas salvas, {total_duplicatas} duplicatas descartadas em {round(tempo_total, 2)}s!'
+            'success': not pipeline.cancelado,
+            'cancelado': pipeline.cancelado,
+            'error': 'Cancelado pelo usuário' if pipeline.cancelado else None,
+            'data': dados,
+            'message': f"PRO TIER: {total_salvos} AWBs novas salvas, {totais['atualizadas']} atualizadas, {total_duplicatas} duplicatas descartadas em {round(tempo_total, 2)}s!"
         }
         
     except Exception as e:
-        processing_status.update({
-            'active': False,
-            'message': f'PRO: Erro - {str(e)}'
-        })
+        progresso.finalizar(message=f'PRO: Erro - {str(e)}')
         return {
             'success': False,
             'error': str(e)
         }
 
+def ler_eventos_em_blocos(stream, formato):
+    """Lê eventos NDJSON (um objeto por linha) ou CSV (com cabeçalho) de um corpo enviado aos poucos.
+    
+    Gera (chunk com as colunas do pipeline, eventos ilegíveis) a cada INGESTAO_LOTE_LINHAS eventos, ou antes
+    disso quando o primeiro evento do bloco já espera há INGESTAO_LOTE_ESPERA segundos.
+    """
+    linhas = (linha.decode('utf-8-sig') for linha in iter(stream.readline, b''))
+    if formato == 'csv':
+        primeira = next((linha for linha in linhas if linha.strip()), None)
+        if primeira is None:
+            return
+        delimitador = detectar_delimitador_linha(primeira)
+        cabecalho = [coluna.strip() for coluna in next(csv.reader([primeira], delimiter=delimitador))]
+        eventos = (dict(zip(cabecalho, valores)) for valores in csv.reader(linhas, delimiter=delimitador) if valores)
+    else:
+        eventos = ler_eventos_ndjson(linhas)
+    
+    registros = []
+    ilegiveis = 0
+    inicio = None
+    for evento in eventos:
+        if evento is None:
+            ilegiveis += 1
+        else:
+            registros.append({COLUNAS_EVENTO.get(chave, chave): valor for chave, valor in evento.items()})
+        inicio = inicio or time.time()
+        if len(registros) >= INGESTAO_LOTE_LINHAS or time.time() - inicio >= INGESTAO_LOTE_ESPERA:
+            yield pd.DataFrame(registros, columns=COLUNAS_PIPELINE), ilegiveis
+            registros, ilegiveis, inicio = [], 0, None
+    if registros or ilegiveis:
+        yield pd.DataFrame(registros, columns=COLUNAS_PIPELINE), ilegiveis
+
+def ler_eventos_ndjson(linhas):
+    """Objetos de cada linha NDJSON (uma linha com um array JSON também vale); None para linha ilegível"""
+    for linha in linhas:
+        if not linha.strip():
+            continue
+        try:
+            evento = json.loads(linha)
+        except ValueError:
+            yield None
+            continue
+        for item in (evento if isinstance(evento, list) else [evento]):
+            yield item if isinstance(item, dict) else None
+
+class IngestaoContinua:
+    """Micro-lotes de eventos de AWB recebidos continuamente, gravados por uma única thread.
+    
+    Cada envio chega já transformado (validação e tarifa). A thread junta os envios pendentes até
+    INGESTAO_LOTE_LINHAS linhas ou até o mais antigo esperar INGESTAO_LOTE_ESPERA segundos, faz o
+    dedup no índice e grava inserções e depois atualizações, como a etapa de escrita do pipeline.
+    O Future de cada envio só é resolvido quando suas linhas estão no banco ou no spool em disco.
+    """
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pendentes = deque()  # (chegada, AWBs válidas, Future)
+        self.linhas_pendentes = 0
+        self.thread = None
+        self.sequencia = 0
+        self.estatisticas_ = {'envios': 0, 'linhas': 0, 'micro_lotes': 0, 'salvos': 0, 'atualizadas': 0,
+                              'duplicatas': 0, 'em_spool': 0, 'falhas': 0, 'ultimo_micro_lote': None}
+    
+    def enviar(self, validas):
+        """Entrega as AWBs válidas de um envio; retorna o Future com o resumo da gravação delas"""
+        futuro = Future()
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.linhas_pendentes < INGESTAO_MAX_PENDENTES, INGESTAO_TIMEOUT):
+                raise TimeoutError('Ingestão contínua sobrecarregada, tente novamente em instantes')
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._executar, name='ingestao-continua', daemon=True)
+                self.thread.start()
+            self.pendentes.append((time.time(), validas, futuro))
+            self.linhas_pendentes += len(validas)
+            self.estatisticas_['envios'] += 1
+            self.estatisticas_['linhas'] += len(validas)
+            self.cond.notify_all()
+        return futuro
+    
+    def _proximo_micro_lote(self):
+        """Espera o micro-lote encher (ou o prazo do envio mais antigo vencer) e o retira da fila"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.pendentes)
+            prazo = self.pendentes[0][0] + INGESTAO_LOTE_ESPERA
+            while self.linhas_pendentes < INGESTAO_LOTE_LINHAS and time.time() < prazo:
+                self.cond.wait(prazo - time.time())
+            
+            envios = []
+            linhas = 0
+            while self.pendentes and (not envios or linhas + len(self.pendentes[0][1]) <= INGESTAO_LOTE_LINHAS):
+                _, validas, futuro = self.pendentes.popleft()
+                envios.append((validas, futuro))
+                linhas += len(validas)
+            self.linhas_pendentes -= linhas
+            self.cond.notify_all()
+        return envios
+    
+    def _executar(self):
+        while True:
+            envios = self._proximo_micro_lote()
+            try:
+                resumos = self._gravar(envios)
+            except Exception as e:
+                print(f"❌ Erro no micro-lote de ingestão contínua: {e}")
+                for _, futuro in envios:
+                    futuro.set_exception(e)
+                continue
+            for (_, futuro), resumo in zip(envios, resumos):
+                futuro.set_result(resumo)
+    
+    def _gravar(self, envios):
+        """Dedup e gravação de um micro-lote; retorna o resumo de cada envio, na ordem recebida"""
+        inicio = time.time()
+        self.sequencia += 1
+        validas = pd.concat([validas for validas, _ in envios], ignore_index=True)
+        origem = np.repeat(np.arange(len(envios)), [len(validas) for validas, _ in envios])
+        
+        # Eventos chegam em ordem: dentro do micro-lote, a última ocorrência de cada AWB é o estado mais recente
+        ultimas = ~validas['awb'].duplicated(keep='last').to_numpy()
+        repetidas = np.bincount(origem[~ultimas], minlength=len(envios))
+        validas, origem = validas[ultimas], origem[ultimas]
+        
+        lote = {'chunk_id': f'ingestao-{self.sequencia}', 'batch_id': f'ingestao:{uuid.uuid4().hex[:12]}:{self.sequencia}',
+                'novas': validas, 'alteradas': None, 'duplicatas': 0, 'erros_por_motivo': {}}
+        lote['upload_id'] = lote['batch_id']  # Cada micro-lote é revertido como um upload
+        with _trava_arquivo(ESCRITAS_TRAVA, exclusiva=False):
+            lote['novas'], lote['duplicatas'], lote['alteradas'] = filtrar_duplicatas_pro(validas)
+            gravar_lote_duravel(lote)
+        
+        # Contagens pelo que o banco (ou o spool) realmente recebeu, não pela classificação no índice:
+        # uma AWB que o índice não conhecia é recusada pelo insert e segue como atualização
+        def por_envio(chave):
+            return np.bincount(origem[validas.index.isin(lote.get(chave, []))], minlength=len(envios))
+        novas = por_envio('linhas_inseridas')
+        alteradas = por_envio('linhas_atualizadas')
+        em_spool = por_envio('linhas_em_spool')
+        com_falha = por_envio('linhas_com_falha')
+        validas_por_envio = np.bincount(origem, minlength=len(envios))
+        falhou = bool(lote['erros_por_motivo'])
+        
+        with self.cond:
+            estatisticas = self.estatisticas_
+            estatisticas['micro_lotes'] += 1
+            estatisticas['salvos'] += lote['salvos']
+            estatisticas['atualizadas'] += lote['atualizadas']
+            estatisticas['duplicatas'] += lote['duplicatas'] + int(repetidas.sum())
+            estatisticas['em_spool'] += lote['em_spool']
+            estatisticas['falhas'] += int(falhou)
+            estatisticas['ultimo_micro_lote'] = {'linhas': len(validas) + int(repetidas.sum()), 'envios': len(envios),
+                                                 'segundos': round(time.time() - inicio, 3), 'em': time.time()}
+        print(f"⚡ Ingestão contínua {lote['batch_id']}: {len(envios)} envios, {len(validas)} AWBs "
+              f"({lote['salvos']} novas, {lote['atualizadas']} atualizadas, {lote['em_spool']} no spool)")
+        
+        resumos = []
+        for i in range(len(envios)):
+            resumos.append({
+                'micro_lote': lote['batch_id'],
+                'duravel': not falhou,
+                'awbs_novas': int(novas[i]),
+                'awbs_alteradas': int(alteradas[i]),
+                'duplicatas_no_banco': int(validas_por_envio[i] - novas[i] - alteradas[i] - em_spool[i] - com_falha[i]),
+                'repetidas_no_micro_lote': int(repetidas[i]),
+                'linhas_em_spool': int(em_spool[i])
+            })
+        return resumos
+    
+    def estatisticas(self):
+        with self.cond:
+            return {**self.estatisticas_, 'linhas_pendentes': self.linhas_pendentes,
+                    'lote_linhas': INGESTAO_LOTE_LINHAS, 'lote_espera': INGESTAO_LOTE_ESPERA}
+
+ingestao_continua = IngestaoContinua()
+
+def criar_job_upload(file_path, nome_arquivo, descritor=None, fonte_delta=None, arquivos=None):
+    """Enfileira o processamento de um arquivo e retorna o ID do job (None se a fila estiver cheia).
+    
+    Com `arquivos` ({'file_path', 'upload'} de cada um), o job processa o lote inteiro e file_path é o diretório do lote.
+    """
+    with upload_jobs_lock:
+        pendentes = sum(1 for job in upload_jobs.values() if job['status'] in ('queued', 'running'))
+        if pendentes >= UPLOAD_JOB_MAX_FILA:
+            return None
+        
+        job_id = uuid.uuid4().hex
+        upload_jobs[job_id] = {
+            'job_id': job_id,
+            'arquivo': nome_arquivo,
+            'upload': descritor,
+            'arquivos': arquivos,
+            'fonte_delta': fonte_delta,
+            'status': 'queued',
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+    
+    # Checkpoint em disco desde a fila: um restart retoma o job mesmo antes de ele começar
+    checkpoint = CheckpointJob.criar(job_id, arquivo=nome_arquivo, file_path=file_path, upload=descritor, arquivos=arquivos,
+                                     fonte_delta=fonte_delta, created_at=upload_jobs[job_id]['created_at'])
+    upload_job_executor.submit(executar_job_upload, job_id, file_path, checkpoint, reservar_job(job_id))
+    return job_id
+
+def job_pendente_por_hash(sha256):
+    """ID do job na fila ou em execução para um arquivo com o mesmo conteúdo (None se não houver)"""
+    with upload_jobs_lock:
+        for job in upload_jobs.values():
+            if job['status'] not in ('queued', 'running'):
+                continue
+            descritores = [job.get('upload')] + [arquivo['upload'] for arquivo in job.get('arquivos') or []]
+            if any((descritor or {}).get('sha256') == sha256 for descritor in descritores):
+                return job['job_id']
+    return None
+
+def executar_job_upload(job_id, file_path, checkpoint=None, trava=None):
+    """Executa um job de upload no pool de background e registra o resultado"""
+    with upload_jobs_lock:
+        upload_jobs[job_id].update({'status': 'running', 'started_at': datetime.now().isoformat()})
+        descritor = upload_jobs[job_id].get('upload')
+        arquivos = upload_jobs[job_id].get('arquivos')
+        fonte_delta = upload_jobs[job_id].get('fonte_delta')
+    
+    if job_cancelado(job_id):
+        resultado = {'success': False, 'cancelado': True, 'error': 'Cancelado pelo usuário antes do início do processamento'}
+    elif encerramento_solicitado.is_set():
+        # Servidor encerrando antes de o job começar: fica para a retomada no próximo boot
+        resultado = {'success': False, 'interrompido': True, 'error': 'Encerramento do servidor antes do início do processamento'}
+    else:
+        try:
+            if checkpoint:
+                checkpoint.atualizar(status='running')
+            if arquivos:
+                resultado = processar_arquivos_pro_tier(arquivos, job_id, fonte_delta, checkpoint)
+            else:
+                resultado = processar_csv_pro_tier(file_path, job_id, descritor, fonte_delta, checkpoint)
+        except Exception as e:
+            resultado = {'success': False, 'error': str(e)}
+    
+    interrompido = resultado.get('interrompido', False)
+    if interrompido:
+        # Arquivo e checkpoint ficam em disco para retomar do último chunk confirmado
+        if checkpoint:
+            checkpoint.atualizar(status='interrupted')
+    else:
+        # Limpar arquivo temporário (ou o diretório do lote)
+        try:
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path, ignore_errors=True)
+            else:
+                os.remove(file_path)
+        except:
+            pass
+        if checkpoint:
+            checkpoint.remover()
+    if trava:
+        trava.close()
+    
+    # Só entra no registro o que chegou inteiro ao banco (ou ao spool): com falha_*, o reenvio do mesmo
+    # arquivo precisa processar de novo, não devolver o resultado anterior
+    if resultado.get('success') and descritor and descritor.get('sha256') and not linhas_com_falha(resultado['data'].get('erros_por_motivo')):
+        registrar_upload_processado(descritor, job_id, resultado.get('data'))
+    if resultado.get('success') and arquivos:
+        # Cada arquivo do lote entra no registro com o seu próprio resumo
+        for arquivo, resumo in zip(arquivos, resultado['data']['arquivos']):
+            if (arquivo.get('upload') or {}).get('sha256') and not linhas_com_falha(resumo.get('erros_por_motivo')):
+                registrar_upload_processado(arquivo['upload'], job_id, resumo)
+    
+    with upload_jobs_lock:
+        upload_jobs_cancelamentos.pop(job_id, None)
+        if resultado.get('cancelado'):
+            status = 'canceled'
+        elif interrompido:
+            status = 'interrupted'
+        else:
+            status = 'done' if resultado.get('success') else 'failed'
+        upload_jobs[job_id].update({
+            'status': status,
+            'finished_at': datetime.now().isoformat(),
+            'finished_ts': time.time(),
+            'result': resultado.get('data'),
+            'error': resultado.get('error')
+        })
+    print(f"📋 Job {job_id}: {upload_jobs[job_id]['status']}")
+
+def job_cancelado(job_id):
+    """Cancelamento pedido neste processo ou, por marcador em disco, em outro worker"""
+    evento = upload_jobs_cancelamentos.get(job_id)
+    if evento is not None and evento.is_set():
+        return True
+    return os.path.exists(os.path.join(JOBS_FOLDER, f'{job_id}.cancel'))
+
+def cancelar_job_upload(job_id):
+    """Pede o cancelamento cooperativo de um job; retorna o status do job (None se não existir)"""
+    with upload_jobs_lock:
+        job = upload_jobs.get(job_id)
+        if job:
+            if job['status'] not in ('queued', 'running'):
+                return job['status']
+            upload_jobs_cancelamentos.setdefault(job_id, threading.Event()).set()
+            job['cancel_requested_at'] = datetime.now().isoformat()
+            return job['status']
+    
+    # Job de outro worker do mesmo servidor: marcador ao lado do checkpoint, verificado a cada chunk
+    if os.path.exists(os.path.join(JOBS_FOLDER, f'{job_id}.json')):
+        open(os.path.join(JOBS_FOLDER, f'{job_id}.cancel'), 'w').close()
+        return 'running'
+    return None
+
+def retomar_jobs_interrompidos():
+    """No boot, reenfileira os jobs com checkpoint em disco (restart no meio do processamento ou na fila)"""
+    for nome in sorted(os.listdir(JOBS_FOLDER)):
+        if not nome.endswith('.json'):
+            continue
+        try:
+            checkpoint = CheckpointJob.carregar(os.path.join(JOBS_FOLDER, nome))
+        except Exception as e:
+            print(f"⚠️ Checkpoint ilegível {nome}: {e}")
+            continue
+        
+        dados = checkpoint.dados
+        job_id = dados['job_id']
+        with upload_jobs_lock:
+            if job_id in upload_jobs:
+                continue
+        if not os.path.exists(dados['file_path']):
+            print(f"⚠️ Job {job_id}: arquivo {dados['file_path']} não existe mais, checkpoint descartado")
+            checkpoint.remover()
+            continue
+        
+        trava = reservar_job(job_id)
+        if not trava:
+            continue  # Outro worker já está executando este job
+        
+        with upload_jobs_lock:
+            upload_jobs[job_id] = {
+                'job_id': job_id,
+                'arquivo': dados.get('arquivo'),
+                'upload': dados.get('upload'),
+                'arquivos': dados.get('arquivos'),
+                'fonte_delta': dados.get('fonte_delta'),
+                'status': 'queued',
+                'retomado': True,
+                'created_at': dados.get('created_at') or datetime.now().isoformat(),
+                'started_at': None,
+                'finished_at': None,
+                'result': None,
+                'error': None
+            }
+        upload_job_executor.submit(executar_job_upload, job_id, dados['file_path'], checkpoint, trava)
+        print(f"♻️ Job {job_id} retomado a partir do chunk {dados['confirmados_ate'] + 1}")
+
+def solicitar_encerramento(signum, frame):
+    """SIGTERM: para de ler chunks novos, deixa os em andamento terminarem e mantém os checkpoints"""
+    if not encerramento_solicitado.is_set():
+        print("🛑 SIGTERM recebido: drenando uploads em andamento e gravando checkpoints...")
+    encerramento_solicitado.set()
+    
+    # Encadeia o handler anterior (ex.: o do worker do gunicorn); sem handler, encerra o processo
+    if callable(sigterm_anterior):
+        sigterm_anterior(signum, frame)
+    elif sigterm_anterior != signal.SIG_IGN:
+        raise SystemExit(128 + signum)
+
+def reenviar_spool_em_background():
+    """Drena o spool sempre que houver lotes pendentes, com backoff exponencial enquanto o banco falhar"""
+    intervalo = SPOOL_REPLAY_INTERVALO
+    while not encerramento_solicitado.wait(intervalo):
+        if not (supabase or pg_pool) or not spool_escrita.pendente():
+            intervalo = SPOOL_REPLAY_INTERVALO
+            continue
+        try:
+            reenviadas = spool_escrita.drenar()
+            if reenviadas:
+                print(f"📤 Spool: {reenviadas} linhas reenviadas ao banco")
+            intervalo = SPOOL_REPLAY_INTERVALO
+        except Exception as e:
+            intervalo = min(SPOOL_REPLAY_INTERVALO_MAX, intervalo * 2)
+            print(f"⚠️ Spool: reenvio falhou ({e}), nova tentativa em {intervalo}s")
+
+def consultar_job_upload(job_id):
+    """Retorna uma cópia do estado do job (None se não existir)"""
+    with upload_jobs_lock:
+        job = upload_jobs.get(job_id)
+        return dict(job) if job else None
+
+def consultar_upload_processado(sha256):
+    """Busca um upload já processado pelo hash do conteúdo (memória local, depois Supabase)"""
+    with uploads_processados_lock:
+        registro = uploads_processados.get(sha256)
+    if registro:
+        return dict(registro)
+    
+    if supabase:
+        try:
+            response = supabase.table(UPLOADS_PROCESSADOS_TABELA).select('*').eq('content_hash', sha256).limit(1).execute()
+            if response.data:
+                registro = response.data[0]
+                with uploads_processados_lock:
+                    uploads_processados[sha256] = registro
+                return dict(registro)
+        except Exception as e:
+            print(f"⚠️ Erro ao consultar registro de uploads: {e}")
+    
+    return None
+
+def registrar_upload_processado(descritor, job_id, resultado):
+    """Grava o resumo do processamento de um arquivo, indexado pelo hash do conteúdo"""
+    registro = {
+        'content_hash': descritor['sha256'],
+        'arquivo': descritor.get('arquivo'),
+        'tamanho_bytes': descritor.get('tamanho_bytes'),
+        'total_linhas': descritor.get('total_linhas'),
+        'job_id': job_id,
+        'resultado': resultado,
+        'processado_em': datetime.now().isoformat()
+    }
+    with uploads_processados_lock:
+        uploads_processados[registro['content_hash']] = registro
+    
+    if supabase:
+        try:
+            supabase.table(UPLOADS_PROCESSADOS_TABELA).upsert(registro, on_conflict='content_hash').execute()
+        except Exception as e:
+            print(f"⚠️ Erro ao gravar registro de uploads: {e}")
+
+def listar_awbs_upload(upload_id):
+    """ids (em ordem) e AWBs das linhas não pagas que o upload inseriu, mais quantas dele já estão pagas"""
+    ids, awbs, pagas = [], [], 0
+    if pg_pool:
+        conn = pg_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT id, awb, status = 'PAGA' FROM awbs WHERE upload_id = %s ORDER BY id", (upload_id,))
+                while True:
+                    linhas = cursor.fetchmany(50000)
+                    if not linhas:
+                        break
+                    for id_awb, awb, paga in linhas:
+                        if paga:
+                            pagas += 1
+                        else:
+                            ids.append(id_awb)
+                            awbs.append(awb)
+            conn.commit()
+        finally:
+            pg_pool.putconn(conn)
+    else:
+        ultimo_id = 0
+        while True:
+            response = (supabase.table('awbs').select('id, awb, status').eq('upload_id', upload_id)
+                        .gt('id', ultimo_id).order('id').limit(1000).execute())
+            if not response.data:
+                break
+            for item in response.data:
+                if item.get('status') == 'PAGA':
+                    pagas += 1
+                else:
+                    ids.append(item['id'])
+                    awbs.append(item['awb'])
+            ultimo_id = response.data[-1]['id']
+    return np.asarray(ids, dtype=np.int64), np.asarray(awbs, dtype=object), pagas
+
+def apagar_awbs_faixa(upload_id, id_inicial, id_final):
+    """Um DELETE por conjunto: as AWBs não pagas do upload na faixa de ids; retorna as linhas apagadas"""
+    if pg_pool:
+        conn = pg_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM awbs
+                    WHERE upload_id = %s AND id BETWEEN %s AND %s AND status IS DISTINCT FROM 'PAGA';
+                """, (upload_id, id_inicial, id_final))
+                apagadas = cursor.rowcount
+            conn.commit()
+            return apagadas
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pg_pool.putconn(conn)
+    
+    response = (supabase.table('awbs').delete().eq('upload_id', upload_id).gte('id', id_inicial).lte('id', id_final)
+                .neq('status', 'PAGA').execute())
+    return len(response.data or [])
+
+def restaurar_alteracoes_copy(upload_id):
+    """Restaura, num único UPDATE ... FROM, o estado anterior das AWBs que o upload alterou.
+    
+    Vale o estado de antes da 1ª alteração do upload, e só onde a AWB ainda está como o upload a deixou.
+    Retorna (DataFrame awb/tipo_servico/data_entrega restaurados, AWBs alteradas pelo upload).
+    """
+    conn = pg_pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                WITH anteriores AS (
+                    SELECT DISTINCT ON (awb) awb, tipo_servico, data_entrega, valor_entrega
+                    FROM {ALTERACOES_TABELA} WHERE upload_id = %(upload_id)s ORDER BY awb, id
+                ), gravados AS (
+                    SELECT DISTINCT ON (awb) awb, tipo_servico_novo, data_entrega_nova
+                    FROM {ALTERACOES_TABELA} WHERE upload_id = %(upload_id)s ORDER BY awb, id DESC
+                )
+                UPDATE awbs a
+                SET tipo_servico = p.tipo_servico, data_entrega = p.data_entrega, valor_entrega = p.valor_entrega
+                FROM anteriores p JOIN gravados g ON g.awb = p.awb
+                WHERE a.awb = p.awb AND a.status IS DISTINCT FROM 'PAGA'
+                  AND a.tipo_servico IS NOT DISTINCT FROM g.tipo_servico_novo
+                  AND a.data_entrega IS NOT DISTINCT FROM g.data_entrega_nova
+                RETURNING a.awb, a.tipo_servico, a.data_entrega;
+            """, {'upload_id': upload_id})
+            restauradas = pd.DataFrame(cursor.fetchall(), columns=['awb', 'tipo_servico', 'data_entrega'])
+            cursor.execute(f"SELECT count(DISTINCT awb) FROM {ALTERACOES_TABELA} WHERE upload_id = %s", (upload_id,))
+            alteradas = cursor.fetchone()[0]
+            cursor.execute(f"DELETE FROM {ALTERACOES_TABELA} WHERE upload_id = %s", (upload_id,))
+        conn.commit()
+        return restauradas, alteradas
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg_pool.putconn(conn)
+
+def restaurar_alteracoes_rest(upload_id):
+    """restaurar_alteracoes_copy via REST: um UPDATE ... WHERE awb IN (...) por estado anterior, em lotes"""
+    registros = []
+    ultimo_id = 0
+    while True:
+        response = (supabase.table(ALTERACOES_TABELA).select('*').eq('upload_id', upload_id)
+                    .gt('id', ultimo_id).order('id').limit(1000).execute())
+        if not response.data:
+            break
+        registros.extend(response.data)
+        ultimo_id = response.data[-1]['id']
+    if not registros:
+        return pd.DataFrame(columns=['awb', 'tipo_servico', 'data_entrega']), 0
+    
+    alteracoes = pd.DataFrame(registros)
+    anteriores = alteracoes.drop_duplicates('awb', keep='first').set_index('awb')
+    gravados = alteracoes.drop_duplicates('awb', keep='last').set_index('awb')
+    awbs = anteriores.index.tolist()
+    restauradas = []
+    for i in range(0, len(awbs), controlador_escrita.batch_size):
+        lote = awbs[i:i+controlador_escrita.batch_size]
+        response = supabase.table('awbs').select('awb, tipo_servico, data_entrega').in_('awb', lote).neq('status', 'PAGA').execute()
+        atuais = pd.DataFrame(response.data or [], columns=['awb', 'tipo_servico', 'data_entrega'])
+        if atuais.empty:
+            continue
+        
+        # Só as AWBs que ninguém alterou depois do upload
+        esperados = gravados.loc[atuais['awb']]
+        intactas = (fingerprint_estados(atuais['tipo_servico'].to_numpy(), atuais['data_entrega'].to_numpy())
+                    == fingerprint_estados(esperados['tipo_servico_novo'].to_numpy(), esperados['data_entrega_nova'].to_numpy()))
+        restaurar = anteriores.loc[atuais['awb'][intactas]].reset_index()
+        if not restaurar.empty:
+            atualizar_lote_awbs(restaurar)
+        restauradas.append(restaurar[['awb', 'tipo_servico', 'data_entrega']])
+    
+    supabase.table(ALTERACOES_TABELA).delete().eq('upload_id', upload_id).execute()
+    restauradas = pd.concat(restauradas, ignore_index=True) if restauradas else pd.DataFrame(columns=['awb', 'tipo_servico', 'data_entrega'])
+    return restauradas, len(awbs)
+
+def esquecer_upload_processado(upload_id):
+    """Tira do registro de uploads processados os arquivos do upload (reenviá-los volta a processar);
+    fontes delta do upload perdem os fingerprints, e o próximo arquivo da fonte é processado completo"""
+    with uploads_processados_lock:
+        registros = [uploads_processados.pop(chave) for chave, registro in list(uploads_processados.items())
+                     if registro.get('job_id') == upload_id]
+    if supabase:
+        try:
+            response = supabase.table(UPLOADS_PROCESSADOS_TABELA).delete().eq('job_id', upload_id).execute()
+            registros.extend(response.data or [])
+        except Exception as e:
+            print(f"⚠️ Erro ao limpar registro de uploads: {e}")
+    
+    fontes = {(registro.get('resultado') or {}).get('fonte_delta') for registro in registros}
+    fontes.add((consultar_job_upload(upload_id) or {}).get('fonte_delta'))
+    for fonte in fontes - {None}:
+        with fingerprints_fontes_lock:
+            try:
+                os.remove(_arquivo_fingerprints_fonte(fonte))
+            except FileNotFoundError:
+                pass
+    return len({registro.get('content_hash') for registro in registros})
+
+def reverter_upload(upload_id):
+    """Desfaz um upload (job ou micro-lote de ingestão): apaga as AWBs que ele inseriu e restaura as que ele alterou.
+    
+    Operações por conjunto: um DELETE por faixa de REVERSAO_LOTE ids e um UPDATE para os estados anteriores.
+    AWBs pagas não são tocadas, nem as alteradas de novo depois do upload. As AWBs saem do índice antes
+    de sair do banco: no intervalo o índice só deixa de conhecê-las (o insert com ON CONFLICT cobre),
+    nunca aponta como existente uma AWB já apagada.
+    """
+    inicio = time.time()
+    ids, awbs, pagas = listar_awbs_upload(upload_id)
+    if len(awbs):
+        cache_awbs_existentes.remover(awbs)
+    
+    operacoes = [(apagar_awbs_faixa, (upload_id, int(ids[i]), int(ids[min(i + REVERSAO_LOTE, len(ids)) - 1])))
+                 for i in range(0, len(ids), REVERSAO_LOTE)]
+    operacoes.append((restaurar_alteracoes_copy if pg_pool else restaurar_alteracoes_rest, (upload_id,)))
+    
+    apagadas = 0
+    for funcao, argumentos in operacoes:
+        for tentativa in range(MAX_RETRIES):
+            controlador_escrita.adquirir()
+            inicio_operacao = time.time()
+            try:
+                resultado = funcao(*argumentos)
+                controlador_escrita.registrar(time.time() - inicio_operacao, True)
+                break
+            except Exception as e:
+                controlador_escrita.registrar(time.time() - inicio_operacao, False)
+                if tentativa < MAX_RETRIES - 1:
+                    time.sleep((tentativa + 1) * 0.1)
+                else:
+                    print(f"❌ Erro ao reverter o upload {upload_id} após {MAX_RETRIES} tentativas: {e}")
+                    raise e
+            finally:
+                controlador_escrita.liberar()
+        if funcao is apagar_awbs_faixa:
+            apagadas += resultado
+    
+    restauradas, alteradas = resultado
+    if not restauradas.empty:
+        estados = fingerprint_estados(restauradas['tipo_servico'].to_numpy(), restauradas['data_entrega'].to_numpy())
+        cache_awbs_existentes.adicionar(restauradas['awb'].to_numpy(), estados)
+    arquivos = esquecer_upload_processado(upload_id)
+    
+    tempo = time.time() - inicio
+    print(f"⏪ Upload {upload_id} revertido em {tempo:.2f}s: {apagadas} AWBs apagadas, {len(restauradas)}/{alteradas} restauradas")
+    return {
+        'upload_id': upload_id,
+        'awbs_apagadas': apagadas,
+        'awbs_pagas_mantidas': pagas + len(awbs) - apagadas,  # Inclui as pagas entre a listagem e o DELETE
+        'awbs_restauradas': len(restauradas),
+        'awbs_nao_restauradas': alteradas - len(restauradas),  # Pagas, apagadas ou alteradas de novo depois do upload
+        'arquivos_liberados': arquivos,
+        'tempo_reversao': round(tempo, 2)
+    }
+
+sigterm_anterior = None
+servicos_iniciados = False
+
+def iniciar_servicos(retomar_jobs=None, reenvio_spool=True):
+    """Inicialização do servidor (chamada pelo wsgi.py, nunca na importação do módulo): confere o esquema do banco,
+    instala a drenagem no SIGTERM, retoma os jobs interrompidos e inicia o reenvio do spool em background"""
+    global sigterm_anterior, servicos_iniciados
+    if PROCESSO_AUXILIAR or servicos_iniciados:
+        return
+    servicos_iniciados = True
+    verificar_linhagem_uploads()
+    verificar_atualizacao_em_lote()
+    if threading.current_thread() is threading.main_thread():
+        sigterm_anterior = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, solicitar_encerramento)
+    if RETOMAR_JOBS if retomar_jobs is None else retomar_jobs:
+        retomar_jobs_interrompidos()
+    if reenvio_spool:
+        threading.Thread(target=reenviar_spool_em_background, name='spool-reenvio', daemon=True).start()
+
 # ROTAS DA API OTIMIZADAS PARA PRO TIER
 
 @app.route('/')
@@ -519,14 +3864,18 @@ def api_status():
         'data': {
             'supabase_connected': supabase is not None,
             'supabase_url': SUPABASE_URL is not None,
+            'postgres_copy': pg_pool is not None,
             'version': 'v7.8 PRO TIER',
-            'processing_active': processing_status['active'],
+            'processing_active': uploads_ativos() > 0,
+            'uploads_ativos': uploads_ativos(),
             'tier': 'PRO ($25/mês)',
             'optimization_level': 'Performance Máxima',
-            'batch_size': BATCH_SIZE,
-            'max_workers': MAX_WORKERS,
+            'batch_size': controlador_escrita.batch_size,
+            'max_workers': controlador_escrita.limite_escritas,
             'chunk_size': CHUNK_SIZE,
-            'cache_duration': f'{CACHE_DURATION//60} minutos'
+            'cache_duration': f'{CACHE_DURATION//60} minutos',
+            'spool': spool_escrita.estatisticas(),
+            'ingestao_continua': ingestao_continua.estatisticas()
         }
     })
 
@@ -574,6 +3923,8 @@ def api_estatisticas():
                 'valor_total': round(valor_total, 2),
                 'supabase_connected': supabase is not None,
                 'awbs_cache_size': len(cache_awbs_existentes),
+                'awbs_cache_memoria': cache_awbs_existentes.estatisticas(),
+                'awbs_cache_watermark': cache_awbs_sync['watermark'],
                 'tier': 'PRO'
             }
         })
@@ -681,9 +4032,63 @@ def api_awbs():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/awbs/eventos', methods=['POST'])
+def api_awbs_eventos():
+    """Ingestão contínua de eventos de AWB (NDJSON ou CSV no corpo, pequeno ou em streaming), agrupados em micro-lotes.
+    
+    Responde quando todas as linhas do envio estão gravadas no banco ou no spool em disco (503 se alguma não ficou).
+    """
+    if not (supabase or pg_pool):
+        return jsonify({'success': False, 'error': 'Supabase não conectado'}), 503
+    
+    try:
+        motoristas, tarifas = carregar_dados_supabase_pro()
+        formato = 'csv' if 'csv' in (request.mimetype or '') or request.args.get('formato') == 'csv' else 'ndjson'
+        resultado = {'linhas': 0, 'entregas_processadas': 0, 'entregas_erro': 0, 'erros_por_motivo': {},
+                     'awbs_novas': 0, 'awbs_alteradas': 0, 'duplicatas_no_banco': 0, 'repetidas_no_micro_lote': 0,
+                     'linhas_em_spool': 0, 'micro_lotes': [], 'duravel': True}
+        
+        # Validação e tarifa no próprio request, à medida que o corpo chega; a gravação é da thread de micro-lotes
+        futuros = []
+        for chunk, ilegiveis in ler_eventos_em_blocos(request.stream, formato):
+            validas, erros_por_motivo = transformar_chunk_pro(chunk, motoristas, tarifas)
+            if ilegiveis:
+                erros_por_motivo['evento_invalido'] = ilegiveis
+            for motivo, quantidade in erros_por_motivo.items():
+                if quantidade:
+                    resultado['erros_por_motivo'][motivo] = resultado['erros_por_motivo'].get(motivo, 0) + quantidade
+            resultado['linhas'] += len(chunk) + ilegiveis
+            resultado['entregas_processadas'] += len(validas)
+            resultado['entregas_erro'] += sum(erros_por_motivo.values())
+            if not validas.empty:
+                futuros.append(ingestao_continua.enviar(validas))
+        
+        for futuro in futuros:
+            resumo = futuro.result(timeout=INGESTAO_TIMEOUT)
+            for campo in ('awbs_novas', 'awbs_alteradas', 'duplicatas_no_banco', 'repetidas_no_micro_lote', 'linhas_em_spool'):
+                resultado[campo] += resumo[campo]
+            if resumo['micro_lote'] not in resultado['micro_lotes']:
+                resultado['micro_lotes'].append(resumo['micro_lote'])
+            resultado['duravel'] = resultado['duravel'] and resumo['duravel']
+        
+        if not resultado['duravel']:
+            return jsonify({'success': False, 'error': 'Parte dos eventos não foi gravada (banco e spool indisponíveis), reenvie',
+                            'data': resultado}), 503
+        return jsonify({
+            'success': True,
+            'data': resultado,
+            'message': f"PRO TIER: {resultado['entregas_processadas']} eventos gravados em {len(resultado['micro_lotes'])} micro-lote(s)"
+        })
+        
+    except (TimeoutError, FuturoExpirado) as e:
+        return jsonify({'success': False, 'error': str(e) or 'Tempo esgotado aguardando a gravação, reenvie'}), 503
+    except Exception as e:
+        # Sem a confirmação da gravação o cliente precisa reenviar: nunca 200
+        return jsonify({'success': False, 'error': str(e)}), 503
+
 @app.route('/api/upload', methods=['POST'])
 def api_upload():
-    """Upload de arquivo CSV otimizado para Pro tier"""
+    """Upload de arquivo CSV ou planilha (xlsx/xls) otimizado para Pro tier"""
     try:
         if 'file' not in request.files:
             return jsonify({'success': False, 'error': 'Nenhum arquivo enviado'})
@@ -698,34 +4103,267 @@ def api_upload():
         # Salvar arquivo
         filename = secure_filename(file.filename)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{filename}"
+        filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{filename}"
         file_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(file_path)
+        descritor = receber_upload(file.stream, file_path, file.filename)
+        
+        # Arquivo idêntico já processado (ou em processamento): não reprocessar, salvo com force=1
+        forcar = request.values.get('force', '').lower() in ('1', 'true', 'sim')
+        if not forcar:
+            anterior = consultar_upload_processado(descritor['sha256'])
+            job_em_andamento = None if anterior else job_pendente_por_hash(descritor['sha256'])
+            if anterior or job_em_andamento:
+                try:
+                    os.remove(file_path)
+                except:
+                    pass
+            
+            if anterior:
+                return jsonify({
+                    'success': True,
+                    'data': {
+                        'job_id': anterior.get('job_id'),
+                        'status': 'done',
+                        'upload_duplicado': True,
+                        'processado_em': anterior.get('processado_em'),
+                        'result': anterior.get('resultado'),
+                        'upload': descritor
+                    },
+                    'message': f"PRO TIER: Arquivo idêntico já processado em {anterior.get('processado_em')}, resultado anterior reaproveitado (envie force=1 para reprocessar)"
+                })
+            if job_em_andamento:
+                return jsonify({
+                    'success': True,
+                    'data': {
+                        'job_id': job_em_andamento,
+                        'status': (consultar_job_upload(job_em_andamento) or {}).get('status', 'queued'),
+                        'upload_duplicado': True,
+                        'upload': descritor
+                    },
+                    'message': 'PRO TIER: Arquivo idêntico já está em processamento'
+                }), 202
         
-        # Processar com performance Pro tier
-        def processar_async():
-            return processar_csv_pro_tier(file_path)
+        # Ingestão delta (delta=1): só as linhas novas ou alteradas desde o último upload da mesma fonte
+        fonte_delta = None
+        if request.values.get('delta', '').lower() in ('1', 'true', 'sim'):
+            fonte_delta = request.values.get('fonte', '').strip() or 'padrao'
         
-        # Executar processamento
-        resultado = processar_async()
+        # Processar em background: a requisição retorna o ID do job imediatamente
+        job_id = criar_job_upload(file_path, file.filename, descritor, fonte_delta)
+        if not job_id:
+            try:
+                os.remove(file_path)
+            except:
+                pass
+            return jsonify({'success': False, 'error': 'Fila de processamento cheia, tente novamente em instantes'}), 429
         
-        # Limpar arquivo temporário
-        try:
-            os.remove(file_path)
-        except:
-            pass
+        return jsonify({
+            'success': True,
+            'data': {
+                'job_id': job_id,
+                'status': 'queued',
+                'upload': descritor
+            },
+            'message': 'PRO TIER: Arquivo recebido, processamento iniciado em background'
+        }), 202
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/upload/lote', methods=['POST'])
+def api_upload_lote():
+    """Upload de vários arquivos (campo files, ou um .zip) processados em um único job, com relatório consolidado"""
+    diretorio = None
+    try:
+        enviados = request.files.getlist('files') or request.files.getlist('file')
+        if not enviados:
+            return jsonify({'success': False, 'error': 'Nenhum arquivo enviado'})
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        diretorio = os.path.join(UPLOAD_FOLDER, f"lote_{timestamp}_{uuid.uuid4().hex[:8]}")
+        os.makedirs(diretorio)
+        forcar = request.values.get('force', '').lower() in ('1', 'true', 'sim')
+        arquivos = []
+        ignorados = []
+        hashes = set()
+        
+        def receber(stream, nome):
+            file_path = os.path.join(diretorio, f"{len(arquivos) + len(ignorados):05d}_{secure_filename(nome)}")
+            descritor = receber_upload(stream, file_path, nome)
+            
+            # Arquivo repetido no próprio lote ou já processado antes (salvo com force=1): fica de fora
+            motivo = None
+            if descritor['sha256'] in hashes:
+                motivo = 'Arquivo repetido no lote'
+            elif not forcar:
+                anterior = consultar_upload_processado(descritor['sha256'])
+                if anterior:
+                    motivo = f"Arquivo idêntico já processado em {anterior.get('processado_em')}"
+                elif job_pendente_por_hash(descritor['sha256']):
+                    motivo = 'Arquivo idêntico já está em processamento'
+            if motivo:
+                os.remove(file_path)
+                ignorados.append({'arquivo': nome, 'motivo': motivo, 'upload_duplicado': True})
+                return
+            hashes.add(descritor['sha256'])
+            arquivos.append({'file_path': file_path, 'upload': descritor})
         
-        return jsonify(resultado)
+        for enviado in enviados:
+            if enviado.filename.lower().endswith('.zip'):
+                with zipfile.ZipFile(enviado.stream) as pacote:
+                    recusa = validar_pacote_zip(pacote)
+                    if recusa:
+                        shutil.rmtree(diretorio, ignore_errors=True)
+                        return jsonify({'success': False, 'error': f'{enviado.filename}: {recusa}'}), 400
+                    for membro in pacote.infolist():
+                        # Só o nome do arquivo (sem as pastas do zip), e só os tipos aceitos no upload
+                        nome = os.path.basename(membro.filename)
+                        if membro.is_dir() or not nome or nome.startswith('.'):
+                            continue
+                        if not allowed_file(nome):
+                            ignorados.append({'arquivo': membro.filename, 'motivo': 'Tipo de arquivo não permitido'})
+                            continue
+                        with pacote.open(membro) as origem:
+                            receber(origem, nome)
+            elif allowed_file(enviado.filename):
+                receber(enviado.stream, enviado.filename)
+            else:
+                ignorados.append({'arquivo': enviado.filename, 'motivo': 'Tipo de arquivo não permitido'})
+        
+        if not arquivos:
+            shutil.rmtree(diretorio, ignore_errors=True)
+            return jsonify({'success': False, 'error': 'Nenhum arquivo novo para processar', 'data': {'ignorados': ignorados}})
+        
+        # Ordem dos nomes (arquivos diários em ordem cronológica): no mesmo pipeline, o dia mais recente prevalece
+        arquivos.sort(key=lambda arquivo: arquivo['upload']['arquivo'])
+        
+        fonte_delta = None
+        if request.values.get('delta', '').lower() in ('1', 'true', 'sim'):
+            fonte_delta = request.values.get('fonte', '').strip() or 'padrao'
+        
+        job_id = criar_job_upload(diretorio, f'{len(arquivos)} arquivos', None, fonte_delta, arquivos=arquivos)
+        if not job_id:
+            shutil.rmtree(diretorio, ignore_errors=True)
+            return jsonify({'success': False, 'error': 'Fila de processamento cheia, tente novamente em instantes'}), 429
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'job_id': job_id,
+                'status': 'queued',
+                'arquivos': [arquivo['upload'] for arquivo in arquivos],
+                'total_linhas': sum(arquivo['upload']['total_linhas'] or 0 for arquivo in arquivos),
+                'ignorados': ignorados
+            },
+            'message': f'PRO TIER: {len(arquivos)} arquivos recebidos, processamento do lote iniciado em background'
+        }), 202
         
     except Exception as e:
+        if diretorio:
+            shutil.rmtree(diretorio, ignore_errors=True)
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/upload/jobs')
+def api_upload_jobs():
+    """Lista os jobs de upload e seus estados"""
+    with upload_jobs_lock:
+        jobs = [dict(job) for job in upload_jobs.values()]
+    
+    return jsonify({
+        'success': True,
+        'data': sorted(jobs, key=lambda job: job['created_at'], reverse=True)
+    })
+
+@app.route('/api/upload/jobs/<job_id>')
+def api_upload_job(job_id):
+    """Estado e resultado de um job de upload"""
+    job = consultar_job_upload(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Job não encontrado'}), 404
+    
+    return jsonify({
+        'success': True,
+        'data': job
+    })
+
+@app.route('/api/upload/jobs/<job_id>/cancel', methods=['POST'])
+def api_upload_job_cancel(job_id):
+    """Cancela um job: para a leitura e o envio de novos lotes; os lotes em gravação terminam"""
+    status = cancelar_job_upload(job_id)
+    if status is None:
+        return jsonify({'success': False, 'error': 'Job não encontrado'}), 404
+    if status not in ('queued', 'running'):
+        return jsonify({'success': False, 'error': f'Job já finalizado ({status})'}), 409
+    
+    return jsonify({
+        'success': True,
+        'data': {
+            'job_id': job_id,
+            'status': 'canceling'
+        },
+        'message': 'Cancelamento solicitado: os lotes já em gravação serão concluídos e o resultado mostrará o que foi gravado'
+    }), 202
+
+@app.route('/api/upload/jobs/<job_id>/rollback', methods=['POST'])
+def api_upload_job_rollback(job_id):
+    """Reverte um upload concluído (job_id, ou o micro_lote de uma ingestão contínua): apaga as AWBs que ele
+    inseriu e restaura as que ele alterou"""
+    if not (supabase or pg_pool):
+        return jsonify({'success': False, 'error': 'Supabase não conectado'}), 503
+    if not LINHAGEM_UPLOADS:
+        return jsonify({'success': False, 'error': 'Linhagem de uploads desativada (LINHAGEM_UPLOADS=0)'}), 400
+    
+    status = (consultar_job_upload(job_id) or {}).get('status')
+    if status in ('queued', 'running') or os.path.exists(os.path.join(JOBS_FOLDER, f'{job_id}.json')):
+        return jsonify({'success': False, 'error': 'Job em andamento: cancele e aguarde o fim antes de reverter'}), 409
+    # Uploads em andamento (em qualquer worker) poderiam reinserir, ou ter ignorado como existente, uma AWB no
+    # meio da reversão; enquanto a reversão segura a trava exclusiva, novas escritas esperam ela terminar
+    trava = reservar_reversao()
+    if trava is None:
+        return jsonify({'success': False, 'error': 'Há uploads em processamento ou outra reversão, tente quando terminarem'}), 409
+    
+    try:
+        # Lotes do upload ainda no spool (em disco, comum aos workers) voltariam ao banco depois da reversão
+        if spool_escrita.pendente():
+            return jsonify({'success': False, 'error': 'Há lotes no spool aguardando reenvio, tente após a drenagem'}), 409
+        resultado = reverter_upload(job_id)
+        with upload_jobs_lock:
+            if job_id in upload_jobs:
+                upload_jobs[job_id].update({'status': 'rolled_back', 'rollback': resultado})
+        return jsonify({
+            'success': True,
+            'data': resultado,
+            'message': f"PRO TIER: Upload revertido - {resultado['awbs_apagadas']} AWBs apagadas, "
+                       f"{resultado['awbs_restauradas']} restauradas"
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        trava.close()  # Fechar o arquivo libera o flock
+
 @app.route('/api/upload/status')
 def api_upload_status():
-    """Status do processamento em tempo real Pro tier"""
+    """Status do processamento em tempo real de um job (?job_id=...; sem ID, o mais recente)"""
+    job_id = request.args.get('job_id', '').strip()
+    progresso = obter_progresso(job_id or None)
+    
+    if not progresso:
+        job = consultar_job_upload(job_id) if job_id else None
+        if job and job['status'] == 'queued':
+            total_linhas = (job.get('upload') or {}).get('total_linhas')
+            return jsonify({'success': True, 'data': {'job_id': job_id, 'active': True, 'progress': 0, 'total_lines': total_linhas or 0,
+                                                      'message': 'PRO: Aguardando na fila de processamento...'}})
+        if job and job['status'] == 'canceled':
+            # Cancelado ainda na fila: nunca criou progresso
+            return jsonify({'success': True, 'data': {'job_id': job_id, 'active': False, 'progress': 0, 'processed_lines': 0, 'errors': 0,
+                                                      'message': 'PRO: Cancelado antes do início', 'performance_stats': {'cancelado': True}}})
+        if job_id:
+            return jsonify({'success': False, 'error': 'Job não encontrado'}), 404
+        return jsonify({'success': True, 'data': {'active': False, 'progress': 0, 'message': ''}})
+    
     return jsonify({
         'success': True,
-        'data': processing_status
+        'data': progresso.snapshot()
     })
 
 @app.route('/api/prestadores/upload', methods=['POST'])
@@ -744,26 +4382,31 @@ def api_prestadores_upload():
         file_path = os.path.join(UPLOAD_FOLDER, f"temp_{filename}")
         file.save(file_path)
         
-        # Processar planilha DE-PARA
-        encoding = detectar_encoding(file_path)
-        
-        if filename.endswith('.csv'):
+        # Processar planilha DE-PARA em chunks (xlsx em streaming, sem montar a planilha inteira em memória)
+        colunas_depara = ['ID do motorista', 'Nome do motorista']
+        if filename.lower().endswith('.csv'):
+            encoding = detectar_encoding(file_path)
             delimitador = detectar_delimitador_csv(file_path, encoding)
-            df = pd.read_csv(file_path, encoding=encoding, delimiter=delimitador)
+            chunks = ler_csv_em_chunks(file_path, encoding, delimitador, colunas_desejadas=colunas_depara)
         else:
-            df = pd.read_excel(file_path)
+            chunks = ler_planilha_em_chunks(file_path, colunas_desejadas=colunas_depara)
         
         # Processar motoristas em lotes (Pro tier suporta)
         motoristas_processados = 0
         motoristas_atualizados = 0
+        total_linhas = 0
         
-        if supabase:
+        for chunk in chunks:
+            total_linhas += len(chunk)
+            if not supabase:
+                continue
+            
             # Preparar dados para upsert em lote
             motoristas_data = []
             
-            for _, row in df.iterrows():
+            for _, row in chunk.iterrows():
                 try:
-                    id_motorista = int(row.get('ID do motorista', 0))
+                    id_motorista = int(float(row.get('ID do motorista', 0)))
                     nome_motorista = str(row.get('Nome do motorista', '')).strip()
                     
                     if id_motorista and nome_motorista:
@@ -781,7 +4424,7 @@ def api_prestadores_upload():
                 try:
                     response = supabase.table('motoristas').upsert(motoristas_data).execute()
                     if response.data:
-                        motoristas_processados = len(response.data)
+                        motoristas_processados += len(response.data)
                 except Exception as e:
                     print(f"Erro no upsert: {e}")
         
@@ -799,7 +4442,7 @@ def api_prestadores_upload():
             'success': True,
             'data': {
                 'motoristas_processados': motoristas_processados,
-                'total_linhas': len(df),
+                'total_linhas': total_linhas,
                 'tier': 'PRO'
             },
             'message': f'PRO TIER: {motoristas_processados} motoristas processados com upsert em lote!'
@@ -886,6 +4529,7 @@ def api_tarifas_update():
         return jsonify({'success': False, 'error': str(e)})
 
 if __name__ == '__main__':
+    iniciar_servicos()
     # Configuração otimizada para Pro tier
     app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
 
@@ -0,0 +1,239 @@
+"""
+Fixtures dos testes: o servidor importado num diretório temporário, sem Supabase nem Postgres,
+e um cliente Supabase falso em memória com o subconjunto do postgrest que o sistema usa.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+
+import pandas as pd
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+# Configuração lida na importação: índice só em memória (a importação não inicia serviços em background)
+os.environ.setdefault('INDICE_AWBS_PERSISTENTE', '0')
+os.chdir(tempfile.mkdtemp(prefix='menezeslog_testes_'))  # uploads/, data/ e static/ são criados na importação
+
+import main_supabase_integrated as m  # noqa: E402
+
+class RespostaFalsa:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+class ConsultaFalsa:
+    """Uma chamada encadeada (table(...).select/insert/upsert/update/delete + filtros + execute)"""
+
+    def __init__(self, banco, tabela):
+        self.banco = banco
+        self.tabela = tabela
+        self.operacao = 'select'
+        self.filtros = []
+        self.dados = None
+        self.opcoes = {}
+        self.contar = False
+        self.ordem = None
+        self.limite = None
+        self.faixa = None
+
+    def select(self, colunas='*', count=None):
+        self.contar = bool(count)
+        return self
+
+    def insert(self, linhas, **opcoes):
+        self.operacao, self.dados, self.opcoes = 'insert', linhas, opcoes
+        return self
+
+    def upsert(self, linhas, **opcoes):
+        self.operacao, self.dados, self.opcoes = 'upsert', linhas, opcoes
+        return self
+
+    def update(self, campos, **opcoes):
+        self.operacao, self.dados = 'update', campos
+        return self
+
+    def delete(self, **opcoes):
+        self.operacao = 'delete'
+        return self
+
+    def _filtro(self, funcao):
+        self.filtros.append(funcao)
+        return self
+
+    def eq(self, coluna, valor):
+        return self._filtro(lambda linha: linha.get(coluna) == valor)
+
+    def neq(self, coluna, valor):
+        return self._filtro(lambda linha: linha.get(coluna) != valor)
+
+    def gt(self, coluna, valor):
+        return self._filtro(lambda linha: linha.get(coluna) is not None and linha[coluna] > valor)
+
+    def gte(self, coluna, valor):
+        return self._filtro(lambda linha: linha.get(coluna) is not None and linha[coluna] >= valor)
+
+    def lte(self, coluna, valor):
+        return self._filtro(lambda linha: linha.get(coluna) is not None and linha[coluna] <= valor)
+
+    def in_(self, coluna, valores):
+        valores = set(valores)
+        return self._filtro(lambda linha: linha.get(coluna) in valores)
+
+    def order(self, coluna, desc=False):
+        self.ordem = (coluna, desc)
+        return self
+
+    def limit(self, quantidade):
+        self.limite = quantidade
+        return self
+
+    def range(self, inicio, fim):
+        self.faixa = (inicio, fim)
+        return self
+
+    def execute(self):
+        with self.banco.lock:
+            self.banco.chamadas.append((self.tabela, self.operacao))
+            if self.banco.fora_do_ar and self.operacao != 'select':
+                raise Exception('connection refused')
+            if self.banco.recusar and self.operacao != 'select':
+                raise self.banco.recusar
+            linhas = self.banco.tabelas.setdefault(self.tabela, [])
+            selecionadas = [linha for linha in linhas if all(filtro(linha) for filtro in self.filtros)]
+
+            if self.operacao == 'select':
+                total = len(selecionadas)
+                if self.ordem:
+                    selecionadas.sort(key=lambda linha: linha[self.ordem[0]], reverse=self.ordem[1])
+                if self.faixa:
+                    selecionadas = selecionadas[self.faixa[0]:self.faixa[1] + 1]
+                if self.limite is not None:
+                    selecionadas = selecionadas[:self.limite]
+                return RespostaFalsa([dict(linha) for linha in selecionadas], total if self.contar else None)
+
+            if self.operacao == 'update':
+                for linha in selecionadas:
+                    linha.update(self.dados)
+                return RespostaFalsa([dict(linha) for linha in selecionadas])
+
+            if self.operacao == 'delete':
+                self.banco.tabelas[self.tabela] = [linha for linha in linhas if linha not in selecionadas]
+                return RespostaFalsa([dict(linha) for linha in selecionadas])
+
+            # insert / upsert: awb é única na tabela awbs
+            chave = self.opcoes.get('on_conflict') or ('awb' if self.tabela == 'awbs' else None)
+            existentes = {linha.get(chave): linha for linha in linhas} if chave else {}
+            novas = self.dados if isinstance(self.dados, list) else [self.dados]
+            if self.operacao == 'insert' and chave and any(nova.get(chave) in existentes for nova in novas):
+                raise Exception('duplicate key value violates unique constraint "awbs_awb_key"')  # Nada é gravado
+            inseridas = []
+            for nova in novas:
+                atual = existentes.get(nova.get(chave)) if chave else None
+                if atual is not None:
+                    if self.opcoes.get('ignore_duplicates'):
+                        continue
+                    atual.update(nova)
+                    inseridas.append(dict(atual))
+                    continue
+                self.banco.sequencia += 1
+                linha = {'id': self.banco.sequencia, **nova}
+                linhas.append(linha)
+                inseridas.append(dict(linha))
+                if chave:
+                    existentes[linha.get(chave)] = linha
+            return RespostaFalsa(inseridas)
+
+class RpcFalsa:
+    """Chamada supabase.rpc(...).execute() das funções do banco que o sistema usa"""
+
+    def __init__(self, banco, nome, parametros):
+        self.banco = banco
+        self.nome = nome
+        self.parametros = parametros
+
+    def execute(self):
+        with self.banco.lock:
+            self.banco.chamadas.append(('rpc', self.nome))
+            if self.nome in self.banco.funcoes_ausentes:
+                raise Exception({'code': 'PGRST202', 'message': f'Could not find the function public.{self.nome}'})
+            if self.banco.fora_do_ar:
+                raise Exception('connection refused')
+            if self.banco.recusar:
+                raise self.banco.recusar
+            return RespostaFalsa(getattr(self, self.nome)(**self.parametros))
+
+    def atualizar_awbs_lote(self, alteracoes, p_upload_id=None):
+        atuais = {linha['awb']: linha for linha in self.banco.tabelas.setdefault('awbs', []) if linha.get('status') != 'PAGA'}
+        atualizadas = []
+        for alteracao in alteracoes:
+            atual = atuais.get(alteracao['awb'])
+            if atual is None:
+                continue
+            if p_upload_id is not None:
+                self.banco.sequencia += 1
+                self.banco.tabelas.setdefault('awbs_alteracoes', []).append({
+                    'id': self.banco.sequencia, 'upload_id': p_upload_id, 'awb': atual['awb'],
+                    'tipo_servico': atual['tipo_servico'], 'data_entrega': atual['data_entrega'],
+                    'valor_entrega': atual['valor_entrega'], 'tipo_servico_novo': alteracao['tipo_servico'],
+                    'data_entrega_nova': alteracao['data_entrega']
+                })
+            atual.update({campo: alteracao[campo] for campo in ('tipo_servico', 'data_entrega', 'valor_entrega')})
+            atualizadas.append({'awb': atual['awb']})
+        return atualizadas
+
+class SupabaseFalso:
+    """Tabelas em memória (listas de dicts); fora_do_ar=True faz toda escrita falhar por conexão,
+    recusar=<exceção> faz o banco recusar toda escrita com ela"""
+
+    def __init__(self):
+        self.tabelas = {}
+        self.sequencia = 0
+        self.chamadas = []
+        self.fora_do_ar = False
+        self.recusar = None
+        self.funcoes_ausentes = set()  # Funções RPC ainda não criadas no banco
+        self.lock = threading.RLock()
+
+    def table(self, nome):
+        return ConsultaFalsa(self, nome)
+
+    def rpc(self, nome, parametros):
+        return RpcFalsa(self, nome, parametros)
+
+    def awbs(self):
+        """Estado atual da tabela awbs por AWB"""
+        return {linha['awb']: linha for linha in self.tabelas.get('awbs', [])}
+
+    def inserir_awbs(self, *awbs):
+        """Grava AWBs já existentes, como (awb, tipo_servico, data_entrega)"""
+        for awb, tipo_servico, data_entrega in awbs:
+            self.sequencia += 1
+            self.tabelas.setdefault('awbs', []).append({
+                'id': self.sequencia, 'empresa_id': 1, 'awb': awb, 'id_motorista': 1, 'nome_motorista': 'Motorista 1',
+                'tipo_servico': tipo_servico, 'data_entrega': data_entrega,
+                'valor_entrega': m.TARIFAS_PADRAO.get(tipo_servico, 0), 'status': 'NAO_PAGA'
+            })
+
+@pytest.fixture
+def banco(monkeypatch, tmp_path):
+    """Supabase falso no lugar do cliente real, com índice de AWBs frio e spool vazio"""
+    falso = SupabaseFalso()
+    falso.tabelas['motoristas'] = [{'id_motorista': i, 'nome_motorista': f'Motorista {i}'} for i in range(1, 6)]
+    monkeypatch.setattr(m, 'supabase', falso)
+    monkeypatch.setattr(m, 'pg_pool', None)
+    monkeypatch.setattr(m, 'cache_awbs_existentes', m.IndiceAWB())
+    monkeypatch.setitem(m.cache_awbs_sync, 'watermark', None)
+    monkeypatch.setattr(m, 'cache_timestamp', 0)
+    monkeypatch.setattr(m, 'spool_escrita', m.SpoolEscrita(str(tmp_path / 'spool')))
+    return falso
+
+def escrever_csv(caminho, linhas):
+    """CSV no formato exportado pelo sistema de entregas: (awb, id_motorista, tipo_servico, data_entrega)"""
+    pd.DataFrame(linhas, columns=['AWB', 'ID do motorista', 'Tipo de Serviço', 'Data/Hora Status do último status']).to_csv(
+        caminho, sep=';', index=False
+    )
+    return str(caminho)
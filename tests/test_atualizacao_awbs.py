@@ -0,0 +1,90 @@
+"""Uploads com AWBs já existentes cujo tipo de serviço ou data de entrega mudou"""
+
+from conftest import m, escrever_csv
+
+def test_upload_pequeno_com_cache_frio_atualiza_awb_existente(banco, tmp_path):
+    # Abaixo de PRELOAD_AWBS_MIN_LINHAS o índice não é carregado: o insert recusa A1 e a alteração segue como UPDATE
+    banco.inserir_awbs(('A1', 0, '2025-01-01 10:00:00'))
+    arquivo = escrever_csv(tmp_path / 'entregas.csv', [('A1', 1, 9, '2025-02-01 08:00:00'), ('A2', 2, 0, '2025-02-01 09:00:00')])
+
+    resultado = m.processar_csv_pro_tier(arquivo, 'job-frio')
+
+    assert resultado['success']
+    assert resultado['data']['awbs_novas_salvas'] == 1
+    assert resultado['data']['awbs_atualizadas'] == 1
+    awbs = banco.awbs()
+    assert awbs['A1']['tipo_servico'] == 9
+    assert awbs['A1']['data_entrega'] == '2025-02-01 08:00:00'
+    assert awbs['A2']['tipo_servico'] == 0
+
+def test_upload_repetido_com_cache_frio_conta_duplicatas(banco, tmp_path):
+    banco.inserir_awbs(('A1', 0, '2025-01-01T10:00:00+00:00'))
+    arquivo = escrever_csv(tmp_path / 'entregas.csv', [('A1', 1, 0, '01/01/2025 10:00')])
+
+    resultado = m.processar_csv_pro_tier(arquivo, 'job-repetido')
+
+    assert resultado['data']['awbs_novas_salvas'] == 0
+    assert resultado['data']['awbs_atualizadas'] == 0
+    assert resultado['data']['duplicatas_no_banco'] == 1
+    assert not any(operacao == 'update' for tabela, operacao in banco.chamadas if tabela == 'awbs')
+
+def test_alteracao_de_awb_que_o_update_nao_encontra_e_inserida(banco, tmp_path):
+    # O índice conhece A1 (inserção de outro lote ainda em voo ou que falhou), mas o banco ainda não
+    m.cache_awbs_existentes.adicionar(['A1'], m.fingerprint_estados([0], ['2025-01-01 10:00:00']))
+    arquivo = escrever_csv(tmp_path / 'entregas.csv', [('A1', 1, 9, '2025-02-01 08:00:00')])
+
+    resultado = m.processar_csv_pro_tier(arquivo, 'job-update-vazio')
+
+    assert resultado['data']['awbs_novas_salvas'] == 1
+    assert resultado['data']['awbs_atualizadas'] == 0
+    assert banco.awbs()['A1']['tipo_servico'] == 9
+
+def test_awbs_sem_banco_nem_spool_saem_do_indice(banco, tmp_path, monkeypatch):
+    def spool_indisponivel(*args):
+        raise OSError('disco cheio')
+    monkeypatch.setattr(m, 'MAX_RETRIES', 1)
+    monkeypatch.setattr(m.spool_escrita, 'gravar', spool_indisponivel)
+    arquivo = escrever_csv(tmp_path / 'entregas.csv', [('A1', 1, 0, '2025-02-01 08:00:00')])
+
+    banco.fora_do_ar = True
+    resultado = m.processar_csv_pro_tier(arquivo, 'job-sem-banco')
+    assert resultado['data']['erros_por_motivo']['falha_gravacao'] == 1
+    assert 'A1' not in m.cache_awbs_existentes
+
+    # Reenviado o mesmo arquivo, a AWB não é descartada como já existente
+    banco.fora_do_ar = False
+    resultado = m.processar_csv_pro_tier(arquivo, 'job-reenvio')
+    assert resultado['data']['awbs_novas_salvas'] == 1
+    assert 'A1' in banco.awbs()
+
+def alterar_dez_awbs(banco, tmp_path, job_id):
+    """Dez AWBs existentes, cada uma com uma data nova diferente (dez combinações de valores)"""
+    banco.inserir_awbs(*[(f'U{i}', 0, '2025-01-01 10:00:00') for i in range(10)])
+    m.cache_awbs_existentes.adicionar([f'U{i}' for i in range(10)], m.fingerprint_estados([0] * 10, ['2025-01-01 10:00:00'] * 10))
+    arquivo = escrever_csv(tmp_path / 'alteradas.csv', [(f'U{i}', 1, 9, f'2025-02-01 08:00:0{i}') for i in range(10)])
+    return m.processar_csv_pro_tier(arquivo, job_id)
+
+def test_alteracoes_via_rest_vao_numa_chamada_por_lote(banco, tmp_path):
+    banco.chamadas.clear()
+    resultado = alterar_dez_awbs(banco, tmp_path, 'job-rpc')
+
+    assert resultado['data']['awbs_atualizadas'] == 10
+    assert banco.chamadas.count(('rpc', 'atualizar_awbs_lote')) == 1
+    assert not any(operacao == 'update' for tabela, operacao in banco.chamadas if tabela == 'awbs')
+    assert all(banco.awbs()[f'U{i}']['data_entrega'] == f'2025-02-01 08:00:0{i}' for i in range(10))
+    if m.LINHAGEM_UPLOADS:
+        assert len(banco.tabelas['awbs_alteracoes']) == 10
+
+def test_sem_a_funcao_no_banco_a_linhagem_vai_num_insert_por_lote(banco, tmp_path, monkeypatch):
+    banco.funcoes_ausentes.add('atualizar_awbs_lote')
+    monkeypatch.setattr(m, 'ATUALIZACAO_VIA_RPC', True)
+    assert m.verificar_atualizacao_em_lote() is False
+
+    banco.chamadas.clear()
+    resultado = alterar_dez_awbs(banco, tmp_path, 'job-sem-rpc')
+
+    assert resultado['data']['awbs_atualizadas'] == 10
+    assert all(banco.awbs()[f'U{i}']['tipo_servico'] == 9 for i in range(10))
+    if m.LINHAGEM_UPLOADS:
+        assert banco.chamadas.count(('awbs_alteracoes', 'insert')) == 1
+        assert len(banco.tabelas['awbs_alteracoes']) == 10
@@ -0,0 +1,46 @@
+"""CLI de ingestão em massa: códigos de saída e estatísticas em JSON"""
+
+import json
+import sys
+
+import pytest
+
+import bulk_ingest
+from conftest import m, escrever_csv
+
+def executar_cli(monkeypatch, capsys, *argumentos):
+    """Roda bulk_ingest.main() com --json -; retorna (código de saída, estatísticas lidas do stdout)"""
+    monkeypatch.setattr(m, 'iniciar_servicos', lambda **opcoes: None)  # Sem handler de SIGTERM nem sondas no processo dos testes
+    monkeypatch.setattr(sys, 'argv', ['bulk_ingest.py', *argumentos, '--json', '-', '--intervalo', '0'])
+    with pytest.raises(SystemExit) as saida:
+        bulk_ingest.main()
+    linhas = capsys.readouterr().out.strip().splitlines()
+    assert len(linhas) == 1  # Com --json -, o stdout só tem o JSON (logs no stderr)
+    return saida.value.code, json.loads(linhas[0])
+
+def test_codigo_0_com_estatisticas_e_arquivo_repetido_ignorado(banco, tmp_path, monkeypatch, capsys):
+    caminho = escrever_csv(tmp_path / 'entregas.csv', [('B1', 1, 0, '2025-05-01 08:00:00'), ('B2', 2, 0, '2025-05-01 09:00:00')])
+    codigo, estatisticas = executar_cli(monkeypatch, capsys, caminho)
+    assert (codigo, estatisticas['codigo_saida'], estatisticas['success']) == (0, 0, True)
+    assert estatisticas['data']['awbs_novas_salvas'] == 2
+    assert sorted(banco.awbs()) == ['B1', 'B2']
+
+    codigo, estatisticas = executar_cli(monkeypatch, capsys, str(tmp_path))
+    assert codigo == 0
+    assert [ignorado['motivo'] for ignorado in estatisticas['data']['ignorados']] == ['já processado']
+
+def test_codigo_2_com_linhas_no_spool(banco, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(m, 'MAX_RETRIES', 1)
+    banco.fora_do_ar = True
+    caminho = escrever_csv(tmp_path / 'entregas.csv', [('B3', 1, 0, '2025-05-02 08:00:00')])
+    codigo, estatisticas = executar_cli(monkeypatch, capsys, caminho)
+    assert (codigo, estatisticas['codigo_saida']) == (2, 2)
+    assert estatisticas['spool']['linhas_pendentes'] == 1
+
+def test_codigo_1_sem_banco_ou_sem_arquivos(banco, tmp_path, monkeypatch, capsys):
+    codigo, estatisticas = executar_cli(monkeypatch, capsys, str(tmp_path / 'vazio'))
+    assert (codigo, estatisticas['error']) == (1, 'Nenhum arquivo encontrado')
+
+    monkeypatch.setattr(m, 'supabase', None)
+    codigo, estatisticas = executar_cli(monkeypatch, capsys, str(tmp_path))
+    assert (codigo, estatisticas['success']) == (1, False)
@@ -0,0 +1,29 @@
+"""Cancelamento cooperativo dos jobs de upload"""
+
+import os
+
+from conftest import m
+from test_checkpoint_job import chunk_csv
+
+def test_marcador_de_cancelamento_para_a_leitura(banco):
+    # Job rodando em outro worker: o cancelamento chega pelo marcador ao lado do checkpoint
+    checkpoint = m.CheckpointJob.criar('job-cancelado', file_path='entregas.csv')
+    lidos = []
+    def ler():
+        for i in range(10):
+            lidos.append(i + 1)
+            yield chunk_csv((f'C{i + 1}', 1, 0, '2025-03-04 10:00:00'))
+            if i + 1 == 2:
+                assert m.cancelar_job_upload('job-cancelado') == 'running'
+                assert os.path.exists(os.path.join(m.JOBS_FOLDER, 'job-cancelado.cancel'))
+
+    motoristas, tarifas = m.carregar_dados_supabase_pro()
+    pipeline = m.PipelineIngestao(motoristas, tarifas, m.iniciar_progresso('job-cancelado'), checkpoint=checkpoint)
+    totais = pipeline.executar(ler(), 10)
+
+    assert pipeline.cancelado
+    assert lidos == [1, 2, 3]  # O chunk 3 já lido é descartado e nada depois dele é lido
+    assert set(banco.awbs()) <= {'C1', 'C2'}
+    assert totais['salvos'] + totais['linhas_canceladas'] == 2
+    checkpoint.remover()
+    assert not os.path.exists(os.path.join(m.JOBS_FOLDER, 'job-cancelado.cancel'))
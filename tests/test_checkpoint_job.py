@@ -0,0 +1,72 @@
+"""Jobs de upload: checkpoint em disco, retomada após restart e inicialização explícita dos serviços"""
+
+import os
+import subprocess
+import sys
+import threading
+
+import pandas as pd
+
+from conftest import RAIZ, m
+
+def test_importar_o_modulo_nao_inicia_servicos(tmp_path):
+    # Testes, bulk_ingest.py e ferramentas importam o módulo: nada roda em background até iniciar_servicos()
+    verificacao = (
+        'import signal, threading\n'
+        'import main_supabase_integrated as m\n'
+        'print(sorted(t.name for t in threading.enumerate()), signal.getsignal(signal.SIGTERM) is signal.SIG_DFL)\n'
+    )
+    saida = subprocess.run([sys.executable, '-c', verificacao], cwd=tmp_path, capture_output=True, text=True, check=True,
+                           env={**os.environ, 'PYTHONPATH': RAIZ, 'RETOMAR_JOBS': '1', 'INDICE_AWBS_PERSISTENTE': '0'})
+    assert saida.stdout.strip().splitlines()[-1] == "['MainThread'] True"
+
+def chunk_csv(*linhas):
+    """Chunk como lido do CSV (colunas do arquivo, valores em texto)"""
+    return pd.DataFrame([[str(valor) for valor in linha] for linha in linhas],
+                        columns=['AWB', 'ID do motorista', 'Tipo de Serviço', 'Data/Hora Status do último status'])
+
+def test_retomada_pula_os_chunks_confirmados(banco):
+    chunks = [
+        chunk_csv(('R1', 1, 0, '2025-03-03 10:00:00'), ('R2', 1, 0, '2025-03-03 10:00:00')),
+        chunk_csv(('R3', 2, 0, '2025-03-03 11:00:00')),
+        chunk_csv(('R4', 3, 9, '2025-03-03 12:00:00')),
+    ]
+    # Antes do restart: o chunk 1 foi confirmado (suas AWBs já estavam no banco)
+    anterior = m.CheckpointJob.criar('job-retomada', file_path='entregas.csv')
+    totais_chunk1 = {**m.novos_totais_pipeline(), 'chunks': 1, 'linhas': 2, 'processadas': 2, 'salvos': 2}
+    anterior.confirmar(1, totais_chunk1)
+    anterior.despachar(1)
+
+    checkpoint = m.CheckpointJob.carregar(anterior.caminho)
+    motoristas, tarifas = m.carregar_dados_supabase_pro()
+    pipeline = m.PipelineIngestao(motoristas, tarifas, m.iniciar_progresso('job-retomada'), checkpoint=checkpoint)
+    totais = pipeline.executar(chunks, len(chunks))
+
+    assert sorted(banco.awbs()) == ['R3', 'R4']  # R1 e R2 não foram relidas nem regravadas
+    assert (totais['chunks'], totais['salvos'], totais['processadas']) == (3, 4, 4)
+    assert checkpoint.dados['confirmados_ate'] == 3
+    checkpoint.remover()
+
+def test_falha_no_checkpoint_termina_o_pipeline_com_erro(banco, monkeypatch):
+    checkpoint = m.CheckpointJob.criar('job-disco-cheio', file_path='entregas.csv')
+    def disco_cheio(chunk_id):
+        raise OSError('No space left on device')
+    monkeypatch.setattr(checkpoint, 'despachar', disco_cheio)
+    motoristas, tarifas = m.carregar_dados_supabase_pro()
+    pipeline = m.PipelineIngestao(motoristas, tarifas, m.iniciar_progresso('job-disco-cheio'), checkpoint=checkpoint)
+    chunks = [chunk_csv((f'D{i}', 1, 0, '2025-03-03 10:00:00')) for i in range(m.PIPELINE_FILA * 4)]
+
+    resultado = {}
+    def executar():
+        try:
+            pipeline.executar(chunks, len(chunks))
+        except OSError as e:
+            resultado['erro'] = e
+    execucao = threading.Thread(target=executar, daemon=True)
+    execucao.start()
+    execucao.join(timeout=10)
+
+    assert not execucao.is_alive()  # Antes: o dedup morria sem sentinelas e executar() esperava para sempre
+    assert 'No space left' in str(resultado['erro'])
+    assert banco.awbs() == {}
+    checkpoint.remover()
@@ -0,0 +1,40 @@
+"""Controlador AIMD das escritas: aumento aditivo, redução pela metade e limites"""
+
+from conftest import m
+
+def test_lote_rapido_aumenta_aditivamente_e_a_cada_3_libera_mais_uma_escrita(monkeypatch):
+    monkeypatch.setattr(m, 'MAX_WORKERS_LIMITE', 8)
+    controlador = m.ControladorEscrita()
+    inicial = (controlador.batch_size, controlador.limite_escritas)
+    for _ in range(3):
+        controlador.registrar(m.LATENCIA_ALVO / 2, True)
+    assert controlador.batch_size == inicial[0] + 3 * m.BATCH_SIZE_INCREMENTO
+    assert controlador.limite_escritas == inicial[1] + 1
+    assert controlador.decisoes[-1]['acao'] == 'aumentar'
+
+def test_falha_ou_latencia_alta_reduz_pela_metade():
+    controlador = m.ControladorEscrita()
+    controlador.batch_size, controlador.limite_escritas = 1000, 6
+    controlador.registrar(0.1, False)
+    assert (controlador.batch_size, controlador.limite_escritas, controlador.falhas) == (500, 3, 1)
+    assert controlador.atraso >= m.BATCH_DELAY
+
+    controlador.registrar(m.LATENCIA_MAXIMA + 1, True)  # Lote lento reduz, mas não conta como falha
+    assert (controlador.batch_size, controlador.limite_escritas, controlador.falhas) == (250, 1, 1)
+    assert controlador.decisoes[-1]['motivo'].startswith('latência')
+
+    # Entre a latência alvo e a máxima nada muda
+    controlador.registrar((m.LATENCIA_ALVO + m.LATENCIA_MAXIMA) / 2, True)
+    assert (controlador.batch_size, controlador.limite_escritas) == (250, 1)
+
+def test_ajustes_respeitam_os_limites(monkeypatch):
+    monkeypatch.setattr(m, 'MAX_WORKERS_LIMITE', 4)
+    controlador = m.ControladorEscrita()
+    for _ in range(200):
+        controlador.registrar(0.01, True)
+    assert (controlador.batch_size, controlador.limite_escritas, controlador.atraso) == (m.BATCH_SIZE_MAX, 4, 0)
+
+    for _ in range(20):
+        controlador.registrar(0.01, False)
+    assert (controlador.batch_size, controlador.limite_escritas) == (m.BATCH_SIZE_MIN, 1)
+    assert controlador.atraso == m.BATCH_DELAY_MAX
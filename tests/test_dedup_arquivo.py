@@ -0,0 +1,39 @@
+"""Dedup das AWBs repetidas dentro de um mesmo upload (DedupArquivo)"""
+
+import numpy as np
+
+from conftest import m
+
+def primeiras_ocorrencias(lotes):
+    """Referência: máscara da 1ª ocorrência de cada AWB ao longo de todos os lotes"""
+    vistas = set()
+    mascaras = []
+    for lote in lotes:
+        mascara = []
+        for awb in lote:
+            mascara.append(awb not in vistas)
+            vistas.add(awb)
+        mascaras.append(np.array(mascara))
+    return mascaras
+
+def test_registra_so_a_primeira_ocorrencia_com_runs_em_memoria_e_em_disco():
+    aleatorio = np.random.default_rng(7)
+    lotes = [np.array([f'AWB{n}' for n in aleatorio.integers(0, 3000, 500)], dtype=object) for _ in range(40)]
+    dedup = m.DedupArquivo(limite_memoria=1000)
+    try:
+        for lote, esperada in zip(lotes, primeiras_ocorrencias(lotes)):
+            assert (dedup.registrar(lote) == esperada).all()
+        estatisticas = dedup.estatisticas()
+        assert estatisticas['awbs_distintas'] == len(set(np.concatenate(lotes)))
+        assert estatisticas['runs_em_disco'] >= 1
+    finally:
+        dedup.fechar()
+
+def test_runs_em_memoria_ficam_em_quantidade_logaritmica():
+    dedup = m.DedupArquivo()
+    for chunk in range(256):
+        dedup.registrar(np.array([f'C{chunk}_{i}' for i in range(100)], dtype=object))
+    estatisticas = dedup.estatisticas()
+    assert estatisticas['awbs_distintas'] == 25600
+    assert estatisticas['runs_em_memoria'] <= 9
+    assert dedup.registrar(np.array(['C0_0', 'C255_99', 'nova'], dtype=object)).tolist() == [False, False, True]
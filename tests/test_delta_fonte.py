@@ -0,0 +1,24 @@
+"""Upload delta por fonte: só as linhas novas ou alteradas desde o último upload aceito são processadas"""
+
+import uuid
+
+from conftest import m, escrever_csv
+
+def test_linha_rejeitada_volta_no_proximo_upload_da_fonte(banco, tmp_path):
+    fonte = f'fonte-{uuid.uuid4().hex[:8]}'
+    dia1 = [('A1', 1, 0, '2025-03-03 10:00:00'), ('A2', 7, 0, '2025-03-03 11:00:00')]  # Motorista 7 ainda não cadastrado
+    primeiro = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'dia1.csv', dia1), 'job-dia1', fonte_delta=fonte)
+    assert primeiro['data']['awbs_novas_salvas'] == 1
+    assert primeiro['data']['erros_por_motivo']['motorista_desconhecido'] == 1
+
+    banco.tabelas['motoristas'].append({'id_motorista': 7, 'nome_motorista': 'Motorista 7'})
+    m.cache_timestamp = 0
+    dia2 = dia1 + [('A3', 2, 0, '2025-03-03 12:00:00')]
+    segundo = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'dia2.csv', dia2), 'job-dia2', fonte_delta=fonte)
+
+    assert (segundo['data']['awbs_novas_salvas'], segundo['data']['linhas_inalteradas']) == (2, 1)
+    assert sorted(banco.awbs()) == ['A1', 'A2', 'A3']
+
+    # Com as três aceitas, o mesmo arquivo não traz mais nada
+    terceiro = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'dia3.csv', dia2), 'job-dia3', fonte_delta=fonte)
+    assert (terceiro['data']['awbs_novas_salvas'], terceiro['data']['linhas_inalteradas']) == (0, 3)
@@ -0,0 +1,33 @@
+"""Inserção de AWBs novas com o banco resolvendo os conflitos (ON CONFLICT (awb) DO NOTHING)"""
+
+import pandas as pd
+import pytest
+
+from conftest import m
+
+def novas_awbs(*awbs):
+    return pd.DataFrame({
+        'awb': list(awbs), 'id_motorista': 1, 'nome_motorista': 'Motorista 1',
+        'tipo_servico': 0, 'data_entrega': '2025-02-01 08:00:00', 'valor_entrega': 3.5
+    })
+
+@pytest.mark.parametrize('ignorar_conflitos', [True, False])
+def test_awb_ja_existente_nao_derruba_o_lote(banco, monkeypatch, ignorar_conflitos):
+    # Sem ignorar conflitos o insert falha com duplicate key e é repetido deixando o banco pular a AWB
+    monkeypatch.setattr(m, 'INSERT_IGNORAR_CONFLITOS', ignorar_conflitos)
+    banco.inserir_awbs(('A2', 0, '2025-01-01 10:00:00'))
+
+    inseridas = m.gravar_awbs_pro(novas_awbs('A1', 'A2', 'A3'), 'job:1')
+
+    assert inseridas.tolist() == [True, False, True]
+    assert sorted(banco.awbs()) == ['A1', 'A2', 'A3']
+    assert banco.awbs()['A2']['data_entrega'] == '2025-01-01 10:00:00'
+
+def test_conflito_com_o_mesmo_estado_conta_como_duplicata(banco):
+    banco.inserir_awbs(('A2', 0, '2025-02-01T08:00:00'))
+    lote = {'chunk_id': 1, 'batch_id': 'job:1', 'upload_id': 'job', 'novas': novas_awbs('A1', 'A2'),
+            'alteradas': None, 'duplicatas': 0, 'erros_por_motivo': {}}
+
+    m.gravar_lote_duravel(lote)
+
+    assert (lote['salvos'], lote['atualizadas'], lote['duplicatas']) == (1, 0, 1)
@@ -0,0 +1,39 @@
+"""Índice de AWBs em disco compartilhado entre os workers"""
+
+import numpy as np
+
+from conftest import m
+
+def estados(*valores):
+    return np.array(valores, dtype=np.uint64)
+
+def test_segunda_instancia_ve_as_inclusoes_da_primeira(tmp_path):
+    primeiro = m.IndiceAWBPersistente(str(tmp_path))
+    segundo = m.IndiceAWBPersistente(str(tmp_path))
+
+    novas, _ = primeiro.classificar(['P1', 'P2'], estados(1, 2))
+    assert novas.tolist() == [True, True]
+    assert segundo.contem(['P1']).tolist() == [False]  # Ainda não recarregou
+    segundo.recarregar()
+    assert segundo.contem(['P1', 'P2', 'P3']).tolist() == [True, True, False]
+
+    # A classificação recarrega sob o flock: P2 não é inédita para o segundo worker e o estado novo é uma alteração
+    novas, alteradas = segundo.classificar(['P2', 'P3'], estados(5, 3))
+    assert (novas.tolist(), alteradas.tolist()) == ([False, True], [True, False])
+    novas, alteradas = primeiro.classificar(['P3', 'P2'], estados(3, 5))
+    assert (novas.tolist(), alteradas.tolist()) == ([False, False], [False, False])
+
+def test_log_compacta_numa_nova_geracao_que_os_outros_workers_carregam(tmp_path, monkeypatch):
+    monkeypatch.setattr(m.IndiceAWBPersistente, 'LIMITE_LOG', 4)
+    primeiro = m.IndiceAWBPersistente(str(tmp_path))
+    segundo = m.IndiceAWBPersistente(str(tmp_path))
+    geracao = primeiro.geracao
+
+    primeiro.classificar([f'G{i}' for i in range(3)], estados(1, 1, 1))
+    assert (primeiro.geracao, primeiro.estatisticas()['registros_log']) == (geracao, 3)
+    primeiro.classificar([f'G{i}' for i in range(3, 6)], estados(1, 1, 1))
+    assert (primeiro.geracao, primeiro.estatisticas()['registros_log']) == (geracao + 1, 0)
+
+    segundo.recarregar()
+    assert segundo.geracao == geracao + 1
+    assert len(segundo) == 6 and segundo.contem([f'G{i}' for i in range(6)]).all()
@@ -0,0 +1,44 @@
+"""Endpoint de eventos em micro-lotes (/api/awbs/eventos)"""
+
+import json
+
+from conftest import m
+
+def enviar_eventos(eventos):
+    corpo = '\n'.join(json.dumps(evento) for evento in eventos)
+    return m.app.test_client().post('/api/awbs/eventos', data=corpo, content_type='application/x-ndjson')
+
+def test_evento_de_awb_existente_com_indice_frio_e_gravado_como_alteracao(banco):
+    banco.inserir_awbs(('E1', 0, '2025-01-01 10:00:00'))
+
+    resposta = enviar_eventos([
+        {'awb': 'E1', 'id_motorista': 1, 'tipo_servico': 9, 'data_entrega': '2025-02-01 08:00:00'},
+        {'awb': 'E2', 'id_motorista': 2, 'tipo_servico': 0, 'data_entrega': '2025-02-01 09:00:00'},
+    ])
+
+    assert resposta.status_code == 200
+    dados = resposta.get_json()['data']
+    assert dados['awbs_novas'] == 1
+    assert dados['awbs_alteradas'] == 1
+    assert dados['duplicatas_no_banco'] == 0
+    awbs = banco.awbs()
+    assert awbs['E1']['tipo_servico'] == 9
+    assert 'E2' in awbs
+
+def test_evento_repetido_conta_como_duplicata(banco):
+    banco.inserir_awbs(('E1', 0, '2025-01-01 10:00:00'))
+
+    resposta = enviar_eventos([{'awb': 'E1', 'id_motorista': 1, 'tipo_servico': 0, 'data_entrega': '2025-01-01 10:00:00'}])
+
+    dados = resposta.get_json()['data']
+    assert (dados['awbs_novas'], dados['awbs_alteradas'], dados['duplicatas_no_banco']) == (0, 0, 1)
+
+def test_erro_inesperado_responde_503(banco, monkeypatch):
+    def transformacao_quebrada(*args):
+        raise RuntimeError('falha inesperada')
+    monkeypatch.setattr(m, 'transformar_chunk_pro', transformacao_quebrada)
+
+    resposta = enviar_eventos([{'awb': 'E3', 'id_motorista': 1, 'tipo_servico': 0}])
+
+    assert resposta.status_code == 503
+    assert resposta.get_json()['success'] is False
@@ -0,0 +1,90 @@
+"""Intake dos uploads: descritor calculado na recepção e registro dos arquivos já processados (hash do conteúdo)"""
+
+import hashlib
+import io
+import os
+import time
+import zipfile
+
+from conftest import m, escrever_csv
+
+def executar_job(caminho):
+    descritor = m.descrever_arquivo_local(caminho)
+    job_id = m.criar_job_upload(caminho, descritor['arquivo'], descritor)
+    limite = time.time() + 10
+    while m.consultar_job_upload(job_id)['status'] in ('queued', 'running') and time.time() < limite:
+        time.sleep(0.02)
+    return descritor, m.consultar_job_upload(job_id)
+
+def test_descritor_conta_linhas_no_texto_decodificado_e_calcula_o_hash(tmp_path, monkeypatch):
+    # Blocos e amostra pequenos: a contagem atravessa o fim da amostra e caracteres partidos entre blocos
+    monkeypatch.setattr(m, 'INTAKE_BLOCO_BYTES', 7)
+    monkeypatch.setattr(m, 'INTAKE_AMOSTRA_BYTES', 64)
+    cabecalho = 'AWB;ID do motorista;Tipo de Serviço;Data/Hora Status do último status\n'
+    linhas = ''.join(f'Ċ{i};1;0;2025-04-03 08:00:00\n' for i in range(40))  # Ċ em UTF-16-LE: bytes 0A 01
+    casos = [
+        ('utf16.csv', (cabecalho + linhas).encode('utf-16'), 40),
+        ('sem_quebra_final.csv', (cabecalho + linhas).rstrip('\n').encode('utf-8'), 40),
+        ('pequeno.csv', (cabecalho + 'A1;1;0;2025-04-03 08:00:00').encode('utf-8'), 1),
+        ('so_cabecalho.csv', cabecalho.encode('utf-8'), 0),
+    ]
+    for nome, conteudo, total in casos:
+        descritor = m.receber_upload(io.BytesIO(conteudo), str(tmp_path / nome), nome)
+        assert (nome, descritor['total_linhas']) == (nome, total)
+        assert descritor['sha256'] == hashlib.sha256(conteudo).hexdigest()
+        assert descritor['tamanho_bytes'] == len(conteudo)
+        assert (tmp_path / nome).read_bytes() == conteudo
+        assert m.descrever_arquivo_local(str(tmp_path / nome))['total_linhas'] == total
+
+def test_hash_so_e_registrado_quando_o_upload_chega_inteiro_ao_banco(banco, tmp_path):
+    linhas = [('H1', 1, 0, '2025-04-01 08:00:00'), ('H2', 2, 0, '2025-04-01 09:00:00')]
+    banco.recusar = Exception({'code': '23514', 'message': 'new row violates check constraint'})
+    descritor, job = executar_job(escrever_csv(tmp_path / 'recusado.csv', linhas))
+    assert job['status'] == 'done'
+    assert job['result']['erros_por_motivo']['falha_gravacao'] == 2
+    assert m.consultar_upload_processado(descritor['sha256']) is None  # O reenvio do arquivo processa de novo
+
+    banco.recusar = None
+    descritor, job = executar_job(escrever_csv(tmp_path / 'reenviado.csv', linhas))
+    assert job['result']['awbs_novas_salvas'] == 2
+    assert m.consultar_upload_processado(descritor['sha256'])['job_id'] == job['job_id']
+
+def enviar_zip(membros, **campos):
+    """POST de um .zip no upload em lote; membros: (nome no zip, conteúdo em bytes)"""
+    pacote = io.BytesIO()
+    with zipfile.ZipFile(pacote, 'w', zipfile.ZIP_DEFLATED) as arquivo_zip:
+        for nome, conteudo in membros:
+            arquivo_zip.writestr(nome, conteudo)
+    pacote.seek(0)
+    return m.app.test_client().post('/api/upload/lote', data={'files': (pacote, 'lote.zip'), **campos},
+                                    content_type='multipart/form-data')
+
+def csv_bytes(*awbs):
+    return ('AWB;ID do motorista;Tipo de Serviço;Data/Hora Status do último status\n'
+            + ''.join(f'{awb};1;0;2025-04-02 08:00:00\n' for awb in awbs)).encode('utf-8')
+
+def test_zip_fora_dos_limites_e_recusado_antes_de_extrair(banco, monkeypatch):
+    monkeypatch.setattr(m, 'ZIP_MAX_MEMBROS', 2)
+    demais = enviar_zip([(f'dia{i}.csv', csv_bytes(f'Z{i}')) for i in range(3)])
+    assert demais.status_code == 400 and 'membros' in demais.get_json()['error']
+
+    bomba = enviar_zip([('bomba.csv', b'0' * (10 * 1024 * 1024))])
+    assert bomba.status_code == 400 and 'compressão' in bomba.get_json()['error']
+
+    caminho = enviar_zip([('../../fora.csv', csv_bytes('Z9'))])
+    assert caminho.status_code == 400 and 'inválido' in caminho.get_json()['error']
+
+    monkeypatch.setattr(m, 'ZIP_MAX_BYTES', 100)
+    grande = enviar_zip([('dia1.csv', csv_bytes('Z1', 'Z2', 'Z3'))])
+    assert grande.status_code == 400 and 'descomprimidos' in grande.get_json()['error']
+    assert not [nome for nome in os.listdir(m.UPLOAD_FOLDER) if nome.startswith('lote_')]
+
+def test_zip_dentro_dos_limites_vira_um_job(banco):
+    resposta = enviar_zip([('pasta/dia1.csv', csv_bytes('Z1')), ('pasta/dia2.csv', csv_bytes('Z2'))])
+    assert resposta.status_code == 202
+    dados = resposta.get_json()['data']
+    assert [arquivo['arquivo'] for arquivo in dados['arquivos']] == ['dia1.csv', 'dia2.csv']
+    limite = time.time() + 10
+    while m.consultar_job_upload(dados['job_id'])['status'] in ('queued', 'running') and time.time() < limite:
+        time.sleep(0.02)
+    assert m.consultar_job_upload(dados['job_id'])['result']['awbs_novas_salvas'] == 2
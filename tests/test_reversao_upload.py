@@ -0,0 +1,78 @@
+"""Reversão de um upload pela linhagem (awbs.upload_id e awbs_alteracoes)"""
+
+import subprocess
+import sys
+
+from conftest import m, escrever_csv
+
+def test_reverter_apaga_inseridas_restaura_alteradas_e_mantem_pagas(banco, tmp_path):
+    banco.inserir_awbs(('X1', 8, '2025-01-01 10:00:00'))
+    arquivo = escrever_csv(tmp_path / 'ruim.csv', [
+        ('X1', 1, 9, '2025-03-03 10:00:00'),
+        ('N1', 1, 0, '2025-03-03 11:00:00'),
+        ('N2', 2, 0, '2025-03-03 12:00:00'),
+    ])
+    resultado = m.processar_csv_pro_tier(arquivo, 'job-ruim')
+    assert (resultado['data']['awbs_novas_salvas'], resultado['data']['awbs_atualizadas']) == (2, 1)
+    banco.awbs()['N2']['status'] = 'PAGA'
+
+    reversao = m.reverter_upload('job-ruim')
+
+    assert (reversao['awbs_apagadas'], reversao['awbs_pagas_mantidas'], reversao['awbs_restauradas']) == (1, 1, 1)
+    awbs = banco.awbs()
+    assert sorted(awbs) == ['N2', 'X1']
+    assert awbs['X1']['tipo_servico'] == 8
+    assert 'N1' not in m.cache_awbs_existentes
+    assert banco.tabelas['awbs_alteracoes'] == []
+
+    # O mesmo arquivo corrigido volta a gravar o que foi revertido
+    novo = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'corrigido.csv', [('N1', 1, 6, '2025-03-03 11:00:00')]), 'job-corrigido')
+    assert novo['data']['awbs_novas_salvas'] == 1
+    assert banco.awbs()['N1']['tipo_servico'] == 6
+
+class BancoSemLinhagem:
+    """Banco criado antes da linhagem: awbs sem a coluna upload_id (erro 42703 do PostgREST)"""
+
+    def table(self, nome):
+        return self
+
+    def select(self, colunas='*'):
+        return self
+
+    def limit(self, quantidade):
+        return self
+
+    def execute(self):
+        raise Exception({'code': '42703', 'message': 'column awbs.upload_id does not exist'})
+
+def test_linhagem_desligada_quando_o_esquema_nao_existe(banco, tmp_path, monkeypatch):
+    monkeypatch.setattr(m, 'LINHAGEM_UPLOADS', True)
+    monkeypatch.setattr(m, 'COLUNAS_AWBS', list(m.COLUNAS_AWBS))
+    monkeypatch.setattr(m, 'supabase', BancoSemLinhagem())
+
+    assert m.verificar_linhagem_uploads() is False
+    assert 'upload_id' not in m.COLUNAS_AWBS
+
+    monkeypatch.setattr(m, 'supabase', banco)
+    resultado = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'a.csv', [('S1', 1, 0, '2025-03-03 10:00:00')]), 'job-sem-linhagem')
+    assert resultado['data']['awbs_novas_salvas'] == 1
+    assert 'upload_id' not in banco.awbs()['S1']
+
+def test_reversao_recusada_com_escrita_em_outro_processo(banco, tmp_path):
+    # Outro worker no meio de um upload segura a trava compartilhada de escrita
+    outro = subprocess.Popen([sys.executable, '-c', (
+        'import fcntl, sys, time\n'
+        f'trava = open({m.ESCRITAS_TRAVA!r}, "a+")\n'
+        'fcntl.flock(trava, fcntl.LOCK_SH)\n'
+        'print("ok", flush=True)\n'
+        'sys.stdin.read()\n'
+    )], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        assert outro.stdout.readline().strip() == 'ok'
+        resposta = m.app.test_client().post('/api/upload/jobs/job-qualquer/rollback')
+        assert resposta.status_code == 409
+    finally:
+        outro.stdin.close()
+        outro.wait()
+
+    assert m.app.test_client().post('/api/upload/jobs/job-qualquer/rollback').status_code == 200
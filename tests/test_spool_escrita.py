@@ -0,0 +1,78 @@
+"""Spool em disco dos lotes que o banco recusou e reenvio deles quando ele volta"""
+
+import os
+
+from conftest import m, escrever_csv
+
+def drenar_spool():
+    # A thread de reenvio em background pode estar com o spool: espera até ele esvaziar
+    while m.spool_escrita.pendente():
+        m.spool_escrita.drenar()
+
+def test_insercao_e_atualizacao_no_spool_sao_reenviadas_em_ordem(banco, tmp_path, monkeypatch):
+    monkeypatch.setattr(m, 'MAX_RETRIES', 1)
+    banco.fora_do_ar = True
+    primeiro = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'dia1.csv', [
+        ('A1', 1, 0, '2025-02-01 08:00:00'), ('A2', 2, 0, '2025-02-01 09:00:00')
+    ]), 'job-dia1')
+    assert primeiro['data']['linhas_em_spool'] == 2
+    assert primeiro['data']['awbs_novas_salvas'] == 0
+
+    # Com o spool pendente, a alteração de A1 entra atrás da inserção dela
+    banco.fora_do_ar = False
+    segundo = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'dia2.csv', [('A1', 1, 9, '2025-02-02 08:00:00')]), 'job-dia2')
+    assert segundo['data']['linhas_em_spool'] == 1
+    assert banco.awbs() == {}
+
+    drenar_spool()
+
+    awbs = banco.awbs()
+    assert (awbs['A1']['tipo_servico'], awbs['A1']['upload_id']) == (9, 'job-dia1')
+    assert awbs['A2']['tipo_servico'] == 0
+
+def test_reenvio_de_insercao_aplica_alteracao_em_awb_gravada_por_outro_writer(banco, tmp_path, monkeypatch):
+    monkeypatch.setattr(m, 'MAX_RETRIES', 1)
+    banco.fora_do_ar = True
+    m.processar_csv_pro_tier(escrever_csv(tmp_path / 'entregas.csv', [('A1', 1, 9, '2025-02-01 08:00:00')]), 'job-spool')
+    banco.fora_do_ar = False
+    banco.inserir_awbs(('A1', 0, '2025-01-01 10:00:00'))
+
+    drenar_spool()
+
+    assert banco.awbs()['A1']['tipo_servico'] == 9
+    assert len(banco.tabelas['awbs']) == 1
+
+def data_invalida():
+    """Recusa permanente do PostgREST (SQLSTATE 22007): repetir o mesmo lote nunca vai dar certo"""
+    return Exception({'code': '22007', 'message': 'invalid input syntax for type timestamp'})
+
+def linhas_rejeitadas():
+    caminho = m.spool_escrita._caminho('rejeitados.log')
+    return open(caminho, 'rb').read().splitlines() if os.path.exists(caminho) else []
+
+def test_erro_permanente_vai_para_rejeitados_sem_segurar_a_fila(banco, tmp_path):
+    banco.recusar = data_invalida()
+    resultado = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'ruim.csv', [('P1', 1, 0, '2025-02-01 08:00:00')]), 'job-ruim')
+    assert resultado['data']['erros_por_motivo']['falha_gravacao'] == 1
+    assert resultado['data']['linhas_em_spool'] == 0
+    assert not m.spool_escrita.pendente()
+    assert len(linhas_rejeitadas()) == 1
+    assert banco.chamadas.count(('awbs', 'upsert')) == 1  # Sem novas tentativas
+
+    # O upload seguinte vai direto ao banco, sem entrar atrás de nada no spool
+    banco.recusar = None
+    seguinte = m.processar_csv_pro_tier(escrever_csv(tmp_path / 'bom.csv', [('P2', 1, 0, '2025-02-01 09:00:00')]), 'job-bom')
+    assert seguinte['data']['awbs_novas_salvas'] == 1
+
+def test_reenvio_rejeita_erro_permanente_na_primeira_falha(banco, tmp_path, monkeypatch):
+    monkeypatch.setattr(m, 'MAX_RETRIES', 1)
+    banco.fora_do_ar = True
+    m.processar_csv_pro_tier(escrever_csv(tmp_path / 'entregas.csv', [('P3', 1, 0, '2025-02-01 08:00:00')]), 'job-spool')
+    banco.fora_do_ar = False
+
+    banco.recusar = data_invalida()
+    assert m.spool_escrita.drenar() == 0  # Não propaga o erro nem espera SPOOL_REPLAY_MAX_TENTATIVAS
+    assert not m.spool_escrita.pendente()
+    assert len(linhas_rejeitadas()) == 1
+    assert m.spool_escrita.estatisticas()['lotes_rejeitados'] == 1
+    assert 'P3' not in m.cache_awbs_existentes
@@ -1,5 +1,6 @@
-from main_supabase_integrated import app
+from main_supabase_integrated import app, iniciar_servicos
+
+iniciar_servicos()
 
 if __name__ == "__main__":
     app.run()
-